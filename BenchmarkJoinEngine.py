@@ -0,0 +1,140 @@
+#!/bin/env python
+"""
+Benchmark the attribute join: the old dict-of-dicts approach versus the columnar NumPy AttributeTable in GenerateStateMapperData.py
+
+Builds a synthetic decennial_attributes.csv the size of a state, then for each approach loads it and looks up every block's GEOID
+(in a shuffled order, the way features come out of a shapefile) and reports the time taken and how much memory it needed.
+Each approach runs in its own child process, so one's memory use doesn't muddy the other's.
+
+Usage:
+    BenchmarkJoinEngine.py [--blocks N] [--seed N]
+    The default of 710000 blocks is about the size of California.
+"""
+
+import os, sys, time, random, tempfile, shutil
+import csv, argparse, multiprocessing
+
+from GenerateStateMapperData import DECENNIAL_FIELD_LABELS, MERGE_TRANSACTION_SIZE, AttributeTable, read_attribute_rows, peak_rss_mb
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def write_synthetic_csv(path,blocks,seed):
+    # a massaged decennial CSV: the header row of labels, then a GEOID and 15 small counts per block
+    # the GEOIDs, shuffled into the order we'll look them up in, are saved alongside as a NumPy .npy file
+    generator = random.Random(seed)
+    geoids    = []
+    csvwrite  = open(path, 'wb')
+    csvoutput = csv.writer(csvwrite)
+    csvoutput.writerow(DECENNIAL_FIELD_LABELS)
+    for index in range(blocks):
+        county = 1 + 2 * (index / 20000)
+        tract  = (index / 400) % 10000
+        geoid  = "06%03d%06d%04d" % (county, tract, index % 400)
+        geoids.append(geoid)
+        csvoutput.writerow([geoid] + [ generator.randint(0,50) for field in DECENNIAL_FIELD_LABELS[1:] ])
+    csvwrite.close()
+    generator.shuffle(geoids)
+    numpy.save(os.path.splitext(path)[0] + '.npy', numpy.array(geoids, dtype='S15'))
+
+
+def join_with_dicts(path,geoids):
+    # the way DecennialMerger used to do it: a dict of eight-key dicts, one per block, then one lookup per feature
+    block_attributes = {}
+    csvread  = open(path, 'rb')
+    csvinput = csv.reader(csvread)
+    csvinput.next()
+    for geoid,hispanic,totalpop,white,black,amerind,asian,hawpi,age1,age2,age3,age4,age5,age6,age7,age8 in csvinput:
+        block_attributes[geoid] = {
+            'HISP':int(hispanic),
+            'TOTPOP':int(totalpop),
+            'WHITE':int(white),
+            'BLACK':int(black),
+            'AMERIND':int(amerind),
+            'ASIAN':int(asian),
+            'HAWPI':int(hawpi),
+            'YOUTH':int(age1) + int(age2) + int(age3) + int(age4) + int(age5) + int(age6) + int(age7) + int(age8),
+        }
+    csvread.close()
+    loaded = time.time()
+
+    total = 0
+    for geoid in geoids:
+        attributes = block_attributes[geoid]
+        total += attributes['YOUTH']
+    return loaded, total
+
+
+def join_with_columns(path,geoids):
+    # the way DecennialMerger does it now: columns in an AttributeTable, then a batch of lookups at a time
+    csvread  = open(path, 'rb')
+    csvinput = csv.reader(csvread)
+    csvinput.next()
+    data  = read_attribute_rows(csvinput, 15, DECENNIAL_FIELD_LABELS[1:])
+    csvread.close()
+    table = AttributeTable(data['GEOID'], {
+        'TOTPOP':data['TotPop'],
+        'YOUTH':data['agem1'] + data['agem2'] + data['agem3'] + data['agem4'] + data['agef1'] + data['agef2'] + data['agef3'] + data['agef4'],
+    })
+    del data
+    loaded = time.time()
+
+    total = 0
+    for start in range(0, len(geoids), MERGE_TRANSACTION_SIZE):
+        rows   = table.rows(geoids[start:start+MERGE_TRANSACTION_SIZE])
+        total += int(table.column('YOUTH', rows).sum())
+    return loaded, total
+
+
+def run_approach(args):
+    # child process: run one approach and report its timings and memory
+    # the GEOIDs to look up are read from the compact .npy file, so that reading them doesn't count toward either approach's memory
+    name, path = args
+    function = { 'dicts':join_with_dicts, 'columns':join_with_columns }[name]
+    geoids   = numpy.load(os.path.splitext(path)[0] + '.npy')
+    before   = peak_rss_mb()
+    started  = time.time()
+    loaded, total = function(path, geoids)
+    finished = time.time()
+    after    = peak_rss_mb()
+    memory   = None if before is None else after - before
+    return { 'name':name, 'load':loaded - started, 'lookup':finished - loaded, 'memory':memory, 'total':total }
+
+
+if __name__ == '__main__':
+    if numpy is None:
+        print "Could not import numpy"
+        sys.exit(4)
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--blocks', type=int, default=710000, help="how many blocks to generate (default 710000, about California)")
+    parser.add_argument('--seed', type=int, default=2010, help="random seed for the synthetic data")
+    options = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='benchmarkjoin')
+    try:
+        path = os.path.join(workdir, 'decennial_attributes.csv')
+        print "Generating %d synthetic blocks in %s" % (options.blocks, path)
+        write_synthetic_csv(path, options.blocks, options.seed)
+        print ""
+
+        # a fresh process for each approach, and one at a time so they don't compete for the CPU
+        results = []
+        for name in ('dicts', 'columns'):
+            pool = multiprocessing.Pool(processes=1)
+            results.append( pool.apply(run_approach, [(name, path)]) )
+            pool.close()
+            pool.join()
+
+        if results[0]['total'] != results[1]['total']:
+            print "WARNING: the two approaches came up with different YOUTH totals: %d and %d" % (results[0]['total'], results[1]['total'])
+
+        print "%-8s  %8s  %8s  %8s  %10s" % ("approach", "load s", "lookup s", "total s", "memory MB")
+        for result in results:
+            memory = "n/a" if result['memory'] is None else "%.1f" % result['memory']
+            print "%-8s  %8.2f  %8.2f  %8.2f  %10s" % (result['name'], result['load'], result['lookup'], result['load'] + result['lookup'], memory)
+    finally:
+        shutil.rmtree(workdir)
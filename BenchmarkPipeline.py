@@ -0,0 +1,326 @@
+#!/bin/env python
+"""
+Benchmark the whole pipeline in GenerateStateMapperData.py on synthetic data, with no network: every stage and the run end to end
+
+Generates a state's worth of made-up data in the same shape as the real thing:
+a tabblock2010_XX_pophu.zip of block polygons with BLOCKID10 and the other TIGER fields,
+and Dexter-style decennial and ACS CSV extracts, each with its two header rows and the ACS incomes as "$1,234" strings with some left blank.
+Then runs the pipeline against it, with the Census and Dexter URLs answered from those files (including byte ranges, so the ranged download is exercised)
+and reports each stage's time from --metrics, plus the whole run's.
+
+Each run's figures are appended to a CSV along with the git commit, so runs before and after a change can be compared;
+the previous run at the same scale is shown alongside for that.
+
+Usage:
+    BenchmarkPipeline.py [--scale county|vermont|california] [--blocks N] [--counties N] [--datadir DIR] [--results FILE]
+    The default scale is about Vermont. --datadir keeps the generated data, and re-uses it as long as the scale and seed are the same,
+    since generating California-sized data takes a while.
+    --format, --serial and --stream-join are passed through to the pipeline.
+"""
+
+import os, sys, time, math, random, tempfile, shutil
+import csv, json, argparse, zipfile
+import urllib, urllib2, mimetools, StringIO
+
+from GenerateStateMapperData import STATE_FIPS_CODES, DECENNIAL_FIELD_NAMES, OUTPUT_FORMATS, OUTPUT_FORMAT, run_pipeline
+
+try:
+    from osgeo import ogr, osr
+except ImportError:
+    ogr = None
+
+
+# named scales: how many blocks, over how many counties
+SCALES = {
+    'county':(12000, 1),
+    'vermont':(32580, 14),
+    'california':(710145, 58),
+}
+
+# about how many blocks to a tract, and how many tracts the rest of the country adds to the national ACS extract
+BLOCKS_PER_TRACT = 50
+OTHER_STATE_TRACTS = 72000
+
+# how many vertices each synthetic block polygon has; real blocks vary a lot, this is around the middle
+BLOCK_VERTICES = 12
+
+# the stages in the order they're reported, as named in the pipeline's metrics
+STAGES = [ 'polygons', 'decennial', 'acs', 'merge', 'merge.acs', 'merge.decennial', 'merge.acs.join', 'merge.decennial.join', 'total' ]
+
+RESULT_FIELDS = [ 'commit', 'date', 'scale', 'blocks', 'counties', 'format', 'stage', 'wall', 'cpu', 'rowspersec', 'featurespersec', 'peakrssmb' ]
+
+
+def synthetic_geoids(statefips,blocks,counties):
+    # block GEOIDs: state, county (odd FIPS codes, as the real ones mostly are), tract, and block numbered from 1000 within the tract
+    # the blocks are split as evenly as they go between the counties, and into tracts of BLOCKS_PER_TRACT
+    geoids = []
+    for county in range(counties):
+        countyblocks = blocks / counties + (1 if county < blocks % counties else 0)
+        for index in range(countyblocks):
+            geoids.append( "%s%03d%04d00%04d" % (statefips, 1 + 2 * county, 100 + index / BLOCKS_PER_TRACT, 1000 + index % BLOCKS_PER_TRACT) )
+    return geoids
+
+
+def write_polygons(path,statefips,geoids,generator):
+    # the zipped shapefile the way TIGER has it: tabblock2010_XX_pophu.shp and friends with the TIGER/Line fields, in NAD83
+    # each block is a ring of BLOCK_VERTICES points inside its own cell of a grid, one grid per county
+    name    = os.path.splitext(os.path.basename(path))[0]
+    tempdir = tempfile.mkdtemp(prefix='benchmarkpolygons')
+    try:
+        driver = ogr.GetDriverByName('ESRI Shapefile')
+        output = driver.CreateDataSource(os.path.join(tempdir, name + '.shp'))
+        srs    = osr.SpatialReference()
+        srs.ImportFromEPSG(4269)
+        layer  = output.CreateLayer(name, srs, ogr.wkbPolygon)
+        for fieldname,fieldtype,width in [ ('STATEFP10',ogr.OFTString,2), ('COUNTYFP10',ogr.OFTString,3), ('TRACTCE10',ogr.OFTString,6), ('BLOCKCE',ogr.OFTString,4), ('BLOCKID10',ogr.OFTString,15), ('PARTFLG',ogr.OFTString,1), ('HOUSING10',ogr.OFTInteger,10), ('POP10',ogr.OFTInteger,10) ]:
+            field = ogr.FieldDefn(fieldname, fieldtype)
+            field.SetWidth(width)
+            layer.CreateField(field)
+        defn = layer.GetLayerDefn()
+
+        cell   = 0.002
+        across = 500
+        for index,geoid in enumerate(geoids):
+            county = int(geoid[2:5])
+            number = (int(geoid[5:11]) / 100 - 100) * BLOCKS_PER_TRACT + int(geoid[11:15]) - 1000
+            left   = -120.0 + (county % 10) * across * cell + (number % across) * cell
+            bottom = 35.0 + (county / 10) * across * cell + (number / across) * cell
+            ring   = ogr.Geometry(ogr.wkbLinearRing)
+            for vertex in range(BLOCK_VERTICES):
+                angle  = 6.283185307 * vertex / BLOCK_VERTICES
+                radius = cell * (0.35 + 0.1 * generator.random())
+                ring.AddPoint_2D( left + cell / 2 + radius * math.cos(angle), bottom + cell / 2 + radius * math.sin(angle) )
+            ring.CloseRings()
+            polygon = ogr.Geometry(ogr.wkbPolygon)
+            polygon.AddGeometry(ring)
+
+            feature = ogr.Feature(defn)
+            feature.SetGeometry(polygon)
+            feature.SetField('STATEFP10', geoid[0:2])
+            feature.SetField('COUNTYFP10', geoid[2:5])
+            feature.SetField('TRACTCE10', geoid[5:11])
+            feature.SetField('BLOCKCE', geoid[11:15])
+            feature.SetField('BLOCKID10', geoid)
+            feature.SetField('PARTFLG', 'N')
+            feature.SetField('HOUSING10', generator.randint(0,40))
+            feature.SetField('POP10', generator.randint(0,100))
+            layer.CreateFeature(feature)
+        output.Destroy()
+
+        archive = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+        for filename in sorted(os.listdir(tempdir)):
+            archive.write(os.path.join(tempdir, filename), filename)
+        archive.close()
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def write_decennial(path,geoids,generator):
+    # a Dexter extract: a row of variable names, a row of labels, then the block's esriid (GEOID) and its counts
+    csvwrite  = open(path, 'wb')
+    csvoutput = csv.writer(csvwrite)
+    csvoutput.writerow(DECENNIAL_FIELD_NAMES)
+    csvoutput.writerow([ "Label for %s" % name for name in DECENNIAL_FIELD_NAMES ])
+    for geoid in geoids:
+        csvoutput.writerow([geoid] + [ generator.randint(0,50) for name in DECENNIAL_FIELD_NAMES[1:] ])
+    csvwrite.close()
+
+
+def write_acs(path,statefips,geoids,generator):
+    # the national ACS tracts extract: the state's tracts and the rest of the country's, with incomes as Dexter gives them, "$52,345",
+    # and about one in fifty left blank the way tracts with no households are
+    tracts = sorted(set([ geoid[:11] for geoid in geoids ]))
+    others = [ "%02d%03d%06d" % (99, 1 + 2 * (index / 1000), index % 1000) for index in range(OTHER_STATE_TRACTS) ]
+    csvwrite  = open(path, 'wb')
+    csvoutput = csv.writer(csvwrite)
+    csvoutput.writerow(['esriid','MedianHHInc'])
+    csvoutput.writerow(['Esri ID','Median Household Income'])
+    for tract in sorted(tracts + others):
+        income = "" if generator.random() < 0.02 else "${:,}".format(generator.randint(9000,250000))
+        csvoutput.writerow([tract, income])
+    csvwrite.close()
+
+
+def generate(datadir,statefips,blocks,counties,seed):
+    # generate the three files into datadir, unless they're there already from the same scale and seed
+    settings = { 'statefips':statefips, 'blocks':blocks, 'counties':counties, 'seed':seed, 'fields':DECENNIAL_FIELD_NAMES }
+    filename = os.path.join(datadir, 'synthetic.json')
+    files    = {
+        'polygons':os.path.join(datadir, 'tabblock2010_%s_pophu.zip' % statefips),
+        'decennial':os.path.join(datadir, 'decennial_xtract.csv'),
+        'acs':os.path.join(datadir, 'acs_xtract.csv'),
+    }
+    try:
+        if json.load(open(filename)) == settings and all([ os.path.exists(path) for path in files.values() ]):
+            print "Re-using synthetic data in %s" % datadir
+            return files
+    except (IOError, ValueError):
+        pass
+
+    print "Generating %d synthetic blocks in %d counties into %s" % (blocks, counties, datadir)
+    generator = random.Random(seed)
+    geoids    = synthetic_geoids(statefips, blocks, counties)
+    write_polygons(files['polygons'], statefips, geoids, generator)
+    write_decennial(files['decennial'], geoids, generator)
+    write_acs(files['acs'], statefips, geoids, generator)
+    json.dump(settings, open(filename, 'w'))
+    return files
+
+
+class SyntheticCensusHandler(urllib2.BaseHandler):
+    # answers the pipeline's requests from the synthetic files instead of the network, so the benchmark runs offline:
+    # the TIGER zip, with Range requests answered with a 206 like the Census web site does; Dexter's broker page, pointing at an xtract.csv;
+    # and the xtract.csv itself, decennial or ACS depending on the dataset asked for
+    # anything else is an error rather than going out to the real network
+    handler_order = 100
+
+    def __init__(self,files):
+        self.files = files
+
+    def http_open(self,request):
+        url = request.get_full_url()
+        if '/cgi-bin/broker' in url:
+            dataset = 'acs' if 'sasdset=ustracts5yr' in url else 'decennial'
+            return self.respond(url, 200, '<a href="/tmpscratch/benchmark.%s/xtract.csv">xtract.csv</a>' % dataset, {})
+        if '/tmpscratch/benchmark.' in url:
+            dataset = url.split('/tmpscratch/benchmark.')[1].split('/')[0]
+            return self.respond_file(url, self.files[dataset], None)
+        if url.endswith('_pophu.zip'):
+            return self.respond_file(url, self.files['polygons'], request.get_header('Range'))
+        raise urllib2.URLError("The benchmark is offline, and has nothing for %s" % url)
+
+    https_open = http_open
+
+    def respond_file(self,url,path,ranged):
+        size = os.path.getsize(path)
+        if not ranged:
+            return self.respond(url, 200, open(path, 'rb'), { 'Content-Length':size })
+        start, end = [ int(number) for number in ranged.split('=')[1].split('-') ]
+        end   = min(end, size - 1)
+        local = open(path, 'rb')
+        local.seek(start)
+        body  = local.read(end - start + 1)
+        local.close()
+        return self.respond(url, 206, body, { 'Content-Length':len(body), 'Content-Range':'bytes %d-%d/%d' % (start, end, size) })
+
+    def respond(self,url,code,body,headers):
+        if isinstance(body, str):
+            body = StringIO.StringIO(body)
+        headers  = mimetools.Message(StringIO.StringIO("".join([ "%s: %s\r\n" % (name, value) for name,value in headers.items() ]) + "\r\n"))
+        response = urllib.addinfourl(body, headers, url, code)
+        response.msg = 'OK'
+        return response
+
+
+def read_results(path):
+    # the results CSV so far, or nothing if there isn't one yet
+    if not os.path.exists(path):
+        return []
+    csvread = open(path, 'rb')
+    results = list(csv.DictReader(csvread))
+    csvread.close()
+    return results
+
+
+def append_results(path,results):
+    new       = not os.path.exists(path)
+    csvwrite  = open(path, 'ab')
+    csvoutput = csv.DictWriter(csvwrite, RESULT_FIELDS)
+    if new:
+        csvoutput.writerow(dict([ (field,field) for field in RESULT_FIELDS ]))
+    csvoutput.writerows(results)
+    csvwrite.close()
+
+
+def git_commit():
+    # the commit being benchmarked, marked + if there are uncommitted changes; blank if this isn't a git checkout
+    here   = os.path.dirname(os.path.abspath(__file__))
+    commit = os.popen('git -C "%s" rev-parse --short HEAD 2>%s' % (here, os.devnull)).read().strip()
+    if commit and os.popen('git -C "%s" status --porcelain --untracked-files=no 2>%s' % (here, os.devnull)).read().strip():
+        commit += '+'
+    return commit
+
+
+if __name__ == '__main__':
+    if ogr is None:
+        print "Could not import ogr"
+        sys.exit(4)
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', choices=sorted(SCALES.keys()), default='vermont', help="how big a state to make up (default vermont)")
+    parser.add_argument('--blocks', type=int, help="how many blocks, instead of the scale's")
+    parser.add_argument('--counties', type=int, help="how many counties, instead of the scale's")
+    parser.add_argument('--seed', type=int, default=2010, help="random seed for the synthetic data")
+    parser.add_argument('--state', default='CA', help="which state to pretend the data is (default CA); only the FIPS code in the GEOIDs changes")
+    parser.add_argument('--datadir', help="keep the synthetic data here and re-use it next time, instead of generating it afresh")
+    parser.add_argument('--results', default='benchmark_results.csv', help="CSV to append each run's figures to, and compare against (default benchmark_results.csv)")
+    parser.add_argument('--format', choices=sorted(OUTPUT_FORMATS.keys()), default=OUTPUT_FORMAT, help="output format for the pipeline (default %s)" % OUTPUT_FORMAT)
+    parser.add_argument('--serial', action='store_true', help="run the pipeline's stages one after another")
+    parser.add_argument('--stream-join', action='store_true', help="use the pipeline's streaming join")
+    options = parser.parse_args()
+
+    state    = options.state.upper()
+    if state not in STATE_FIPS_CODES:
+        parser.error("Unknown state code: %s" % state)
+    blocks   = options.blocks or SCALES[options.scale][0]
+    counties = options.counties or SCALES[options.scale][1]
+    if counties < 1 or blocks < counties:
+        parser.error("Need at least one county, and at least one block per county")
+    scale    = options.scale if not options.blocks and not options.counties else 'custom'
+
+    workdir = tempfile.mkdtemp(prefix='benchmarkpipeline')
+    try:
+        datadir = options.datadir or os.path.join(workdir, 'synthetic')
+        if not os.path.isdir(datadir):
+            os.makedirs(datadir)
+        files = generate(datadir, STATE_FIPS_CODES[state], blocks, counties, options.seed)
+        print ""
+
+        # run the pipeline with every request answered from the synthetic files, no cache so the downloads are really done,
+        # and --force so nothing is skipped; the stage figures come from its --metrics output
+        urllib2.install_opener( urllib2.build_opener(SyntheticCensusHandler(files)) )
+        rundir = os.path.join(workdir, 'run')
+        os.makedirs(rundir)
+        config = {
+            'state':state, 'statefips':STATE_FIPS_CODES[state], 'countyfips':None, 'workdir':rundir,
+            'format':options.format, 'serial':options.serial, 'streamjoin':options.stream_join,
+            'cachedir':None, 'force':True, 'metrics':'json',
+        }
+        started = time.time()
+        run_pipeline(config)
+        total   = time.time() - started
+        print ""
+
+        metrics = dict([ (record['stage'], record) for record in json.load(open(os.path.join(rundir, 'metrics.json'))) ])
+        metrics['total'] = { 'wall':round(total, 3), 'cpu':None, 'rowspersec':0, 'featurespersec':round(blocks / total, 1), 'peakrssmb':max([ record['peakrssmb'] for record in metrics.values() ]) }
+
+        # compare with the last run recorded at the same scale and format, then add this one
+        matching = [ result for result in read_results(options.results) if (result['scale'], result['blocks'], result['counties'], result['format']) == (scale, str(blocks), str(counties), options.format) ]
+        previous = {}
+        if matching:
+            latest   = max([ result['date'] for result in matching ])
+            previous = dict([ (result['stage'], result) for result in matching if result['date'] == latest ])
+
+        commit  = git_commit()
+        date    = time.strftime('%Y-%m-%dT%H:%M:%S')
+        results = []
+        print "%-22s  %8s  %8s  %12s  %8s  %8s" % ("stage", "wall s", "cpu s", "per sec", "peak MB", "was s")
+        for stage in STAGES:
+            if stage not in metrics:
+                continue
+            record = metrics[stage]
+            rate   = record['featurespersec'] or record['rowspersec']
+            was    = previous[stage]['wall'] if stage in previous else ""
+            cpu    = "" if record['cpu'] is None else "%.2f" % record['cpu']
+            peak   = "" if record['peakrssmb'] is None else "%.1f" % record['peakrssmb']
+            print "%-22s  %8.2f  %8s  %12.1f  %8s  %8s" % (stage, record['wall'], cpu, rate, peak, was)
+            results.append({
+                'commit':commit, 'date':date, 'scale':scale, 'blocks':blocks, 'counties':counties, 'format':options.format, 'stage':stage,
+                'wall':record['wall'], 'cpu':record['cpu'], 'rowspersec':record['rowspersec'], 'featurespersec':record['featurespersec'], 'peakrssmb':record['peakrssmb'],
+            })
+        append_results(options.results, results)
+        if previous:
+            print "(was: the last run at this scale, commit %s on %s)" % (previous.values()[0]['commit'] or "unknown", previous.values()[0]['date'])
+        print "Results added to %s" % options.results
+    finally:
+        shutil.rmtree(workdir)
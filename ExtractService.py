@@ -0,0 +1,319 @@
+#!/bin/env python
+"""
+A local HTTP service answering extract requests from warm statewide datasets, so asking for a county doesn't mean a whole run each time
+
+Each state's merged blocks are built once by GenerateStateMapperData's pipeline, as a GeoPackage with its R-tree and GEOID index,
+then kept ready, and requests are answered straight from them:
+    /extract/XX                     every block in the state
+    /extract/XX?counties=031,033    the blocks in some counties, through the GEOID index
+    /extract/XX?bbox=W,S,E,N        the blocks touching a bounding box in longitude and latitude, through the R-tree
+                                    (counties and bbox can go together; add &output=csv for just the attributes instead of GeoJSON)
+    /status                         each state: when its dataset was built, and whether a rebuild is underway or the last one failed
+    /rebuild/XX                     bring a state up to date now, in the background
+Requests are handled in threads, each opening the dataset for itself. Builds run in a separate process, one state at a time,
+with the usual progress going into XX/run.log under the root directory. At startup and then every --refresh-hours each state is brought
+up to date: the manifest re-runs only the stages which are stale, e.g. after the ACS or decennial vintage changes, and the polygons are
+checked against the Census web site. A dataset which changed is swapped in once it's finished; until then the old one keeps answering.
+
+Usage:
+    ExtractService.py --states CA,VT [--root datasets] [--port 8001] [--host 127.0.0.1] [--refresh-hours 24]
+    ExtractService.py --all
+"""
+
+import os, sys, time, json, glob, shutil
+import csv, argparse, urlparse, threading, multiprocessing
+import BaseHTTPServer, SocketServer
+
+from GenerateStateMapperData import STATE_FIPS_CODES, CACHE_DIRECTORY, TIGER_BASE_URL, DEXTER_BASE_URL, ogr, state_config, run_state
+
+# how often each state is brought up to date
+REFRESH_HOURS = 24
+
+
+class StateDatasets:
+    # the warm datasets: for each state, the GeoPackage being served, and the builds which keep it up to date
+    # a state is built in ROOT/XX as usual, then its censusblocks.gpkg is copied to ROOT/XX/serving_<hash>.gpkg which is what's served,
+    # so a rebuild rewriting censusblocks.gpkg never pulls the file out from under a request
+    # the hash is the one the manifest recorded for the merge's output, so a rebuild which changed nothing doesn't copy or swap anything
+    # requests check a dataset out and release it when they're done with it, and a dataset that's been swapped out is removed once the last of them has
+    def __init__(self,root,states,settings):
+        self.root     = root
+        self.states   = states
+        self.settings = dict(settings, format='gpkg', cacherevalidate=True)
+        self.lock     = threading.Lock()
+        self.serving  = {}
+        self.building = {}
+        self.failed   = {}
+        self.readers  = {}
+        self.retired  = set()
+        self.pool     = multiprocessing.Pool(processes=1)
+
+        # whatever was being served before a restart is served again straight away
+        for state in states:
+            served = sorted(glob.glob(os.path.join(root, state, 'serving_*.gpkg')), key=os.path.getmtime)
+            if served:
+                self.serving[state] = { 'path':served[-1], 'built':os.path.getmtime(served[-1]) }
+                for stale in served[:-1]:
+                    os.unlink(stale)
+
+    def path(self,state):
+        # the dataset to answer a request from, or None if the state's first build hasn't finished
+        with self.lock:
+            entry = self.serving.get(state)
+            return entry['path'] if entry else None
+
+    def checkout(self,state):
+        # the dataset to answer a request from, as path() gives it, kept on disk until it's handed back to release()
+        with self.lock:
+            entry = self.serving.get(state)
+            if not entry:
+                return None
+            self.readers[entry['path']] = self.readers.get(entry['path'], 0) + 1
+            return entry['path']
+
+    def release(self,path):
+        # a request is done with a dataset; if it's been swapped out and this was the last request reading it, it goes
+        with self.lock:
+            self.readers[path] -= 1
+            if self.readers[path]:
+                return
+            del self.readers[path]
+            if path not in self.retired:
+                return
+            self.retired.discard(path)
+        self.remove(path)
+
+    def remove(self,path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def rebuild(self,state):
+        # start bringing a state up to date in the build process, unless it already is being; returns whether it was started
+        with self.lock:
+            if state in self.building:
+                return False
+            self.building[state] = time.time()
+        config = state_config(state, None, os.path.join(self.root, state), **self.settings)
+        self.pool.apply_async(run_state, [config], callback=self.built)
+        return True
+
+    def built(self,summary):
+        # in the pool's result thread, when a build is done: swap the new dataset in if it worked and something changed
+        # nothing may escape from here, since it would end the pool's result thread, and no build after it would ever be seen to finish;
+        # so failing to swap the dataset in, e.g. a full disk, is a failed rebuild like any other
+        state = summary['state']
+        try:
+            error = summary['error']
+            if summary['ok']:
+                try:
+                    self.swap(state, summary['workdir'], summary['output'])
+                except Exception, e:
+                    error = "%s: %s" % (e.__class__.__name__, e)
+            with self.lock:
+                if error:
+                    self.failed[state] = error
+                else:
+                    self.failed.pop(state, None)
+            if error:
+                print "%s: rebuild FAILED, still serving the previous dataset: %s" % (state, error)
+        finally:
+            with self.lock:
+                self.building.pop(state, None)
+
+    def swap(self,state,workdir,output):
+        manifest = json.load(open(os.path.join(workdir, 'manifest.json'), 'r'))
+        digest   = manifest['stages']['merge']['outputs'][output]
+        served   = os.path.join(workdir, 'serving_%s.gpkg' % digest[:16])
+        if self.path(state) == served:
+            return
+
+        # copied under a temporary name and renamed, so a request can't find a half-copied file
+        shutil.copyfile(output, served + '.tmp')
+        os.rename(served + '.tmp', served)
+        # the old file is removed now if no request is reading it, otherwise by release() when the last one is done
+        with self.lock:
+            previous = self.serving.get(state)
+            self.serving[state] = { 'path':served, 'built':time.time() }
+            if previous and previous['path'] in self.readers:
+                self.retired.add(previous['path'])
+                previous = None
+        print "%s: now serving %s" % (state, os.path.basename(served))
+        if previous:
+            self.remove(previous['path'])
+
+    def status(self):
+        with self.lock:
+            return dict([ (state, {
+                'dataset':os.path.basename(self.serving[state]['path']) if state in self.serving else None,
+                'built':time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.serving[state]['built'])) if state in self.serving else None,
+                'rebuilding':state in self.building,
+                'error':self.failed.get(state),
+            }) for state in self.states ])
+
+    def refresh(self,hours):
+        # in a background thread: bring every state up to date now, then every so many hours
+        while True:
+            for state in self.states:
+                self.rebuild(state)
+            time.sleep(hours * 3600)
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+class ExtractRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # the datasets are kept on the server, see ExtractServer
+    def do_GET(self):
+        url   = urlparse.urlsplit(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        parts = [ part for part in url.path.split('/') if part ]
+        if parts == [ 'status' ]:
+            return self.send_json(200, self.server.datasets.status())
+        if len(parts) == 2 and parts[0] == 'rebuild':
+            state = parts[1].upper()
+            if state not in self.server.datasets.states:
+                return self.send_error(404, "%s isn't one of the states being served" % state)
+            return self.send_json(202, { 'state':state, 'started':self.server.datasets.rebuild(state) })
+        if len(parts) == 2 and parts[0] == 'extract':
+            return self.extract(parts[1].upper(), query)
+        self.send_error(404, "Try /extract/XX, /status or /rebuild/XX")
+
+    def extract(self,state,query):
+        datasets = self.server.datasets
+        if state not in datasets.states:
+            return self.send_error(404, "%s isn't one of the states being served" % state)
+        path = datasets.checkout(state)
+        if path is None:
+            return self.send_error(503, "%s is still being built; see /status" % state)
+        try:
+            self.extract_from(path, state, query)
+        finally:
+            datasets.release(path)
+
+    def extract_from(self,path,state,query):
+        # check the request before sending anything, so a bad one gets a 400 rather than half a response
+        counties = [ county.strip() for county in query.get('counties', '').split(',') if county.strip() ]
+        for county in counties:
+            if len(county) != 3 or not county.isdigit():
+                return self.send_error(400, "Bad county FIPS code %s; County FIPS are always 3 digits." % county)
+        bbox = None
+        if query.get('bbox'):
+            try:
+                bbox = [ float(value) for value in query['bbox'].split(',') ]
+            except ValueError:
+                bbox = []
+            if len(bbox) != 4:
+                return self.send_error(400, "bbox should be W,S,E,N")
+        output = query.get('output', 'geojson')
+        if output not in ('geojson', 'csv'):
+            return self.send_error(400, "output should be geojson or csv")
+
+        # the dataset is closed however the request ends, e.g. the client hanging up partway, so it can be released and removed once it's been swapped out
+        datasource = ogr.Open(path, 0)
+        try:
+            # the counties are GEOID ranges, so the GEOID index finds them: ~ sorts after every digit
+            layer = datasource.GetLayer(0)
+            if counties:
+                prefixes = [ STATE_FIPS_CODES[state] + county for county in counties ]
+                layer.SetAttributeFilter(" OR ".join([ "(GEOID >= '%s' AND GEOID < '%s~')" % (prefix, prefix) for prefix in prefixes ]))
+            if bbox:
+                layer.SetSpatialFilterRect(*bbox)
+
+            # streamed out as it's read, with no Content-Length: the connection closing marks the end
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/geo+json' if output == 'geojson' else 'text/csv')
+            self.end_headers()
+            if output == 'geojson':
+                self.write_geojson(layer)
+            else:
+                self.write_csv(layer)
+        finally:
+            datasource.Destroy()
+
+    def write_geojson(self,layer):
+        self.wfile.write('{"type":"FeatureCollection","features":[\n')
+        separator = ''
+        feature   = layer.GetNextFeature()
+        while feature:
+            self.wfile.write(separator + feature.ExportToJson())
+            separator = ',\n'
+            feature   = layer.GetNextFeature()
+        self.wfile.write('\n]}\n')
+
+    def write_csv(self,layer):
+        defn   = layer.GetLayerDefn()
+        names  = [ defn.GetFieldDefn(index).GetName() for index in range(defn.GetFieldCount()) ]
+        output = csv.writer(self.wfile)
+        output.writerow(names)
+        feature = layer.GetNextFeature()
+        while feature:
+            output.writerow([ feature.GetField(name) for name in names ])
+            feature = layer.GetNextFeature()
+
+    def send_json(self,code,data):
+        content = json.dumps(data, indent=2, sort_keys=True)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class ExtractServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    # one thread per request, so a big extract doesn't hold up the small ones behind it
+    daemon_threads = True
+
+    def __init__(self,address,datasets):
+        BaseHTTPServer.HTTPServer.__init__(self, address, ExtractRequestHandler)
+        self.datasets = datasets
+
+
+if __name__ == '__main__':
+    if ogr is None:
+        print "Could not import ogr"
+        print "You must have Python-OGR installed, e.g. be using Python from OSG4Win"
+        sys.exit(4)
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--states', help="comma-separated list of two-letter state codes to serve, e.g. CA,TX,VT")
+    parser.add_argument('--all', action='store_true', help="serve every state")
+    parser.add_argument('--root', default='datasets', help="directory to build and keep the datasets in, a subdirectory XX for each state (default datasets)")
+    parser.add_argument('--port', type=int, default=8001, help="port to listen on (default 8001)")
+    parser.add_argument('--host', default='127.0.0.1', help="address to listen on (default 127.0.0.1, this machine only)")
+    parser.add_argument('--refresh-hours', type=float, default=REFRESH_HOURS, help="how often to bring each state up to date (default %d)" % REFRESH_HOURS)
+    parser.add_argument('--cache', default=CACHE_DIRECTORY, help="directory to keep downloads in (default %s)" % CACHE_DIRECTORY)
+    parser.add_argument('--tiger-url', default=TIGER_BASE_URL, help="base URL for the TIGER block polygons (default %s)" % TIGER_BASE_URL)
+    parser.add_argument('--dexter-url', default=DEXTER_BASE_URL, help="base URL for MCDC Dexter, for the attribute extracts (default %s)" % DEXTER_BASE_URL)
+    options = parser.parse_args()
+
+    if options.all:
+        states = sorted(STATE_FIPS_CODES.keys())
+    elif options.states:
+        states = [ state.strip().upper() for state in options.states.split(',') if state.strip() ]
+    else:
+        parser.error("Give --states or --all")
+    for state in states:
+        if state not in STATE_FIPS_CODES:
+            parser.error("Unknown state code: %s" % state)
+    if ogr.GetDriverByName('GPKG') is None:
+        parser.error("This GDAL doesn't have the GPKG driver, which the datasets are kept in")
+
+    ogr.UseExceptions()
+    settings = { 'cachedir':options.cache, 'tigerurl':options.tiger_url.rstrip('/'), 'dexterurl':options.dexter_url.rstrip('/') }
+    datasets = StateDatasets(os.path.abspath(options.root), states, settings)
+    refresher = threading.Thread(target=datasets.refresh, args=[options.refresh_hours])
+    refresher.daemon = True
+    refresher.start()
+
+    server = ExtractServer((options.host, options.port), datasets)
+    print "Serving extracts of %s at http://%s:%d/ from %s" % (", ".join(states), options.host, options.port, options.root)
+    print "    e.g. http://%s:%d/extract/%s?counties=001" % (options.host, options.port, states[0])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print ""
+    finally:
+        datasets.close()
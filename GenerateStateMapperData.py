@@ -1,642 +1,3357 @@
-#!/bin/env python
-"""
-Command-line application to fetch census blocks, decennial census tables (block), and ACS income (tract) data
-then merge them into a single Mapper-ready shapefile for the whole state. (or, prune it to an area of interest for a more localized mapper)
-
-Usage:
-    Basic, grab a whole state:
-        GenerateStateMapperData.py XX
-        Where XX is the two-letter postal code for the state, e.g. CA or VT.
-    County, filter the state dataset to a single county, via FIPS code:
-        GenerateStateMapperData.py XX NNN
-        Where XX is the two-letter postal code for the state, e.g. CA or VT.
-        And NNN is a three-digit county FIPS code, e.g. 031
-"""
-
-# state FIPS codes
-# so the user can give a two-letter code (CA, UT) and we look up the FIPS for them
-# the FIPS is used for most filenames on remote (government) services, though we often want to use a human-friendly name for target filenames and output
-STATE_FIPS_CODES = {
-    "AL" : "01",
-    "AK" : "02",
-    "AZ" : "04",
-    "AR" : "05",
-    "CA" : "06",
-    "CO" : "08",
-    "CT" : "09",
-    "DE" : "10",
-    "DC" : "11",
-    "FL" : "12",
-    "GA" : "13",
-    "HI" : "15",
-    "ID" : "16",
-    "IL" : "17",
-    "IN" : "18",
-    "IA" : "19",
-    "KS" : "20",
-    "KY" : "21",
-    "LA" : "22",
-    "ME" : "23",
-    "MD" : "24",
-    "MA" : "25",
-    "MI" : "26",
-    "MN" : "27",
-    "MS" : "28",
-    "MO" : "29",
-    "MT" : "30",
-    "NE" : "31",
-    "NV" : "32",
-    "NH" : "33",
-    "NJ" : "34",
-    "NM" : "35",
-    "NY" : "36",
-    "NC" : "37",
-    "ND" : "38",
-    "OH" : "39",
-    "OK" : "40",
-    "OR" : "41",
-    "PA" : "42",
-    "RI" : "44",
-    "SC" : "45",
-    "SD" : "46",
-    "TN" : "47",
-    "TX" : "48",
-    "UT" : "49",
-    "VT" : "50",
-    "VA" : "51",
-    "WA" : "53",
-    "WV" : "54",
-    "WI" : "55",
-    "WY" : "56",
-}
-
-# what years do we go for? decennial is of course every 10 years, while ACS is approximately annual
-ACS_YEAR       = "2013"
-DECENNIAL_YEAR = "2010"
-
-# from the MCDC Dexter, the list of census variables
-# and a corresponding list of how to relabel those variables
-DECENNIAL_FIELD_NAMES  = [
-    'esriid',
-    'P4i3','P6i1','P6i2','P6i3','P6i4','P6i5','P6i6',
-    'P12i3','P12i4','P12i5','P12i6','P12i27','P12i28','P12i29','P12i30',
-]
-DECENNIAL_FIELD_LABELS = [
-    'GEOID',
-    'Hispanic','TotPop','White','Black','Amerind','Asian','Hawpi',
-    'agem1','agem2','agem3','agem4','agef1','agef2','agef3','agef4'
-]
-
-####################################################################################################################################################
-####################################################################################################################################################
-
-import os, sys, time, re
-import urllib, urllib2, zipfile
-import csv
-
-class PolygonDownloader:
-    def __init__(self,config):
-        self.config = config
-        self.url    = "ftp://ftp2.census.gov/geo/tiger/TIGER%sBLKPOPHU/tabblock%s_%s_pophu.zip" % (DECENNIAL_YEAR,DECENNIAL_YEAR,self.config['statefips'])
-        self.target = os.path.basename(self.url)
-    def main(self):
-        self.download()
-        self.unpack()
-        self.strip()
-        pass
-    def download(self):
-        remote = urllib2.urlopen(self.url)
-        local  = open(self.target, 'wb')
-        size   = int( remote.info().getheaders("Content-Length")[0] )
-        print "    %s" % (self.url)
-        print "    %s" % (self.target)
-
-        downloaded = 0
-        while True:
-            block = remote.read(1048576)
-            if not block:
-                break
-            downloaded += len(block)
-            local.write(block)
-            print "    %d MB of %d MB" % (downloaded/1048576 , size/1048576)
-        local.close()
-        remote.close()
-    def unpack(self):
-        # unpack the four amigos
-        print "    Unpacking shapefile from %s" % self.target
-        local = open(self.target, 'rb')
-        zip   = zipfile.ZipFile(local)
-        for name in zip.namelist():
-            if os.path.splitext(name)[1] != '.shp' and os.path.splitext(name)[1] != '.shx' and os.path.splitext(name)[1] != '.dbf' and os.path.splitext(name)[1] != '.prj':
-                continue
-            zip.extract(name)
-        local.close()
-
-        # rename the 4 files to a given set of names: censusblocks.shp et al
-        # Windows can't do an atomic overwrite, so we have to unlink the target files first in case they exist
-        shp1 = os.path.basename( os.path.splitext(self.target)[0] ) + '.shp';
-        shx1 = os.path.basename( os.path.splitext(self.target)[0] ) + '.shx';
-        dbf1 = os.path.basename( os.path.splitext(self.target)[0] ) + '.dbf';
-        prj1 = os.path.basename( os.path.splitext(self.target)[0] ) + '.prj';
-
-        try:
-            os.unlink("censusblocks_raw.shp")
-        except OSError:
-            pass
-        try:
-            os.unlink("censusblocks_raw.shx")
-        except OSError:
-            pass
-        try:
-            os.unlink("censusblocks_raw.dbf")
-        except OSError:
-            pass
-        try:
-            os.unlink("censusblocks_raw.prj")
-        except OSError:
-            pass
-
-        os.rename(shp1,"censusblocks_raw.shp")
-        os.rename(shx1,"censusblocks_raw.shx")
-        os.rename(dbf1,"censusblocks_raw.dbf")
-        os.rename(prj1,"censusblocks_raw.prj")
-
-        os.unlink(self.target)
-        print "    Ready: censusblocks.shp"
-    def strip(self):
-        try:
-            os.unlink("censusblocks.shp")
-        except OSError:
-            pass
-        try:
-            os.unlink("censusblocks.shx")
-        except OSError:
-            pass
-        try:
-            os.unlink("censusblocks.dbf")
-        except OSError:
-            pass
-        try:
-            os.unlink("censusblocks.prj")
-        except OSError:
-            pass
-
-        print "    Stripping extraneous fields from polygons"
-        command = 'ogr2ogr -sql "SELECT BLOCKID10 AS GEOID FROM censusblocks_raw" censusblocks.shp censusblocks_raw.shp'
-        os.system(command)
-
-        try:
-            os.unlink("censusblocks_raw.shp")
-        except OSError:
-            pass
-        try:
-            os.unlink("censusblocks_raw.shx")
-        except OSError:
-            pass
-        try:
-            os.unlink("censusblocks_raw.dbf")
-        except OSError:
-            pass
-        try:
-            os.unlink("censusblocks_raw.prj")
-        except OSError:
-            pass
-
-
-class DecennialDownloader:
-    def __init__(self,config):
-
-        dataset   = "%sblocks" % ( config['state'].lower() )
-        params    = {
-            "sasdset" : dataset,
-            "_PROGRAM" : "websas.dexter.sas",
-            "_SERVICE" : "bigtime",
-            "path" : "/pub/data/sf1%s" % DECENNIAL_YEAR,
-            "view" : "0",
-            "ranksteropt" : "no",
-            "quicklook" : "0",
-            "dlm" : "csv",
-            "lst" : "none",
-            "dbfile" : "none",
-            "fkey1" : "",
-            "op1" : "",
-            "value1" : "",
-            "logic1" : "and",
-            "fkey2" : "",
-            "op2" : "",
-            "value2" : "",
-            "logic2" : "and",
-            "fkey3" : "",
-            "op3" : "",
-            "value3" : "",
-            "logic3" : "and",
-            "fkey4" : "",
-            "op4" : "",
-            "value4" : "",
-            "logic4" : "and",
-            "fkey5" : "",
-            "op5" : "",
-            "value5" : "",
-            "maxobs" : "",
-            "_subtype" : "ph",
-            "varlist" : ",".join(DECENNIAL_FIELD_NAMES),
-            "title2" : "",
-            "subtitle" : " ",
-            "footnote" : " ",
-            "sortby" : "",
-            "_aggby" : "",
-            "_agglvl" : "1",
-            "_grand" : "NO",
-            "_means" : "",
-            "_mweights" : "",
-            "_dropvars" : "_lvl_  _nag_",
-            "rept_byvars" : "",
-            "rept_idvars" : "",
-            "orient" : "portrait",
-            "odsstyle" : "sasweb",
-            "fmtstmt" : "",
-            "renamestmt" : "",
-            "labelstmt" : "",
-            "transby" : "",
-            "transprefix" : "",
-            "transname" : "",
-            "transidlabel" : "",
-            "hasxys" : "1",
-            "haslookupvars" : "1",
-            "hasgeoid" : "0",
-            "latvar" : "IntPtLat",
-            "lonvar" : "IntPtLon",
-            "_y0lat" : "",
-            "_x0long" : "",
-            "_debug" : "",
-            "query" : "",
-        }
-        self.url = "http://mcdc.missouri.edu/cgi-bin/broker?%s" % urllib.urlencode(params)
-    def main(self):
-        self.download()
-        self.massage()
-    def download(self):
-        # open the URL we figured out earlier; hooray for Dexter allowing both GET and POST !
-        print "    Requesting decennial data from Dexter"
-        print "    %s" % self.url
-        content = urllib2.urlopen(self.url)
-        content = content.read()
-        url     = "http://mcdc.missouri.edu/" + re.search(r'(/tmpscratch/[\w\.]+/xtract.csv)',content).groups()[0]
-        print "    Ready: %s" % url
-        urllib.urlretrieve(url, "decennial_attributes_raw.csv")
-        print "    Downloaded decennial_attributes_raw.csv"
-    def massage(self):
-        # trim the first 2 rows, replace them with one with good field names
-        # then just pass the other rows through as is
-        print "    Fixing data in decennial_attributes_raw.csv"
-        csvread  = open('decennial_attributes_raw.csv', 'rb')
-        csvwrite = open('decennial_attributes.csv', 'wb')
-
-        csvoutput = csv.writer(csvwrite)
-        csvinput  = csv.reader(csvread)
-
-        csvoutput.writerow(DECENNIAL_FIELD_LABELS)
-
-        csvinput.next()
-        csvinput.next()
-        for row in csvinput:
-            csvoutput.writerow(row)
-
-        csvread.close()
-        csvwrite.close()
-        print "    Done: decennial_attributes.csv"
-        os.unlink('decennial_attributes_raw.csv')
-
-
-class ACSDownloader:
-    def __init__(self,config):
-        params = {
-            "sasdset" : "ustracts5yr",
-            "_PROGRAM" : "websas.dexter.sas",
-            "_SERVICE" : "bigtime",
-            "path" : "/pub/data/acs%s" % ACS_YEAR,
-            "view" : "0",
-            "ranksteropt" : "no",
-            "quicklook" : "0",
-            "dlm" : "csv",
-            "lst" : "none",
-            "dbfile" : "none",
-            "fkey1" : "",
-            "op1" : "",
-            "value1" : "",
-            "logic1" : "and",
-            "fkey2" : "",
-            "op2" : "",
-            "value2" : "",
-            "logic2" : "and",
-            "fkey3" : "",
-            "op3" : "",
-            "value3" : "",
-            "logic3" : "and",
-            "fkey4" : "",
-            "op4" : "",
-            "value4" : "",
-            "logic4" : "and",
-            "fkey5" : "",
-            "op5" : "",
-            "value5" : "",
-            "maxobs" : "",
-            "idv" : "esriid",
-            "_subtype" : " ",
-            "v" : "AvgHHInc",
-            "vregexp" : "",
-            "varlist" : "esriid,MedianHHInc",
-            "title2" : "",
-            "subtitle" : " ",
-            "footnote" : " ",
-            "sortby" : "",
-            "_aggby" : "",
-            "_agglvl" : "1",
-            "_grand" : "NO",
-            "_means" : "",
-            "_mweights" : "",
-            "_dropvars" : "_lvl_  _nag_",
-            "rept_byvars" : "",
-            "rept_idvars" : "",
-            "orient" : "portrait",
-            "odsstyle" : "sasweb",
-            "fmtstmt" : "",
-            "renamestmt" : "",
-            "labelstmt" : "",
-            "transby" : "",
-            "transprefix" : "",
-            "transname" : "",
-            "transidlabel" : "",
-            "hasxys" : "1",
-            "haslookupvars" : "1",
-            "hasgeoid" : "1",
-            "latvar" : "IntPtLat",
-            "lonvar" : "IntPtLon",
-            "_y0lat" : "",
-            "_x0long" : "",
-            "_debug" : "",
-            "query" : "",
-        }
-        self.url = "http://mcdc.missouri.edu/cgi-bin/broker?%s" % urllib.urlencode(params)
-    def main(self):
-        self.download()
-        self.massage()
-    def download(self):
-        # open the URL we figured out earlier; hooray for Dexter allowing both GET and POST !
-        print "    Requesting ACS data from Dexter"
-        content = urllib2.urlopen(self.url)
-        content = content.read()
-        url     = "http://mcdc.missouri.edu/" + re.search(r'(/tmpscratch/[\w\.]+/xtract.csv)',content).groups()[0]
-        print "    Ready: %s" % url
-        urllib.urlretrieve(url, "acs_attributes_raw.csv")
-        print "    Downloaded acs_attributes_raw.csv"
-    def massage(self):
-        # trim the first 2 rows, replace them with one with good field names
-        # then fix the rows: dollar values have $ and commas, and nulls are empty cells which botch the math
-        print "    Fixing data in acs_attributes_raw.csv"
-        csvread  = open('acs_attributes_raw.csv', 'rb')
-        csvwrite = open('acs_attributes.csv', 'wb')
-
-        csvoutput = csv.writer(csvwrite)
-        csvinput  = csv.reader(csvread)
-
-        csvoutput.writerow(['TRACTID','MHHINC'])
-
-        csvinput.next()
-        csvinput.next()
-        for geoid,dollars in csvinput:
-            if dollars:
-                dollars = int( dollars.replace('$','').replace(',','') )
-            else:
-                dollars = 0
-            csvoutput.writerow([geoid,dollars])
-
-        csvread.close()
-        csvwrite.close()
-        print "    Done: acs_attributes.csv"
-        os.unlink('acs_attributes_raw.csv')
-
-
-class ACSMerger():
-    def __init__(self,config):
-        # load the ACS CSV file into a giant assoc keyed by tract ID
-        print "    Loading acs_attributes.csv into memory"
-        self.tract_attributes = {}
-        csvread  = open('acs_attributes.csv', 'rb')
-        csvinput = csv.reader(csvread)
-        csvinput.next() # skip the first line
-        for tractid,mhhinc in csvinput:
-            self.tract_attributes[tractid] = { 'MHHINC':int(mhhinc) }
-        csvread.close()
-
-    def main(self):
-        print "    Assigning ACS fields to records in censustracts.shp"
-
-        # 1 - open the shapefile and add attributes to it (unless it exists already)
-        source = ogr.Open('censusblocks.shp', 1)
-        layer  = source.GetLayer()
-        defn   = layer.GetLayerDefn()
-
-        if defn.GetFieldIndex('MHHINC') == -1:
-            layer.CreateField( ogr.FieldDefn('MHHINC', ogr.OFTInteger) )
-
-        # 2 - then iterate over all records in it, and populate them from the ACS data we cached during init
-        # the tract-ID is the first 11 characters of the GEOID, we can key from that
-        feature = layer.GetNextFeature()
-        while feature:
-            tractid    = feature.GetField("GEOID")[:11]
-            attributes = self.tract_attributes[tractid]
-            feature.SetField("MHHINC", attributes['MHHINC'] )
-            layer.SetFeature(feature)
-            feature = layer.GetNextFeature()
-
-        # 999 - done
-        source.Destroy()
-
-
-class DecennialMerger():
-    def __init__(self,config):
-        # load the ACS CSV file into a giant assoc keyed by tract ID
-        print "    Loading decennial_attributes.csv into memory"
-        self.block_attributes = {}
-        csvread  = open('decennial_attributes.csv', 'rb')
-        csvinput = csv.reader(csvread)
-        csvinput.next() # skip the first line
-        for geoid,hispanic,totalpop,white,black,amerind,asian,hawpi,age1,age2,age3,age4,age5,age6,age7,age8 in csvinput:
-            self.block_attributes[geoid] = {
-                'HISP':int(hispanic),
-                'TOTPOP':int(totalpop),
-                'WHITE':int(white),
-                'BLACK':int(black),
-                'AMERIND':int(amerind),
-                'ASIAN':int(asian),
-                'HAWPI':int(hawpi),
-                'YOUTH':int(age1) + int(age2) + int(age3) + int(age4) + int(age5) + int(age6) + int(age7) + int(age8),
-            }
-        csvread.close()
-
-    def main(self):
-        print "    Assigning ACS fields to records in censustracts.shp"
-
-        # 1 - open the shapefile and add attributes to it (unless it exists already)
-        source = ogr.Open('censusblocks.shp', 1)
-        layer  = source.GetLayer()
-        defn   = layer.GetLayerDefn()
-
-        if defn.GetFieldIndex('HISP') == -1:
-            layer.CreateField( ogr.FieldDefn('HISP', ogr.OFTInteger) )
-        if defn.GetFieldIndex('TOTPOP') == -1:
-            layer.CreateField( ogr.FieldDefn('TOTPOP', ogr.OFTInteger) )
-        if defn.GetFieldIndex('WHITE') == -1:
-            layer.CreateField( ogr.FieldDefn('WHITE', ogr.OFTInteger) )
-        if defn.GetFieldIndex('BLACK') == -1:
-            layer.CreateField( ogr.FieldDefn('BLACK', ogr.OFTInteger) )
-        if defn.GetFieldIndex('AMERIND') == -1:
-            layer.CreateField( ogr.FieldDefn('AMERIND', ogr.OFTInteger) )
-        if defn.GetFieldIndex('ASIAN') == -1:
-            layer.CreateField( ogr.FieldDefn('ASIAN', ogr.OFTInteger) )
-        if defn.GetFieldIndex('HAWPI') == -1:
-            layer.CreateField( ogr.FieldDefn('HAWPI', ogr.OFTInteger) )
-        if defn.GetFieldIndex('YOUTH') == -1:
-            layer.CreateField( ogr.FieldDefn('YOUTH', ogr.OFTInteger) )
-
-        # 2 - then iterate over all records in it, and populate them from the ACS data we cached during init
-        feature = layer.GetNextFeature()
-        while feature:
-            geoid    = feature.GetField("GEOID")
-            attributes = self.block_attributes[geoid]
-            feature.SetField("HISP",    attributes['HISP'] )
-            feature.SetField("TOTPOP",  attributes['TOTPOP'] )
-            feature.SetField("WHITE",   attributes['WHITE'] )
-            feature.SetField("BLACK",   attributes['BLACK'] )
-            feature.SetField("AMERIND", attributes['AMERIND'] )
-            feature.SetField("ASIAN",   attributes['ASIAN'] )
-            feature.SetField("HAWPI",   attributes['HAWPI'] )
-            feature.SetField("YOUTH",   attributes['YOUTH'] )
-            layer.SetFeature(feature)
-            feature = layer.GetNextFeature()
-
-        # 999 - done
-        source.Destroy()
-
-
-class CountyTrimmer:
-    def __init__(self,config):
-        self.statefips  = config['statefips']
-        self.countyfips = config['countyfips']
-    def main(self):
-        # unlink the target "trimmed" shapefile, since ogr2ogr will pitch a fit if it already exists
-        try:
-            os.unlink("censusblocks_trimmed.shp")
-        except OSError:
-            pass
-        try:
-            os.unlink("censusblocks_trimmed.shx")
-        except OSError:
-            pass
-        try:
-            os.unlink("censusblocks_trimmed.dbf")
-        except OSError:
-            pass
-        try:
-            os.unlink("censusblocks_trimmed.prj")
-        except OSError:
-            pass
-
-        command = 'ogr2ogr -sql "SELECT * FROM censusblocks WHERE SUBSTR(GEOID,1,5) = \'%s%s\'" censusblocks_trimmed.shp censusblocks.shp' % (self.statefips,self.countyfips)
-        os.system(command)
-
-        # now rename "trimmed" and "non-trimmed" into place
-        os.rename('censusblocks.shp','censusblocks_statewide.shp')
-        os.rename('censusblocks.shx','censusblocks_statewide.shx')
-        os.rename('censusblocks.dbf','censusblocks_statewide.dbf')
-        os.rename('censusblocks.prj','censusblocks_statewide.prj')
-
-        os.rename('censusblocks_trimmed.shp','censusblocks.shp')
-        os.rename('censusblocks_trimmed.shx','censusblocks.shx')
-        os.rename('censusblocks_trimmed.dbf','censusblocks.dbf')
-        os.rename('censusblocks_trimmed.prj','censusblocks.prj')
-
-
-####################################################################################################################################################
-####################################################################################################################################################
-
-if __name__ == '__main__':
-    # sanity checks: make sure we have OGR module
-    try:
-        from osgeo import ogr
-    except:
-        print "Could not import ogr"
-        print "You must have Python-OGR installed, e.g. be using Python from OSG4Win"
-        sys.exit(4)
-
-    # sanity checks: make sure we can execute ogr2ogr
-    command = 'ogr2ogr --version'
-    code = os.system(command)
-    if code != 0:
-        print "Could not execute ogr2ogr binary. Are you sure it's installed?"
-        sys.exit(2)
-
-    # parse command-line params, there's only 1
-    try:
-        state  = sys.argv[1]
-        try:
-            county = sys.argv[2]
-            if len(county) != 3:
-                print "ERROR: Bad county FIPS code; County FIPS are always 3 digits."
-                print ""
-                sys.exit(1)
-        except IndexError:
-            county = None
-        fips   = STATE_FIPS_CODES[state]
-    except:
-        print "USAGE"
-        print "Whole state:"
-        print "    python GenerateStateMapperData.py XX"
-        print "        Where XX is the two-letter postal code for the state, e.g. CA or VT."
-        print "Single county by FIPS code:"
-        print "    python GenerateStateMapperData.py XX NNN"
-        print "        Where XX is the two-letter postal code for the state, e.g. CA or VT."
-        print "        And NNN is a three-digit county FIPS code, e.g. 031"
-        sys.exit(1)
-
-    # compose a single config object, and tell the user what we think they asked for
-    config = { 'state':state, 'statefips':fips, 'countyfips':county }
-    print "Preparing to generate data for %s   State FIPS code is %s" % (config['state'],config['statefips'])
-    if county:
-        print "Will filter by county FIPS = %s" % county
-    print ""
-    print "If that looks right, just wait 5 seconds."
-    print "If not, hit ctrl-C right now to abort."
-    time.sleep(5)
-    print "Starting"
-    print ""
-
-    # Part 1: download all the datasets: polygon geometries, ACS for income data at tract level, decennial census for race and youth attributes
-    print "Fetching polygon shapefile from USCB FTP"
-    plyd = PolygonDownloader(config)
-    plyd.main()
-
-    print "Fetching decennial attributes from MCDC Dexter"
-    decd = DecennialDownloader(config)
-    decd.main()
-
-    print "Fetching ACS income tract attributes from MDCDC Dexter"
-    acsd = ACSDownloader(config)
-    acsd.main()
-
-    # Part 2: merge the attributes from the CSVs into the shapefile via OGR
-    print "Merging ACS MHHINC into censusblocks"
-    merge1 = ACSMerger(config)
-    merge1.main()
-
-    print "Merging Decennial attribs into censusblocks"
-    merge2 = DecennialMerger(config)
-    merge2.main()
-
-    # Part 3: if a specific county FIPS was given then filter the censusblocks shapefile
-    # yeah, in postprocessing after we we wasted time doing joins earlier, but it was seconds and this is best left in a final massage phase, so we can abort and examine the not-yet-pruned version when debugging
-    if config['countyfips']:
-        print "Trimming shapefile to county FIPS %s" % config['countyfips']
-        trimmer = CountyTrimmer(config)
-        trimmer.main()
+#!/bin/env python
+"""
+Command-line application to fetch census blocks, decennial census tables (block), and ACS income (tract) data
+then merge them into a single Mapper-ready shapefile for the whole state. (or, prune it to an area of interest for a more localized mapper)
+
+Usage:
+    Basic, grab a whole state:
+        GenerateStateMapperData.py XX
+        Where XX is the two-letter postal code for the state, e.g. CA or VT.
+    County, only fetch and merge a single county (or several), via FIPS code:
+        GenerateStateMapperData.py XX NNN [NNN ...]
+        Where XX is the two-letter postal code for the state, e.g. CA or VT.
+        And NNN is a three-digit county FIPS code, e.g. 031
+    Batch, run several states (or all of them) in parallel worker processes:
+        GenerateStateMapperData.py --states CA,TX,VT [--workers 4]
+        GenerateStateMapperData.py --all [--workers 4]
+        Each state is written into its own subdirectory, e.g. CA/censusblocks.shp with a CA/run.log
+    Prefetch, download states' polygons and extracts into a local mirror, then run against it:
+        GenerateStateMapperData.py --prefetch mirror [--states CA,TX,VT]
+        ServeMirror.py mirror --port 8000
+        GenerateStateMapperData.py XX --tiger-url http://localhost:8000/tiger --dexter-url http://localhost:8000
+    From Python, without the prompt, e.g. as ExtractService.py does:
+        import GenerateStateMapperData
+        path = GenerateStateMapperData.generate('VT', ['007'], workdir='VT', format='gpkg')
+"""
+
+# state FIPS codes
+# so the user can give a two-letter code (CA, UT) and we look up the FIPS for them
+# the FIPS is used for most filenames on remote (government) services, though we often want to use a human-friendly name for target filenames and output
+STATE_FIPS_CODES = {
+    "AL" : "01",
+    "AK" : "02",
+    "AZ" : "04",
+    "AR" : "05",
+    "CA" : "06",
+    "CO" : "08",
+    "CT" : "09",
+    "DE" : "10",
+    "DC" : "11",
+    "FL" : "12",
+    "GA" : "13",
+    "HI" : "15",
+    "ID" : "16",
+    "IL" : "17",
+    "IN" : "18",
+    "IA" : "19",
+    "KS" : "20",
+    "KY" : "21",
+    "LA" : "22",
+    "ME" : "23",
+    "MD" : "24",
+    "MA" : "25",
+    "MI" : "26",
+    "MN" : "27",
+    "MS" : "28",
+    "MO" : "29",
+    "MT" : "30",
+    "NE" : "31",
+    "NV" : "32",
+    "NH" : "33",
+    "NJ" : "34",
+    "NM" : "35",
+    "NY" : "36",
+    "NC" : "37",
+    "ND" : "38",
+    "OH" : "39",
+    "OK" : "40",
+    "OR" : "41",
+    "PA" : "42",
+    "RI" : "44",
+    "SC" : "45",
+    "SD" : "46",
+    "TN" : "47",
+    "TX" : "48",
+    "UT" : "49",
+    "VT" : "50",
+    "VA" : "51",
+    "WA" : "53",
+    "WV" : "54",
+    "WI" : "55",
+    "WY" : "56",
+}
+
+# batch mode: how many states to run at the same time, each in its own worker process
+# this is mostly network-bound, so it doesn't need to match the number of CPUs
+BATCH_WORKERS = 4
+
+# downloads are kept in a cache directory, so re-running a state doesn't fetch hundreds of MB all over again
+# entries are keyed by the URL and query parameters (vintage, state, varlist) so a change to any of them is a fresh download
+# CACHE_MAX_BYTES caps the cache's size; the least-recently-used entries are removed first
+# set CACHE_DIRECTORY to None to turn caching off entirely
+CACHE_DIRECTORY = "download_cache"
+CACHE_MAX_BYTES = 10 * 1024 * 1024 * 1024
+
+# the block polygon zips for big states are large, so they're fetched over several connections at once, each taking a byte range
+# parts are kept between runs, so an interrupted download picks up where it left off instead of starting over
+# DOWNLOAD_MIN_PART keeps small files from being chopped into silly little pieces
+DOWNLOAD_CONNECTIONS = 4
+DOWNLOAD_MIN_PART    = 8 * 1024 * 1024
+DOWNLOAD_RETRIES     = 5
+DOWNLOAD_TIMEOUT     = 60
+
+# the parts of a shapefile which we move around together, including its spatial and attribute indexes
+SHAPEFILE_EXTENSIONS = [ '.shp', '.shx', '.dbf', '.prj', '.cpg', '.qix', '.idm', '.ind' ]
+
+# the merged blocks can be written in any of these formats: OGR driver, file extension, layer creation options
+# GeoPackage gets an R-tree, FlatGeobuf its packed Hilbert R-tree, and GeoParquet has row groups in GEOID order with bbox stats
+# so a bbox query or a county extract is an index lookup rather than a scan of the whole state
+OUTPUT_FORMAT  = 'shapefile'
+OUTPUT_FORMATS = {
+    'shapefile' : ( 'ESRI Shapefile', '.shp',     [] ),
+    'gpkg'      : ( 'GPKG',           '.gpkg',    [ 'SPATIAL_INDEX=YES' ] ),
+    'fgb'       : ( 'FlatGeobuf',     '.fgb',     [ 'SPATIAL_INDEX=YES' ] ),
+    'parquet'   : ( 'Parquet',        '.parquet', [ 'GEOMETRY_ENCODING=WKB', 'ROW_GROUP_SIZE=65536', 'WRITE_COVERING_BBOX=YES' ] ),
+    'mbtiles'   : ( 'MBTiles',        '.mbtiles', [] ),
+    'pmtiles'   : ( 'MBTiles',        '.pmtiles', [] ),
+}
+
+# these formats are vector tilesets: the blocks are merged into a GeoPackage first, then cut into tiles by VectorTiler
+TILE_FORMATS = [ 'mbtiles', 'pmtiles' ]
+
+# vector tiles are made for these bands of zooms: (min zoom, max zoom, fields or None for all, simplification in tile units, minimum block area)
+# lower zooms get fewer fields, more simplification, and leave out blocks smaller than the minimum area, in pixels at the band's lowest zoom
+# so a whole state at zoom 5 isn't a million sub-pixel polygons each with a dozen attributes
+TILE_ZOOM_BANDS = [
+    (  5,  9, [ 'GEOID', 'TOTPOP', 'MHHINC' ], 4.0, 1.0 ),
+    ( 10, 11, [ 'GEOID', 'TOTPOP', 'HISP', 'YOUTH', 'MHHINC' ], 2.0, 0.25 ),
+    ( 12, 14, None, 1.0, 0 ),
+]
+
+# bands from this zoom up are tiled as one job per tile at this zoom, spread over a pool of processes (--tile-workers, default one per CPU)
+TILE_PARTITION_ZOOM = 8
+
+# --rollups: the blocks can also be added up into these areas, in the same pass as the merge: (name, GEOID length, output base name)
+# an area's GEOID is the start of its blocks' GEOIDs: 12 characters for a block group, 11 for a tract, 5 for a county
+ROLLUP_LEVELS = [
+    ( 'blockgroup', 12, 'censusblockgroups' ),
+    ( 'tract',      11, 'censustracts' ),
+    ( 'county',      5, 'censuscounties' ),
+]
+
+# --optimize: a stage after the merge writes a slimmer copy of the blocks to ship, censusblocks_optimized plus the format's extension; see BlockOptimizer
+# its coordinates are rounded to this many decimal places of a degree, 6 being about 10cm (--optimize-precision)
+OPTIMIZE_PRECISION = 6
+
+# --empty-blocks: what the optimize stage does with the blocks where TOTPOP is 0, a good share of every state: keep them, drop them, or merge each tract's into one
+EMPTY_BLOCKS = [ 'keep', 'drop', 'merge' ]
+
+# the decennial fields whose type is count in the field spec are summed into the rollups; MHHINC is a median and can't be added up,
+# so only tracts get it, which is the level the ACS has it for, rather than it being copied down onto blocks and back up again
+
+# Dexter's CSV extracts are converted into columns this many rows at a time
+ATTRIBUTE_CHUNK_ROWS = 50000
+
+# the merge stage's inputs are the outputs of these stages
+MERGE_UPSTREAM = [ 'polygons', 'decennial', 'acs' ]
+
+# the merge joins and writes this many features per batch, each batch in one transaction
+MERGE_TRANSACTION_SIZE = 10000
+
+# with --stream-join, the attributes are sorted on disk and merge-joined against the blocks in GEOID order, holding about this much of them in memory at once
+STREAM_JOIN_MEMORY = 64 * 1048576
+
+# a join reports this many of the GEOIDs it found no attributes for, along with how many there were in all
+UNMATCHED_EXAMPLES = 5
+
+# when counties are given, Dexter is asked for just their rows by filtering on this variable, which holds the 5-digit state+county FIPS
+# Dexter's IN operator takes a list of values separated by colons
+DEXTER_COUNTY_VARIABLE = "county"
+
+# the ACS tracts dataset is national, so a whole-state run asks Dexter for just the state's tracts by filtering on this variable, the 2-digit state FIPS
+DEXTER_STATE_VARIABLE = "state"
+
+# each run keeps a manifest.json of which stages finished and with what inputs, so a re-run only does the stages which are stale
+# bump the version if what the stages write changes, so older manifests don't count
+MANIFEST_VERSION = 1
+
+# where the data comes from: the Census Bureau's TIGER files, and MCDC's Dexter for the attribute extracts
+# either can be pointed elsewhere with --tiger-url and --dexter-url, e.g. at a mirror made with --prefetch and served by ServeMirror.py
+TIGER_BASE_URL  = "https://www2.census.gov/geo/tiger"
+DEXTER_BASE_URL = "http://mcdc.missouri.edu"
+
+# Dexter can be slow, more so for a long varlist, and now and then a request to it fails: see DexterClient
+# each request gets DEXTER_TIMEOUT seconds; one which fails is tried again up to DEXTER_RETRIES more times, waiting DEXTER_BACKOFF seconds and then twice as long each time
+# an extract Dexter hasn't finished writing yet is checked for every DEXTER_POLL_SECONDS, for up to DEXTER_MAX_WAIT seconds
+DEXTER_TIMEOUT      = 300
+DEXTER_RETRIES      = 4
+DEXTER_BACKOFF      = 5
+DEXTER_POLL_SECONDS = 5
+DEXTER_MAX_WAIT     = 600
+
+# a varlist of more than this many variables is split into sub-extracts, fetched side by side and joined back together on esriid (--dexter-batch)
+DEXTER_VARLIST_BATCH = 20
+
+# the settings a run gets when it isn't told otherwise, the same as the command line's defaults; see state_config()
+RUN_DEFAULTS = {
+    'format':OUTPUT_FORMAT,
+    'cachedir':CACHE_DIRECTORY,
+    'cachemaxbytes':CACHE_MAX_BYTES,
+    'connections':DOWNLOAD_CONNECTIONS,
+    'joinmemory':STREAM_JOIN_MEMORY,
+    'mergeworkers':1,
+    'tigerurl':TIGER_BASE_URL,
+    'dexterurl':DEXTER_BASE_URL,
+    'dexterbatch':DEXTER_VARLIST_BATCH,
+}
+
+# what years do we go for? decennial is of course every 10 years, while ACS is approximately annual
+# --acs-years joins several ACS vintages at once instead, each with its own year-suffixed fields; see acs_vintages()
+ACS_YEAR       = "2013"
+DECENNIAL_YEAR = "2010"
+
+# the decennial fields, as a spec: which census variables to ask MCDC Dexter for, and how the output fields are made from them
+# source: each Dexter variable, and the label its column is kept under in decennial_attributes.npy, and optionally its type: integer unless it says real
+# fields: in output order, each output field's name, its type, and either the label it's a copy of or an expression over the labels
+# an expression is arithmetic over whole columns: labels, numbers, + - * / and parentheses, e.g. 100.0 * Male / TotPop
+# a block whose expression divides by zero gets 0 for that field, rather than an infinity or a NaN
+# types are count (whole numbers which add up, so they're summed into --rollups), integer, or real; see FIELD_TYPES
+# --field-spec FILE uses a JSON file of the same shape instead; the spec is compiled once per run by FieldTransform
+DECENNIAL_FIELD_SPEC = {
+    'source': [
+        [ 'P4i3',   'Hispanic' ],
+        [ 'P6i1',   'TotPop' ],
+        [ 'P6i2',   'White' ],
+        [ 'P6i3',   'Black' ],
+        [ 'P6i4',   'Amerind' ],
+        [ 'P6i5',   'Asian' ],
+        [ 'P6i6',   'Hawpi' ],
+        [ 'P12i3',  'agem1' ],
+        [ 'P12i4',  'agem2' ],
+        [ 'P12i5',  'agem3' ],
+        [ 'P12i6',  'agem4' ],
+        [ 'P12i27', 'agef1' ],
+        [ 'P12i28', 'agef2' ],
+        [ 'P12i29', 'agef3' ],
+        [ 'P12i30', 'agef4' ],
+    ],
+    'fields': [
+        [ 'HISP',    'count', 'Hispanic' ],
+        [ 'TOTPOP',  'count', 'TotPop' ],
+        [ 'WHITE',   'count', 'White' ],
+        [ 'BLACK',   'count', 'Black' ],
+        [ 'AMERIND', 'count', 'Amerind' ],
+        [ 'ASIAN',   'count', 'Asian' ],
+        [ 'HAWPI',   'count', 'Hawpi' ],
+        [ 'YOUTH',   'count', 'agem1 + agem2 + agem3 + agem4 + agef1 + agef2 + agef3 + agef4' ],
+    ],
+}
+
+# the types a field spec's fields can have: the NumPy type of the column, and the OGR type of the field
+FIELD_TYPES = {
+    'count'   : ( 'i4', 'OFTInteger' ),
+    'integer' : ( 'i4', 'OFTInteger' ),
+    'real'    : ( 'f8', 'OFTReal' ),
+}
+
+# a shapefile's DBF cuts field names to this many characters, so a field spec's names can't be longer when the output is a shapefile
+SHAPEFILE_FIELD_NAME_LENGTH = 10
+
+# the default spec's Dexter variables, and the labels of the columns they're kept under, each with the GEOID first
+DECENNIAL_FIELD_NAMES  = [ 'esriid' ] + [ source[0] for source in DECENNIAL_FIELD_SPEC['source'] ]
+DECENNIAL_FIELD_LABELS = [ 'GEOID' ] + [ source[1] for source in DECENNIAL_FIELD_SPEC['source'] ]
+
+####################################################################################################################################################
+####################################################################################################################################################
+
+import os, sys, time, re, math
+import urllib, urllib2, urlparse, zipfile
+import csv
+import argparse, multiprocessing, traceback, threading
+import hashlib, json, shutil, tempfile, heapq
+import cProfile
+import httplib, socket
+import sqlite3, struct, gzip, StringIO
+import __future__
+
+# OGR and NumPy are checked for at startup, but are imported here at module level so batch-mode worker processes have it too
+try:
+    from osgeo import ogr
+except ImportError:
+    ogr = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# for peak memory in --metrics; there's no resource module on Windows, so there it's left out
+try:
+    import resource
+except ImportError:
+    resource = None
+
+class DownloadCache:
+    # a directory of downloaded files, each stored under a hash of whatever identifies the request (URL, query params)
+    # alongside a small JSON file saying what it is, how big it should be, and the server's Last-Modified if it gave one
+    # entries are checked against that size before use, and "touched" on each use so eviction can go least-recently-used first
+    # safe to share between threads and batch-mode worker processes: entries are written to a temp file then renamed into place
+    def __init__(self,directory,max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # another worker may have just made it
+                if not os.path.isdir(self.directory):
+                    raise
+    def key(self,request):
+        # request is anything repr-able which identifies the download, e.g. a URL or a sorted list of query params
+        return hashlib.sha1(repr(request)).hexdigest()
+    def fetch(self,request,target,download,revalidate=None):
+        # put the content for this request into the target file, from the cache if we have it, else by calling download(path)
+        # download() returns the server's Last-Modified header (or None) and is only called on a miss
+        # revalidate(metadata) is optional: if given and it returns False, the cached copy is considered stale
+        # returns True on a cache hit
+        key      = self.key(request)
+        entry    = os.path.join(self.directory, key)
+        metadata = self.metadata(key)
+        if metadata and os.path.exists(entry) and os.path.getsize(entry) == metadata['size'] and (revalidate is None or revalidate(metadata)):
+            os.utime(entry, None)
+            self.copy(entry, target)
+            print "    Using cached copy %s" % entry
+            return True
+
+        temp = "%s.%d.%d.tmp" % (entry, os.getpid(), threading.current_thread().ident)
+        try:
+            lastmodified = download(temp)
+            metadata = { 'request':repr(request), 'size':os.path.getsize(temp), 'lastmodified':lastmodified, 'stored':time.time() }
+            self.replace(temp, entry)
+        finally:
+            if os.path.exists(temp):
+                os.unlink(temp)
+        metafile = open(entry + '.json.%d.%d.tmp' % (os.getpid(), threading.current_thread().ident), 'w')
+        json.dump(metadata, metafile)
+        metafile.close()
+        self.replace(metafile.name, entry + '.json')
+
+        self.copy(entry, target)
+        self.evict(keep=key)
+        return False
+    def metadata(self,key):
+        try:
+            metafile = open(os.path.join(self.directory, key + '.json'), 'r')
+        except IOError:
+            return None
+        try:
+            return json.load(metafile)
+        except ValueError:
+            return None
+        finally:
+            metafile.close()
+    def evict(self,keep=None):
+        # remove least-recently-used entries until the cache fits in max_bytes
+        # the entry we just stored is kept even if it alone is over the limit, else we'd have nothing to work with
+        entries = []
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.json') or filename.endswith('.tmp'):
+                continue
+            path = os.path.join(self.directory, filename)
+            try:
+                entries.append( (os.path.getmtime(path), os.path.getsize(path), filename) )
+            except OSError:
+                pass
+        total = sum([ size for used,size,filename in entries ])
+        for used,size,filename in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if filename == keep:
+                continue
+            for path in (os.path.join(self.directory, filename), os.path.join(self.directory, filename + '.json')):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            total -= size
+            print "    Evicted %s from download cache" % filename
+    def copy(self,entry,target):
+        link_or_copy(entry, target)
+    def replace(self,source,target):
+        # Windows can't do an atomic overwrite, so unlink the target first; if another worker beat us to it, theirs is just as good
+        try:
+            os.rename(source, target)
+        except OSError:
+            try:
+                os.unlink(target)
+            except OSError:
+                pass
+            os.rename(source, target)
+
+
+def open_download_cache(config):
+    # the DownloadCache for this run, or None if caching is turned off
+    if not config.get('cachedir'):
+        return None
+    return DownloadCache(config['cachedir'], config.get('cachemaxbytes', CACHE_MAX_BYTES))
+
+
+def unlink_shapefile(path):
+    # remove a shapefile and its sidecar files, if they exist
+    # Windows can't do an atomic overwrite, so this is what has to happen before something is renamed into place
+    base = os.path.splitext(path)[0]
+    for extension in SHAPEFILE_EXTENSIONS:
+        try:
+            os.unlink(base + extension)
+        except OSError:
+            pass
+
+
+def shapefile_files(path):
+    # the files making up a shapefile, those which exist anyway
+    base = os.path.splitext(path)[0]
+    return [ base + extension for extension in SHAPEFILE_EXTENSIONS if os.path.exists(base + extension) ]
+
+
+def unlink_dataset(path):
+    # remove an output dataset if it exists, be it a shapefile and its sidecars or a single-file format
+    if os.path.splitext(path)[1] == '.shp':
+        unlink_shapefile(path)
+        return
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def output_path(config):
+    # where the merged blocks end up: censusblocks plus the extension for the output format
+    drivername, extension, options = OUTPUT_FORMATS[config.get('format', OUTPUT_FORMAT)]
+    return os.path.join(config['workdir'], 'censusblocks' + extension)
+
+
+def optimized_path(config):
+    # where --optimize writes its slimmer copy of the merged blocks: censusblocks_optimized plus the extension for the output format
+    drivername, extension, options = OUTPUT_FORMATS[config.get('format', OUTPUT_FORMAT)]
+    return os.path.join(config['workdir'], 'censusblocks_optimized' + extension)
+
+
+def rollup_format(config):
+    # which of OUTPUT_FORMATS --rollups are written in with --rollup-geometry: the same as the blocks, or a GeoPackage alongside a tileset
+    rollupformat = config.get('format', OUTPUT_FORMAT)
+    if rollupformat in TILE_FORMATS:
+        rollupformat = 'gpkg'
+    return rollupformat
+
+
+def rollup_path(config,basename):
+    # where one of the --rollups ends up: a CSV of counts, or with --rollup-geometry a dataset in rollup_format()
+    if not config.get('rollupgeometry'):
+        return os.path.join(config['workdir'], basename + '.csv')
+    return os.path.join(config['workdir'], basename + OUTPUT_FORMATS[rollup_format(config)][1])
+
+
+def rename_shapefile(source,target):
+    # rename a shapefile and whichever of its sidecar files exist
+    source = os.path.splitext(source)[0]
+    target = os.path.splitext(target)[0]
+    for extension in SHAPEFILE_EXTENSIONS:
+        if os.path.exists(source + extension):
+            os.rename(source + extension, target + extension)
+
+
+class OGRSession:
+    # in-process stand-in for ogr2ogr: no process startup and driver registration per step, and GDAL errors come back as exceptions
+    # rather than an exit code which is easy to ignore
+    # datasources are opened once and kept open for the rest of the run, so later queries against the same file reuse them
+    # one session is shared by a run's stages, see run_pipeline(); the lock is because the downloads run in threads
+    def __init__(self):
+        ogr.UseExceptions()
+        self.lock        = threading.Lock()
+        self.datasources = {}
+    def open(self,path):
+        with self.lock:
+            if path not in self.datasources:
+                datasource = ogr.Open(path, 0)
+                if datasource is None:
+                    raise IOError("OGR could not open %s" % path)
+                self.datasources[path] = datasource
+            return self.datasources[path]
+    def query(self,path,sql):
+        # run OGR SQL against a datasource and return the result layer; hand it back to release() when done
+        layer = self.open(path).ExecuteSQL(sql)
+        if layer is None:
+            raise RuntimeError("OGR query failed against %s: %s" % (path, sql))
+        return layer
+    def release(self,path,layer):
+        self.open(path).ReleaseResultSet(layer)
+    def translate(self,path,sql,target,drivername='ESRI Shapefile',options=[]):
+        # the equivalent of: ogr2ogr -sql "sql" target path
+        # the query's features are streamed straight into the new dataset, which is closed so it's complete on disk; returns how many were written
+        driver = ogr.GetDriverByName(drivername)
+        if driver is None:
+            raise RuntimeError("GDAL has no %s driver" % drivername)
+        self.close(target)
+        unlink_dataset(target)
+
+        layer = self.query(path, sql)
+        try:
+            output   = driver.CreateDataSource(target)
+            outlayer = output.CreateLayer(os.path.splitext(os.path.basename(target))[0], layer.GetSpatialRef(), layer.GetGeomType(), options)
+            defn     = layer.GetLayerDefn()
+            for index in range(defn.GetFieldCount()):
+                outlayer.CreateField( defn.GetFieldDefn(index) )
+            outdefn  = outlayer.GetLayerDefn()
+
+            count   = 0
+            feature = layer.GetNextFeature()
+            while feature:
+                outfeature = ogr.Feature(outdefn)
+                outfeature.SetFrom(feature)
+                outlayer.CreateFeature(outfeature)
+                count  += 1
+                feature = layer.GetNextFeature()
+            output.Destroy()
+        finally:
+            self.release(path, layer)
+        return count
+    def close(self,path=None):
+        # close one datasource, or all of them
+        with self.lock:
+            for opened in [ opened for opened in self.datasources.keys() if path is None or opened == path ]:
+                self.datasources.pop(opened).Destroy()
+
+
+def ogr_session(config):
+    # the run's shared OGRSession if there is one, otherwise a fresh one, e.g. when a stage is run on its own
+    return config.get('ogrsession') or OGRSession()
+
+
+def county_geoid_prefixes(config):
+    # the 5-digit state+county GEOID prefixes of the counties asked for, or None for the whole state
+    if not config.get('countyfips'):
+        return None
+    return [ config['statefips'] + countyfips for countyfips in config['countyfips'] ]
+
+
+def acs_vintages(config):
+    # the ACS vintages a run joins, each as its year, field suffix, stage name and attributes file
+    # normally just ACS_YEAR, with plain MHHINC in acs_attributes.npy as always; with --acs-years, each of those years
+    # with its fields suffixed by the last two digits of the year (MHHINC13, MHHINC18) and a stage and file of its own
+    if not config.get('acsyears'):
+        return [ { 'year':ACS_YEAR, 'suffix':'', 'stage':'acs', 'filename':'acs_attributes.npy' } ]
+    return [ { 'year':year, 'suffix':year[-2:], 'stage':'acs%s' % year, 'filename':'acs_attributes_%s.npy' % year } for year in config['acsyears'] ]
+
+
+def merge_upstream(config):
+    # the stages whose outputs go into the merge: MERGE_UPSTREAM, with its acs stage standing in for each of the run's ACS vintages
+    upstream = []
+    for name in MERGE_UPSTREAM:
+        if name == 'acs':
+            upstream.extend([ vintage['stage'] for vintage in acs_vintages(config) ])
+        else:
+            upstream.append(name)
+    return upstream
+
+
+def dexter_county_filter(config,params,statewide=False):
+    # fill in Dexter's first filter slot so it only extracts rows for the counties asked for, if any
+    # or with statewide, for a national dataset, the rows for the state; a config with no statefips is for the national dataset as a whole
+    prefixes = county_geoid_prefixes(config)
+    if prefixes:
+        params['fkey1']  = DEXTER_COUNTY_VARIABLE
+        params['op1']    = "EQ" if len(prefixes) == 1 else "IN"
+        params['value1'] = ":".join(prefixes)
+    elif statewide and config.get('statefips'):
+        params['fkey1']  = DEXTER_STATE_VARIABLE
+        params['op1']    = "EQ"
+        params['value1'] = config['statefips']
+
+
+def unlink_file(path):
+    # remove a file, if it's there, before writing a new one in its place
+    # it may be a hard link to a download cache entry or to a state's slice of the national ACS extract (see link_or_copy),
+    # and opening it for writing would overwrite those as well, leaving e.g. a cache entry whose contents no longer match its query
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def link_or_copy(source,target):
+    # a hard link where the platform has them, since these files can be hundreds of MB; else a plain copy
+    if os.path.exists(target):
+        os.unlink(target)
+    try:
+        os.link(source, target)
+    except (AttributeError, OSError):
+        shutil.copyfile(source, target)
+
+
+class RangedDownload:
+    # fetch one HTTP URL into a local file over several connections, each connection taking one byte range of the file
+    # each range goes into its own part file next to the target, plus a JSON file describing the ranges and the remote file's size and age
+    # if the transfer drops, that range is retried from where it stopped; if the whole run dies, the next one resumes from the part files
+    # as long as the server still has the same file; once all ranges are in, their sizes are checked and they're stitched into the target
+    # servers which don't do Range requests (or FTP) get a plain single-stream download, as before
+    def __init__(self,url,partsbase,connections=DOWNLOAD_CONNECTIONS,retries=DOWNLOAD_RETRIES,timeout=DOWNLOAD_TIMEOUT):
+        self.url         = url
+        self.partsbase   = partsbase
+        self.connections = max(1, connections)
+        self.retries     = retries
+        self.timeout     = timeout
+        self.lock        = threading.Lock()
+    def probe(self):
+        # ask for the first byte: a 206 with Content-Range tells us both that ranges work and how big the file is
+        # returns (size, lastmodified, ranged)
+        request = urllib2.Request(self.url, headers={ 'Range':'bytes=0-0' })
+        remote  = urllib2.urlopen(request, timeout=self.timeout)
+        info    = remote.info()
+        code    = remote.getcode()
+        remote.close()
+        lastmodified = info.getheader("Last-Modified")
+        contentrange = info.getheader("Content-Range")
+        if code == 206 and contentrange and '/' in contentrange and not contentrange.endswith('/*'):
+            return int(contentrange.split('/')[-1]), lastmodified, True
+        size = info.getheader("Content-Length")
+        return (int(size) if size else 0), lastmodified, False
+    def fetch(self,target):
+        # download into the target file, returning the server's Last-Modified header (or None)
+        if not self.url.lower().startswith('http'):
+            return self.fetch_stream(target)
+        size, lastmodified, ranged = self.probe()
+        if not ranged or not size:
+            return self.fetch_stream(target)
+
+        ranges = self.plan(size, lastmodified)
+        self.size       = size
+        self.downloaded = sum([ self.part_size(index) for index in range(len(ranges)) ])
+        self.reported   = -1
+        if self.downloaded:
+            print "    Resuming download, %d MB of %d MB already here" % (self.downloaded/1048576, size/1048576)
+        print "    Downloading %d MB over %d connections" % (size/1048576, len(ranges))
+
+        # one thread per range; any range which still failed after its retries fails the download, but its part is kept for next time
+        errors  = []
+        threads = []
+        for index,(start,end) in enumerate(ranges):
+            thread = threading.Thread(target=self.fetch_range, args=(index,start,end,errors), name=threading.current_thread().name)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.5)
+        if errors:
+            raise IOError("Download of %s failed, %d MB of %d MB is saved and will be resumed next time: %s" % (self.url, self.downloaded/1048576, size/1048576, errors[0]))
+
+        self.stitch(ranges, target)
+        return lastmodified
+    def plan(self,size,lastmodified):
+        # split the file into ranges, or pick up the ranges from an earlier attempt if it was for the very same remote file
+        state = self.partsbase + '.json'
+        try:
+            previous = json.load(open(state, 'r'))
+            if previous['url'] == self.url and previous['size'] == size and previous['lastmodified'] == lastmodified:
+                return [ tuple(pair) for pair in previous['ranges'] ]
+        except (IOError, ValueError, KeyError):
+            pass
+        self.cleanup()
+
+        count  = max(1, min(self.connections, size / DOWNLOAD_MIN_PART))
+        length = size / count
+        ranges = []
+        for index in range(count):
+            start = index * length
+            end   = size - 1 if index == count - 1 else start + length - 1
+            ranges.append( (start,end) )
+        statefile = open(state, 'w')
+        json.dump({ 'url':self.url, 'size':size, 'lastmodified':lastmodified, 'ranges':ranges }, statefile)
+        statefile.close()
+        return ranges
+    def part_path(self,index):
+        return "%s.part%d" % (self.partsbase, index)
+    def part_size(self,index):
+        try:
+            return os.path.getsize(self.part_path(index))
+        except OSError:
+            return 0
+    def fetch_range(self,index,start,end,errors):
+        # fetch bytes start..end (inclusive) into the part file, continuing from however much of it we already have
+        wanted = end - start + 1
+        for attempt in range(self.retries + 1):
+            have = self.part_size(index)
+            if have >= wanted:
+                return
+            try:
+                request = urllib2.Request(self.url, headers={ 'Range':'bytes=%d-%d' % (start + have, end) })
+                remote  = urllib2.urlopen(request, timeout=self.timeout)
+                if remote.getcode() != 206:
+                    remote.close()
+                    raise IOError("server ignored the Range request")
+                local = open(self.part_path(index), 'ab')
+                try:
+                    while have < wanted:
+                        block = remote.read(min(1048576, wanted - have))
+                        if not block:
+                            break
+                        local.write(block)
+                        have += len(block)
+                        self.progress(len(block))
+                finally:
+                    local.close()
+                    remote.close()
+                if have < wanted:
+                    raise IOError("connection closed early")
+            except (IOError, socket.error, httplib.HTTPException), e:
+                if attempt == self.retries:
+                    errors.append(str(e))
+                    return
+                print "    Connection for bytes %d-%d dropped (%s), retrying" % (start, end, e)
+                time.sleep(min(2 ** attempt, 30))
+        if self.part_size(index) < wanted:
+            errors.append("bytes %d-%d still incomplete after %d tries" % (start, end, self.retries + 1))
+    def progress(self,length):
+        # report every 10% rather than every MB, so this stays readable when other downloads are printing too
+        with self.lock:
+            self.downloaded += length
+            decile = 10 * self.downloaded / self.size
+            if decile != self.reported:
+                self.reported = decile
+                print "    %d MB of %d MB" % (self.downloaded/1048576 , self.size/1048576)
+    def stitch(self,ranges,target):
+        # check each part is exactly the length of its range, then concatenate them into the target and clean up
+        for index,(start,end) in enumerate(ranges):
+            if self.part_size(index) != end - start + 1:
+                self.cleanup()
+                raise IOError("Download of %s came back the wrong size in bytes %d-%d" % (self.url, start, end))
+        unlink_file(target)
+        local = open(target, 'wb')
+        for index in range(len(ranges)):
+            part = open(self.part_path(index), 'rb')
+            shutil.copyfileobj(part, local, 1048576)
+            part.close()
+        local.close()
+        if os.path.getsize(target) != ranges[-1][1] + 1:
+            raise IOError("Download of %s came back the wrong size" % self.url)
+        self.cleanup()
+    def cleanup(self):
+        # remove part files and the ranges file, from this attempt or a stale earlier one
+        directory = os.path.dirname(self.partsbase) or '.'
+        prefix    = os.path.basename(self.partsbase) + '.'
+        for filename in os.listdir(directory):
+            if filename.startswith(prefix) and (filename[len(prefix):].startswith('part') or filename[len(prefix):] == 'json'):
+                try:
+                    os.unlink(os.path.join(directory, filename))
+                except OSError:
+                    pass
+    def fetch_stream(self,target):
+        # one connection, start to finish
+        remote = urllib2.urlopen(self.url, timeout=self.timeout)
+        unlink_file(target)
+        local  = open(target, 'wb')
+        size   = int( remote.info().getheaders("Content-Length")[0] )
+
+        # report every 10% rather than every MB, so this stays readable when other downloads are printing too
+        downloaded = 0
+        reported   = -1
+        while True:
+            block = remote.read(1048576)
+            if not block:
+                break
+            downloaded += len(block)
+            local.write(block)
+            decile = 10 * downloaded / size if size else 0
+            if decile != reported:
+                reported = decile
+                print "    %d MB of %d MB" % (downloaded/1048576 , size/1048576)
+        local.close()
+        lastmodified = remote.info().getheader("Last-Modified")
+        remote.close()
+        return lastmodified
+
+
+class PolygonDownloader:
+    def __init__(self,config):
+        self.config = config
+        self.url    = "%s/TIGER%sBLKPOPHU/tabblock%s_%s_pophu.zip" % (config.get('tigerurl') or TIGER_BASE_URL, DECENNIAL_YEAR, DECENNIAL_YEAR, self.config['statefips'])
+        self.workdir = config['workdir']
+        self.target  = os.path.join(self.workdir, os.path.basename(self.url))
+        self.cache   = open_download_cache(config)
+        self.counts  = {}
+    def main(self):
+        self.download()
+        self.strip()
+    def fingerprint(self):
+        return { 'url':self.url, 'counties':county_geoid_prefixes(self.config) }
+    def outputs(self):
+        return shapefile_files(os.path.join(self.workdir,"censusblocks_stripped.shp"))
+    def download(self):
+        print "    %s" % (self.url)
+        print "    %s" % (self.target)
+        if self.cache:
+            revalidate = self.revalidate if self.config.get('cacherevalidate') else None
+            self.counts['cachehit'] = self.cache.fetch(self.url, self.target, self.fetch, revalidate)
+        else:
+            self.fetch(self.target)
+    def revalidate(self,metadata):
+        # costs one round trip, but not the download: is the server's copy still the same size and age as the one we cached?
+        size, lastmodified, ranged = RangedDownload(self.url, self.target).probe()
+        if size and size != metadata['size']:
+            return False
+        if lastmodified and metadata.get('lastmodified') and lastmodified != metadata['lastmodified']:
+            return False
+        return True
+    def fetch(self,target):
+        # part files go next to self.target rather than target, which may be a cache temp file, so a re-run can find them and resume
+        download = RangedDownload(self.url, self.target, self.config.get('connections', DOWNLOAD_CONNECTIONS))
+        return download.fetch(target)
+    def strip(self):
+        # read the shapefile straight out of the zip via GDAL's /vsizip/ and write out only the GEOID column in one pass
+        # so there's never an extracted copy nor a second intermediate shapefile on disk
+        unlink_shapefile(os.path.join(self.workdir,"censusblocks_stripped.shp"))
+
+        # the zip's central directory tells us the name of the .shp inside it, which is also the layer name
+        local   = open(self.target, 'rb')
+        members = [ name for name in zipfile.ZipFile(local).namelist() if os.path.splitext(name)[1].lower() == '.shp' ]
+        local.close()
+        if not members:
+            raise IOError("No shapefile found inside %s" % self.target)
+        source = "/vsizip/%s/%s" % ( os.path.abspath(self.target).replace('\\','/'), members[0] )
+        layer  = os.path.splitext(os.path.basename(members[0]))[0]
+
+        # if counties were given, filter to them right here so nothing downstream ever sees the rest of the state
+        where    = ""
+        prefixes = county_geoid_prefixes(self.config)
+        if prefixes:
+            where = " WHERE SUBSTR(BLOCKID10,1,5) IN (%s)" % ",".join([ "'%s'" % prefix for prefix in prefixes ])
+
+        print "    Stripping extraneous fields from polygons in %s" % source
+        session = ogr_session(self.config)
+        count   = session.translate(source, "SELECT BLOCKID10 AS GEOID FROM %s%s" % ( layer, where ), os.path.join(self.workdir,'censusblocks_stripped.shp'))
+        session.close(source)
+        self.counts['features']  = count
+        self.counts['bytesread'] = os.path.getsize(self.target)
+
+        os.unlink(self.target)
+        print "    Ready: censusblocks_stripped.shp, %d blocks" % count
+
+
+class DecennialDownloader:
+    def __init__(self,config):
+        self.workdir = config['workdir']
+        self.transform = FieldTransform(field_spec(config))
+
+        dataset   = "%sblocks" % ( config['state'].lower() )
+        params    = {
+            "sasdset" : dataset,
+            "_PROGRAM" : "websas.dexter.sas",
+            "_SERVICE" : "bigtime",
+            "path" : "/pub/data/sf1%s" % DECENNIAL_YEAR,
+            "view" : "0",
+            "ranksteropt" : "no",
+            "quicklook" : "0",
+            "dlm" : "csv",
+            "lst" : "none",
+            "dbfile" : "none",
+            "fkey1" : "",
+            "op1" : "",
+            "value1" : "",
+            "logic1" : "and",
+            "fkey2" : "",
+            "op2" : "",
+            "value2" : "",
+            "logic2" : "and",
+            "fkey3" : "",
+            "op3" : "",
+            "value3" : "",
+            "logic3" : "and",
+            "fkey4" : "",
+            "op4" : "",
+            "value4" : "",
+            "logic4" : "and",
+            "fkey5" : "",
+            "op5" : "",
+            "value5" : "",
+            "maxobs" : "",
+            "_subtype" : "ph",
+            "varlist" : ",".join([ 'esriid' ] + self.transform.variables),
+            "title2" : "",
+            "subtitle" : " ",
+            "footnote" : " ",
+            "sortby" : "",
+            "_aggby" : "",
+            "_agglvl" : "1",
+            "_grand" : "NO",
+            "_means" : "",
+            "_mweights" : "",
+            "_dropvars" : "_lvl_  _nag_",
+            "rept_byvars" : "",
+            "rept_idvars" : "",
+            "orient" : "portrait",
+            "odsstyle" : "sasweb",
+            "fmtstmt" : "",
+            "renamestmt" : "",
+            "labelstmt" : "",
+            "transby" : "",
+            "transprefix" : "",
+            "transname" : "",
+            "transidlabel" : "",
+            "hasxys" : "1",
+            "haslookupvars" : "1",
+            "hasgeoid" : "0",
+            "latvar" : "IntPtLat",
+            "lonvar" : "IntPtLon",
+            "_y0lat" : "",
+            "_x0long" : "",
+            "_debug" : "",
+            "query" : "",
+        }
+        dexter_county_filter(config, params)
+        self.client  = DexterClient(config.get('dexterurl') or DEXTER_BASE_URL)
+        self.url     = self.client.broker_url(params)
+        self.params  = sorted(params.items())
+        self.batches = dexter_batches(params, zip(self.transform.variables, self.transform.labels), config.get('dexterbatch') or DEXTER_VARLIST_BATCH)
+        self.cache   = open_download_cache(config)
+        self.counts  = {}
+    def main(self):
+        self.download()
+    def fingerprint(self):
+        # the whole query, however the varlist gets split up: the sub-extracts joined back together are the same columns
+        return { 'params':self.params, 'labels':[ 'GEOID' ] + self.transform.labels, 'types':self.types() }
+    def types(self):
+        # each column's type, in the labels' order
+        return [ self.transform.sourcetypes[label] for label in self.transform.labels ]
+    def outputs(self):
+        return [ os.path.join(self.workdir,"decennial_attributes.npy") ]
+    def download(self):
+        # the extract is cached by its query params, which cover the vintage, the state and the varlist
+        # what's cached is the parsed columns rather than Dexter's CSV, hence the 'npy' in the key
+        # and those columns are named and typed by the field spec's source, which isn't in the query, so it's in the key too: relabel a variable and it's a new entry
+        # it's the same whether or not the varlist was split into sub-extracts, so the cache key doesn't say
+        target = os.path.join(self.workdir,"decennial_attributes.npy")
+        if self.cache:
+            self.counts['cachehit'] = self.cache.fetch([self.params,'npy',self.transform.labels,self.types()], target, self.fetch)
+        else:
+            self.fetch(target)
+        print "    Ready: decennial_attributes.npy"
+    def fetch(self,target):
+        # open the URL we figured out earlier; hooray for Dexter allowing both GET and POST !
+        # a long varlist is asked for as several sub-extracts at once, each parsed as it comes in, then joined back together on the GEOID
+        print "    Requesting decennial data from Dexter"
+        print "    %s" % self.url
+        if len(self.batches) > 1:
+            print "    Split into %d sub-extracts of up to %d variables, fetched side by side" % (len(self.batches), len(self.batches[0][1]))
+        counts = [ {} for batch in self.batches ]
+        parts  = self.client.extract_all([ (params, lambda remote, params=params, labels=labels, counts=batchcounts: self.read(remote, params, labels, counts)) for (params,labels),batchcounts in zip(self.batches, counts) ])
+        data   = join_attribute_batches(parts)
+        save_attribute_data(target, data)
+        self.counts['bytesread'] = sum([ batchcounts.get('bytesread', 0) for batchcounts in counts ])
+        self.counts['rows'] = len(data)
+        print "    Parsed %d blocks" % len(data)
+    def read(self,remote,params,labels,counts):
+        # parse an extract as it streams in: skip the first 2 rows (variable names and labels), the rest are the GEOID and counts
+        # the columns are labelled and typed as the field spec says, and saved in NumPy's own format for the merge to load as-is
+        counts.clear()
+        rows = csv.reader(counted_lines(remote, counts))
+        rows.next()
+        rows.next()
+        return read_attribute_rows(rows, 15, labels, "Dexter extract %s" % dexter_extract_name(params.items()), self.transform.sourcetypes)
+
+
+class ACSDownloader:
+    # the ACS tracts dataset is national: Dexter is asked for just the state's tracts (or the counties'), and anything else is dropped while parsing
+    # in case a server (e.g. a mirror, which holds the national extract) doesn't filter
+    # a config with no statefips fetches the national extract, see split_national_acs(); a config with acsfiles uses that state's slice of it
+    # vintage is one of acs_vintages(), by default the run's first (and usually only) one
+    def __init__(self,config,vintage=None):
+        self.workdir = config['workdir']
+        self.config  = config
+        self.vintage = vintage or acs_vintages(config)[0]
+        params = {
+            "sasdset" : "ustracts5yr",
+            "_PROGRAM" : "websas.dexter.sas",
+            "_SERVICE" : "bigtime",
+            "path" : "/pub/data/acs%s" % self.vintage['year'],
+            "view" : "0",
+            "ranksteropt" : "no",
+            "quicklook" : "0",
+            "dlm" : "csv",
+            "lst" : "none",
+            "dbfile" : "none",
+            "fkey1" : "",
+            "op1" : "",
+            "value1" : "",
+            "logic1" : "and",
+            "fkey2" : "",
+            "op2" : "",
+            "value2" : "",
+            "logic2" : "and",
+            "fkey3" : "",
+            "op3" : "",
+            "value3" : "",
+            "logic3" : "and",
+            "fkey4" : "",
+            "op4" : "",
+            "value4" : "",
+            "logic4" : "and",
+            "fkey5" : "",
+            "op5" : "",
+            "value5" : "",
+            "maxobs" : "",
+            "idv" : "esriid",
+            "_subtype" : " ",
+            "v" : "AvgHHInc",
+            "vregexp" : "",
+            "varlist" : "esriid,MedianHHInc",
+            "title2" : "",
+            "subtitle" : " ",
+            "footnote" : " ",
+            "sortby" : "",
+            "_aggby" : "",
+            "_agglvl" : "1",
+            "_grand" : "NO",
+            "_means" : "",
+            "_mweights" : "",
+            "_dropvars" : "_lvl_  _nag_",
+            "rept_byvars" : "",
+            "rept_idvars" : "",
+            "orient" : "portrait",
+            "odsstyle" : "sasweb",
+            "fmtstmt" : "",
+            "renamestmt" : "",
+            "labelstmt" : "",
+            "transby" : "",
+            "transprefix" : "",
+            "transname" : "",
+            "transidlabel" : "",
+            "hasxys" : "1",
+            "haslookupvars" : "1",
+            "hasgeoid" : "1",
+            "latvar" : "IntPtLat",
+            "lonvar" : "IntPtLon",
+            "_y0lat" : "",
+            "_x0long" : "",
+            "_debug" : "",
+            "query" : "",
+        }
+        dexter_county_filter(config, params, statewide=True)
+        self.client  = DexterClient(config.get('dexterurl') or DEXTER_BASE_URL)
+        self.url     = self.client.broker_url(params)
+        self.params  = sorted(params.items())
+        self.batches = [ (params, [ 'MHHINC' ]) ]
+        self.cache   = open_download_cache(config)
+        self.counts  = {}
+    def main(self):
+        self.download()
+    def fingerprint(self):
+        return { 'params':self.params }
+    def outputs(self):
+        return [ os.path.join(self.workdir,self.vintage['filename']) ]
+    def download(self):
+        # the extract is cached by its query params, which cover the vintage, the state and the varlist
+        # what's cached is the parsed columns rather than Dexter's CSV, hence the 'npy' in the key
+        target = os.path.join(self.workdir,self.vintage['filename'])
+        shared = self.config.get('acsfiles', {}).get(self.vintage['stage'])
+        if shared:
+            print "    Using this state's tracts from the shared national extract, %s" % shared
+            link_or_copy(shared, target)
+            self.counts['shared'] = True
+        elif self.cache:
+            self.counts['cachehit'] = self.cache.fetch([self.params,'npy'], target, self.fetch)
+        else:
+            self.fetch(target)
+        print "    Ready: %s" % self.vintage['filename']
+    def fetch(self,target):
+        # open the URL we figured out earlier; hooray for Dexter allowing both GET and POST !
+        print "    Requesting ACS %s data from Dexter" % self.vintage['year']
+        data = self.client.extract(self.batches[0][0], self.read)
+        save_attribute_data(target, data)
+        self.counts['rows'] = len(data)
+        print "    Parsed %d tracts" % len(data)
+    def read(self,remote):
+        # parse the extract as it streams in: skip the first 2 rows (variable names and labels), the rest are the tract ID and income
+        # then saved in NumPy's own format for the merge to load as-is
+        self.counts.pop('bytesread', None)
+        rows = csv.reader(counted_lines(remote, self.counts))
+        rows.next()
+        rows.next()
+        return read_attribute_rows(self.clean(rows), 11, ['MHHINC'], "ACS %s extract %s" % (self.vintage['year'], dexter_extract_name(self.batches[0][0].items())))
+    def clean(self,rows):
+        # fix the rows: dollar values have $ and commas, and nulls are empty cells which botch the math
+        # and keep only the state's tracts (or the counties'), unless this is the national extract
+        prefixes = county_geoid_prefixes(self.config)
+        if not prefixes and self.config.get('statefips'):
+            prefixes = [ self.config['statefips'] ]
+        prefixes = tuple(prefixes or [])
+        for geoid,dollars in rows:
+            if prefixes and not geoid.startswith(prefixes):
+                continue
+            yield [ geoid, dollars.replace('$','').replace(',','') or '0' ]
+
+
+def split_national_acs(states,directory,common,vintage):
+    # multi-state runs: fetch the national ACS tracts extract once, instead of every state fetching its own,
+    # and split it into one columnar file per state for the workers to share; returns the file for each state
+    # that's for one of acs_vintages(); with --acs-years it's done for each of them
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    print "Fetching the national ACS %s tracts extract once, for all %d states" % (vintage['year'], len(states))
+    national = ACSDownloader(dict(common, state='US', statefips=None, countyfips=None, workdir=directory), vintage)
+    national.download()
+
+    data     = numpy.load(os.path.join(directory, vintage['filename']))
+    statekey = data['GEOID'].astype('S2')
+    acsfiles = {}
+    for state in states:
+        acsfiles[state] = os.path.join(directory, '%s_%s.npy' % (os.path.splitext(vintage['filename'])[0], state))
+        save_attribute_data(acsfiles[state], data[ statekey == STATE_FIPS_CODES[state] ])
+    print "Split into %d states' files in %s" % (len(states), directory)
+    print ""
+    return acsfiles
+
+
+class AttributeTable:
+    # a columnar attribute table: one sorted array of GEOIDs as fixed-width bytes, and one int32 NumPy array per field in the same order
+    # a whole batch of GEOIDs is looked up at once with a binary search (searchsorted), instead of one dict lookup per feature,
+    # and there's no small dict per row: a big state's blocks take a few MB instead of a few hundred
+    # each column has an extra row of zeros on the end, which is what a GEOID that isn't in the table gets; see unmatched_keys()
+    def __init__(self,keys,columns):
+        order          = numpy.argsort(keys, kind='mergesort')
+        self.keys      = keys[order]
+        self.columns   = dict([ (name, numpy.concatenate([ values[order], numpy.zeros(1, dtype=values.dtype) ])) for name,values in columns.items() ])
+        self.unmatched = 0
+        self.examples  = []
+    def __len__(self):
+        return len(self.keys)
+    def rows(self,geoids):
+        # the row numbers for an array of GEOIDs; a GEOID that isn't in the table is counted, and pointed at the row of zeros
+        keys  = numpy.asarray(geoids, dtype=self.keys.dtype)
+        rows  = numpy.searchsorted(self.keys, keys)
+        found = rows < len(self.keys)
+        found[found] = self.keys[rows[found]] == keys[found]
+        if not found.all():
+            unmatched_keys(self, keys[~found])
+            rows[~found] = len(self.keys)
+        return rows
+    def column(self,name,rows):
+        return self.columns[name][rows]
+    def close(self):
+        pass
+
+
+class AttributeStream:
+    # the same lookups as AttributeTable, but holding a fixed amount of the attributes in memory however big the state, for --stream-join
+    # only the attribute side is bounded: the blocks are still read through OGR's ORDER BY GEOID, which sorts every block's key in memory,
+    # and the runs are merged a row at a time through heapq, so this trades time for the attributes' memory rather than making the whole merge fixed-size
+    # the .npy is read through a memory map and sorted by GEOID in runs which fit the memory budget, each run spilled to disk as its own .npy
+    # then the runs are merged back together as one stream in GEOID order, and each batch of GEOIDs is merge-joined against it
+    # which only works if the GEOIDs asked for are in order too: BlockMerger reads the blocks ORDER BY GEOID
+    # columns is a function making the output columns from a batch of records, e.g. adding up YOUTH, since there's no whole table to do it to up front
+    def __init__(self,path,prefixes,columns,budget,workdir,rows=None):
+        data           = numpy.load(path, mmap_mode='r')
+        if rows:
+            data = data[rows[0]:rows[1]]
+        self.dtype     = data.dtype
+        self.columns   = columns
+        self.unmatched = 0
+        self.examples  = []
+        self.rundir    = tempfile.mkdtemp(prefix='joinruns', dir=workdir)
+        self.runs      = []
+        self.count     = 0
+
+        # 1 - sort a budget's worth of rows at a time, keeping only the counties asked for if any, and write each run out
+        runrows = max(1, budget / self.dtype.itemsize)
+        for start in range(0, len(data), runrows):
+            run = numpy.array(data[start:start+runrows])
+            if prefixes:
+                width = len(prefixes[0])
+                run   = run[ numpy.in1d(run['GEOID'].astype('S%d' % width), numpy.array(prefixes, dtype='S%d' % width)) ]
+            if not len(run):
+                continue
+            run = run[ numpy.argsort(run['GEOID'], kind='mergesort') ]
+            runpath = os.path.join(self.rundir, 'run%d.npy' % len(self.runs))
+            save_attribute_data(runpath, run)
+            self.runs.append(runpath)
+            self.count += len(run)
+        del data
+
+        # 2 - merge the runs, each read a slice at a time so all of the slices together fit the budget
+        slicerows    = max(1, runrows / max(1, len(self.runs)))
+        self.stream  = heapq.merge(*[ self.read_run(index, runpath, slicerows) for index,runpath in enumerate(self.runs) ])
+        self.current = next(self.stream, None)
+        self.last    = None
+        self.empty   = numpy.zeros(1, dtype=self.dtype)[0]
+    def __len__(self):
+        return self.count
+    def read_run(self,index,runpath,slicerows):
+        # one sorted run's records, as (GEOID, run number, record) so heapq.merge orders by GEOID and never has to compare two records
+        run = numpy.load(runpath, mmap_mode='r')
+        for start in range(0, len(run), slicerows):
+            for record in numpy.array(run[start:start+slicerows]):
+                yield (record['GEOID'], index, record)
+        del run
+    def rows(self,geoids):
+        # the columns for an array of GEOIDs in ascending order, repeats allowed (e.g. every block in a tract)
+        # a GEOID that isn't in the stream is counted and gets zeros
+        records = numpy.zeros(len(geoids), dtype=self.dtype)
+        missing = []
+        for position,geoid in enumerate(geoids):
+            if self.last is not None and geoid < self.last:
+                raise RuntimeError("A streaming join needs GEOIDs in order, but %s came after %s" % (geoid, self.last))
+            self.last = geoid
+            while self.current is not None and self.current[0] < geoid:
+                self.current = next(self.stream, None)
+            if self.current is not None and self.current[0] == geoid:
+                records[position] = self.current[2]
+            else:
+                records[position] = self.empty
+                missing.append(geoid)
+        if missing:
+            unmatched_keys(self, missing)
+        return self.columns(records)
+    def column(self,name,rows):
+        return rows[name]
+    def close(self):
+        # the memory-mapped runs have to be let go of before they can be deleted, on Windows anyway
+        self.stream  = None
+        self.current = None
+        shutil.rmtree(self.rundir, ignore_errors=True)
+
+
+def counted_lines(stream,counts):
+    # the lines of a download, adding up how many bytes went by into counts['bytesread'] for --metrics
+    for line in stream:
+        counts['bytesread'] = counts.get('bytesread', 0) + len(line)
+        yield line
+
+
+class DexterError(IOError):
+    # Dexter answered, but not with anything usable, e.g. a broker page with no extract on it: asking again the same way won't help, so it isn't retried
+    pass
+
+
+class DexterClient:
+    # asks MCDC Dexter's broker for extracts, riding out Dexter being slow and the odd failed request
+    # the broker's page points at the extract's xtract.csv, which is checked for until Dexter has finished writing it;
+    # a page which instead says to come back later, with a meta refresh, is followed once the wait it asks for is up
+    # waiting on an extract is bounded by DEXTER_MAX_WAIT, not by the retries
+    # each extract is handed to a reader function as it streams in; if anything fails on the way, even partway through reading,
+    # the whole extract is asked for again after a wait which doubles each time, up to the retries
+    # except for an HTTP error which isn't Dexter's trouble, e.g. a 400 for a bad query, or a DexterError, which no amount of retrying fixes
+    def __init__(self,dexter,retries=DEXTER_RETRIES,timeout=DEXTER_TIMEOUT):
+        self.dexter  = dexter
+        self.retries = retries
+        self.timeout = timeout
+    def broker_url(self,params):
+        return "%s/cgi-bin/broker?%s" % (self.dexter, urllib.urlencode(params))
+    def extract(self,params,reader):
+        # returns whatever reader(stream) returns for the extract given by the query params
+        for attempt in range(self.retries + 1):
+            try:
+                remote = self.open_extract(params)
+                try:
+                    return reader(remote)
+                finally:
+                    remote.close()
+            except (IOError, socket.error, httplib.HTTPException), e:
+                if not self.retriable(e) or attempt == self.retries:
+                    raise
+                wait = DEXTER_BACKOFF * 2 ** attempt
+                print "    Dexter request failed (%s), trying again in %d seconds" % (e, wait)
+                time.sleep(wait)
+    def extract_all(self,jobs):
+        # several extracts side by side, a thread each: jobs are (params, reader) and the readers' results come back in the same order
+        # if any of them still fails after its retries, so does the lot
+        if len(jobs) == 1:
+            return [ self.extract(*jobs[0]) ]
+        results = [ None ] * len(jobs)
+        errors  = []
+        threads = []
+        for index,(params,reader) in enumerate(jobs):
+            thread = threading.Thread(target=self.extract_into, args=(index,params,reader,results,errors), name=threading.current_thread().name)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.5)
+        if errors:
+            raise errors[0]
+        return results
+    def extract_into(self,index,params,reader,results,errors):
+        try:
+            results[index] = self.extract(params, reader)
+        except Exception, e:
+            errors.append(e)
+    def open_extract(self,params):
+        # ask the broker for the extract, then open its xtract.csv once Dexter has it ready
+        url    = self.broker_url(params)
+        waited = 0
+        while True:
+            remote = urllib2.urlopen(url, timeout=self.timeout)
+            page   = remote.read()
+            remote.close()
+            match  = re.search(r'(/tmpscratch/[\w\.]+/xtract.csv)', page)
+            if match:
+                break
+            refresh = re.search(r'http-equiv=["\']?refresh["\']?[^>]*content=["\']?(\d+)\s*;\s*url=([^"\'>\s]+)', page, re.IGNORECASE)
+            if not refresh:
+                raise DexterError("Dexter's response had no extract in it: %s" % url)
+            url    = urlparse.urljoin(url, refresh.group(2))
+            waited = self.wait(waited, int(refresh.group(1)), url)
+
+        # a 404 is an extract not written yet; so is a hiccup while checking, rather than going back to the broker over it
+        extract = self.dexter + match.group(1)
+        while True:
+            try:
+                remote = urllib2.urlopen(extract, timeout=self.timeout)
+                print "    Ready: %s" % extract
+                return remote
+            except (IOError, socket.error, httplib.HTTPException), e:
+                if not self.retriable(e) and getattr(e, 'code', None) != 404:
+                    raise
+            waited = self.wait(waited, DEXTER_POLL_SECONDS, extract)
+    def wait(self,waited,seconds,url):
+        # wait for Dexter to get on with an extract, unless it's been too long already; returns how long it's been
+        if waited >= DEXTER_MAX_WAIT:
+            raise IOError("Dexter still hadn't finished the extract after %d seconds: %s" % (waited, url))
+        if not waited:
+            print "    Waiting for Dexter to finish the extract"
+        time.sleep(seconds)
+        return waited + seconds
+    def retriable(self,error):
+        # an HTTP error is worth another try if it's the server's trouble, a timeout or being told to slow down
+        # and so is anything else, e.g. a dropped connection, but for a DexterError
+        if isinstance(error, urllib2.HTTPError):
+            return error.code >= 500 or error.code in (408, 429)
+        return not isinstance(error, DexterError)
+
+
+def dexter_batches(params,columns,size):
+    # split an extract's varlist into sub-extracts of at most size variables, each also asking for esriid to join them back together on
+    # columns are the (variable, label) pairs in the varlist; returns the query params and the labels for each sub-extract
+    # a varlist which fits is the one extract as it was
+    if len(columns) <= size:
+        return [ (params, [ label for variable,label in columns ]) ]
+    batches = []
+    for start in range(0, len(columns), size):
+        batch = columns[start:start+size]
+        batches.append( (dict(params, varlist=",".join([ 'esriid' ] + [ variable for variable,label in batch ])), [ label for variable,label in batch ]) )
+    return batches
+
+
+def dexter_extract_name(params):
+    # the name a Dexter extract is kept under in a --prefetch mirror, and looked up by in ServeMirror.py: the dataset and a hash of the query
+    # the filter slot is left out, since the mirror holds whole-state extracts (and the national ACS extract)
+    # and the state or counties are filtered again when the attributes are read
+    params = sorted([ (key,value) for key,value in params if key not in ('fkey1','op1','value1') ])
+    return "%s_%s" % (dict(params)['sasdset'], hashlib.sha1(urllib.urlencode(params)).hexdigest()[:16])
+
+
+def unmatched_keys(table,keys):
+    # count GEOIDs which a table had no attributes for, and keep the first few distinct ones for the report at the end of the merge
+    table.unmatched += len(keys)
+    for key in keys:
+        if len(table.examples) >= UNMATCHED_EXAMPLES:
+            break
+        if key not in table.examples:
+            table.examples.append(key)
+
+
+def attribute_table(config,filename,columns):
+    # the table a merger joins against: by default all in memory as an AttributeTable,
+    # or with --stream-join an AttributeStream which sorts the attributes on disk and holds only STREAM_JOIN_MEMORY (or --join-memory-mb) of them at a time
+    # a --merge-workers process is given where its county's rows are in a sorted copy of the file instead, see attribute_slices(), so it reads only those
+    path     = os.path.join(config['workdir'], filename)
+    prefixes = county_geoid_prefixes(config)
+    rows     = None
+    if filename in config.get('attributeslices', {}):
+        path, rows = config['attributeslices'][filename]
+        prefixes   = None
+    if config.get('streamjoin'):
+        print "    Sorting %s on disk for a streaming join" % filename
+        return AttributeStream(path, prefixes, columns, config.get('joinmemory', STREAM_JOIN_MEMORY), config['workdir'], rows)
+    print "    Loading %s into memory" % filename
+    data = load_attribute_data(path, prefixes, rows)
+    return AttributeTable(data['GEOID'], columns(data))
+
+
+def read_attribute_rows(rows,keywidth,fieldnames,source='the attributes',types=None):
+    # turn rows of text (a GEOID, then some numbers) into columns, e.g. straight from a csv.reader on a Dexter extract as it downloads
+    # returns a NumPy record array, with a GEOID column of fixed-width bytes and a column for each of the fieldnames,
+    # int32 unless types (a dict of fieldname to NumPy type) says otherwise, e.g. f8 for a source the field spec says is real
+    # rows are taken in chunks and each chunk's numbers are parsed by NumPy in one go, which is a lot quicker than int() per cell
+    # and means only one chunk's worth of Python strings exist at a time
+    # a row that isn't all numbers, or has a fraction in an integer column, is an IOError saying which row of source (e.g. the extract) it was
+    types  = types or {}
+    dtype  = [ ('GEOID','S%d' % keywidth) ] + [ (name, types.get(name, 'i4')) for name in fieldnames ]
+    chunks = []
+    keys   = []
+    values = []
+    first  = 1
+    for row in rows:
+        if len(row) != len(dtype):
+            raise IOError("%s: row %d has %d columns, not %d" % (source, first + len(keys), len(row), len(dtype)))
+        keys.append(row[0])
+        values.append(",".join(row[1:]))
+        if len(keys) == ATTRIBUTE_CHUNK_ROWS:
+            chunks.append( attribute_chunk(keys, values, dtype, source, first) )
+            first += len(keys)
+            keys   = []
+            values = []
+    chunks.append( attribute_chunk(keys, values, dtype, source, first) )
+    return numpy.concatenate(chunks)
+
+
+def join_attribute_batches(parts):
+    # join sub-extracts' columns, each from read_attribute_rows, back together on the GEOID, in the rows' order in the first
+    # they're all extracts of the same rows, so one with a different number of rows or a GEOID missing came back wrong
+    data = parts[0]
+    for part in parts[1:]:
+        order = numpy.argsort(part['GEOID'])
+        found = order[ numpy.minimum(numpy.searchsorted(part['GEOID'], data['GEOID'], sorter=order), max(len(part) - 1, 0)) ] if len(part) else order
+        if len(part) != len(data) or not numpy.array_equal(part['GEOID'][found], data['GEOID']):
+            raise IOError("Dexter's sub-extracts didn't have the same blocks in them: %d rows and %d rows" % (len(data), len(part)))
+        joined = numpy.zeros(len(data), dtype=data.dtype.descr + part.dtype.descr[1:])
+        for name in data.dtype.names:
+            joined[name] = data[name]
+        for name in part.dtype.names[1:]:
+            joined[name] = part[name][found]
+        data = joined
+    return data
+
+
+def attribute_chunk(keys,values,dtype,source,first):
+    # one chunk of rows as a record array: the GEOIDs as given, and the comma-separated numbers parsed all together
+    # parsed as floating point, so a fraction in an integer column is seen rather than cut off, then each column as its own type
+    # NumPy stops quietly at the first cell it can't parse, so too few numbers means a bad cell somewhere; first is the chunk's first row number
+    chunk = numpy.zeros(len(keys), dtype=dtype)
+    chunk['GEOID'] = keys
+    if keys:
+        width   = len(dtype) - 1
+        numbers = numpy.fromstring(",".join(values), dtype='f8', sep=',')
+        if len(numbers) != len(keys) * width:
+            bad_attribute_row(keys, values, dtype, source, first)
+        numbers = numbers.reshape(len(keys), width)
+        for index,(name,kind) in enumerate(dtype[1:]):
+            column = numbers[:,index]
+            if kind != 'f8':
+                fractions = numpy.flatnonzero(column != numpy.floor(column))
+                if len(fractions):
+                    row = fractions[0]
+                    raise IOError("%s: row %d (GEOID %s) has %s for %s, which should be a whole number" % (source, first + row, keys[row], values[row].split(',')[index], name))
+            chunk[name] = column
+    return chunk
+
+
+def bad_attribute_row(keys,values,dtype,source,first):
+    # find the cell of a chunk which NumPy couldn't parse, and say where it was
+    for row,value in enumerate(values):
+        for (name,kind),cell in zip(dtype[1:], value.split(',')):
+            try:
+                float(cell)
+            except ValueError:
+                raise IOError("%s: row %d (GEOID %s) has %r for %s, which isn't a number" % (source, first + row, keys[row], cell, name))
+    raise IOError("%s: couldn't read the numbers in rows %d to %d" % (source, first, first + len(keys) - 1))
+
+
+def save_attribute_data(path,data):
+    # NumPy's .npy format: compact, and loading it is just reading it back in, no parsing
+    # written through a file object, since numpy.save would tack .npy onto a filename which doesn't already end with it
+    # and as a new file, since the old one may be linked to a cache entry or shared by other states; see unlink_file()
+    unlink_file(path)
+    output = open(path, 'wb')
+    numpy.save(output, data)
+    output.close()
+
+
+def load_attribute_data(path,prefixes=None,rows=None):
+    # load columns saved by save_attribute_data, keeping only the rows which start with one of the GEOID prefixes (counties) if given
+    # or only the rows from rows[0] up to rows[1], e.g. one county's from attribute_slices()
+    # either way the file is memory-mapped, so only the rows kept are read into memory
+    data = numpy.load(path, mmap_mode='r' if prefixes or rows else None)
+    if rows:
+        return numpy.array(data[rows[0]:rows[1]])
+    if prefixes:
+        width = len(prefixes[0])
+        data  = data[ numpy.in1d(data['GEOID'].astype('S%d' % width), numpy.array(prefixes, dtype='S%d' % width)) ]
+    return data
+
+
+def attribute_slices(path,prefixes,sortedpath):
+    # for --merge-workers: where each county's rows are, so each process reads only its own rather than filtering the whole file
+    # the file is sorted by GEOID once, into sortedpath, unless it already is; then each county's rows are the ones between two binary searches
+    # returns the sorted file's path, and { prefix : (first row, row after the last) }
+    data = numpy.load(path, mmap_mode='r')
+    keys = data['GEOID']
+    if len(keys) > 1 and (keys[1:] < keys[:-1]).any():
+        save_attribute_data(sortedpath, data[ numpy.argsort(keys, kind='mergesort') ])
+        path = sortedpath
+        data = numpy.load(path, mmap_mode='r')
+        keys = data['GEOID']
+    counties = keys.astype('S%d' % len(prefixes[0]))
+    wanted   = numpy.array(prefixes, dtype=counties.dtype)
+    starts   = numpy.searchsorted(counties, wanted, side='left').tolist()
+    stops    = numpy.searchsorted(counties, wanted, side='right').tolist()
+    del data, keys
+    return path, dict(zip(prefixes, zip(starts, stops)))
+
+
+class FieldTransform:
+    # a field spec (see DECENNIAL_FIELD_SPEC) compiled once into a transform over whole columns
+    # each expression is checked against the spec's labels and compiled to Python bytecode up front, then evaluated once per batch
+    # (or once for a whole in-memory table) with every label standing for a NumPy column, so a derived field costs one more array operation
+    # per batch, not more Python per feature; a copy of a label is just the column itself
+    # a bad spec raises ValueError, saying which field and why; that includes a field name used twice, or taken by GEOID, BLOCKS or the ACS fields (MHHINC...),
+    # or longer than maxname if it's given, e.g. SHAPEFILE_FIELD_NAME_LENGTH when the output is a shapefile
+
+    # one token of an expression: a label, a number, or an operator or parenthesis, with any spaces around it
+    TOKEN = re.compile(r'\s*(?:([A-Za-z_]\w*)|(\d+(?:\.\d*)?|\.\d+)|([-+*/()]))\s*')
+
+    def __init__(self,spec,maxname=None):
+        self.variables   = [ source[0] for source in spec['source'] ]
+        self.labels      = [ source[1] for source in spec['source'] ]
+        self.sourcetypes = {}
+        self.fields      = []
+        for source in spec['source']:
+            label = source[1]
+            if not re.match(r'^[A-Za-z_]\w*$', label) or label == 'GEOID':
+                raise ValueError("Bad label %s in the field spec; labels are letters, digits and underscores, and not GEOID" % label)
+            kind = source[2] if len(source) > 2 else 'integer'
+            if kind not in ('integer', 'real'):
+                raise ValueError("Source %s has unknown type %s; use integer or real" % (label, kind))
+            self.sourcetypes[label] = FIELD_TYPES[kind][0]
+        for name, kind, expression in spec['fields']:
+            if name in [ field[0] for field in self.fields ]:
+                raise ValueError("Field %s is in the field spec twice" % name)
+            if name in ('GEOID', 'BLOCKS') or name.startswith('MHHINC'):
+                raise ValueError("Field %s would clash with the blocks' GEOID, the rollups' BLOCKS or the ACS fields' MHHINC; give it another name" % name)
+            if maxname and len(name) > maxname:
+                raise ValueError("Field %s is longer than a shapefile's %d characters for a field name; give it a shorter one" % (name, maxname))
+            if kind not in FIELD_TYPES:
+                raise ValueError("Field %s has unknown type %s; use one of %s" % (name, kind, ", ".join(sorted(FIELD_TYPES.keys()))))
+            if expression in self.labels:
+                self.fields.append( (name, kind, expression, None, None) )
+                continue
+            # compiled with true division as if from __future__, so 1/3 is a third as the comment on __call__ says, and not 0
+            used = self.check_expression(name, expression)
+            try:
+                code = compile(expression, '<field %s>' % name, 'eval', __future__.division.compiler_flag)
+            except SyntaxError, error:
+                raise ValueError("Field %s's expression isn't valid arithmetic: %s (%s)" % (name, expression, error.msg))
+            self.fields.append( (name, kind, None, code, used) )
+        self.names     = [ field[0] for field in self.fields ]
+        self.sumfields = [ field[0] for field in self.fields if field[1] == 'count' ]
+
+    def check_expression(self,name,expression):
+        # only labels, numbers, arithmetic and parentheses are allowed, so the compiled expression can't do anything but sums
+        # and each token has to be able to follow the one before: no ** or // (Python's power and floor division), no label right after a label,
+        # and no ( right after a label, which Python would take as a call; anything else unbalanced is left for compile() to find
+        # returns the labels the expression uses
+        used     = []
+        position = 0
+        previous = None
+        while position < len(expression):
+            token = self.TOKEN.match(expression, position)
+            if not token:
+                raise ValueError("Field %s's expression has something other than labels, numbers and + - * / ( ) at: %s" % (name, expression[position:]))
+            operand      = token.group(1) or token.group(2)
+            symbol       = token.group(3)
+            afteroperand = previous in ('operand', ')')
+            if operand and afteroperand or symbol == '(' and afteroperand or symbol in ('*', '/', ')') and not afteroperand:
+                raise ValueError("Field %s's expression has something out of place at: %s" % (name, expression[token.start():].strip()))
+            previous = 'operand' if operand else symbol
+            identifier = token.group(1)
+            if identifier and identifier not in self.labels:
+                raise ValueError("Field %s's expression uses %s, which isn't one of the spec's source labels" % (name, identifier))
+            if identifier and identifier not in used:
+                used.append(identifier)
+            position = token.end()
+        if not used:
+            raise ValueError("Field %s's expression uses none of the spec's source labels" % name)
+        return used
+
+    def __call__(self,data):
+        # the output columns from a record array of source columns, as a dict of name to column
+        # expressions are worked in floating point, so / is true division, and a row which divided by zero comes out as 0
+        columns = {}
+        for name, kind, label, code, used in self.fields:
+            dtype = FIELD_TYPES[kind][0]
+            if label:
+                columns[name] = data[label].astype(dtype)
+                continue
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                values = eval(code, { '__builtins__':{} }, dict([ (source, data[source].astype('f8')) for source in used ]))
+            values = numpy.where(numpy.isfinite(values), values, 0)
+            if dtype != 'f8':
+                values = numpy.rint(values)
+            columns[name] = values.astype(dtype)
+        return columns
+
+    def create_fields(self,layer):
+        for name, kind, label, code, used in self.fields:
+            layer.CreateField( ogr.FieldDefn(name, getattr(ogr, FIELD_TYPES[kind][1])) )
+
+
+def field_spec(config):
+    # the run's decennial field spec: from --field-spec, or DECENNIAL_FIELD_SPEC
+    return config.get('fieldspec') or DECENNIAL_FIELD_SPEC
+
+
+def rollup_sum_fields(config):
+    # the fields --rollups adds up, being the spec's counts; with the total population first, as the rollups have always had it
+    return sorted(FieldTransform(field_spec(config)).sumfields, key=lambda name: name != 'TOTPOP')
+
+
+class ACSMerger():
+    # one ACS vintage's MHHINC, or with --acs-years its year-suffixed field e.g. MHHINC18; see acs_vintages()
+    def __init__(self,config,vintage):
+        self.workdir = config['workdir']
+        self.name    = 'ACS%s' % (vintage['year'] if vintage['suffix'] else '')
+        self.field   = 'MHHINC' + vintage['suffix']
+
+        # load the ACS columns keyed by tract ID
+        self.table  = attribute_table(config, vintage['filename'], self.columns)
+        self.counts = { 'rows':len(self.table), 'bytesread':os.path.getsize(os.path.join(self.workdir,vintage['filename'])), 'joinseconds':0.0, 'lookups':0 }
+        print "    Loaded %d tracts" % len(self.table)
+
+    def columns(self,data):
+        return { self.field:data['MHHINC'] }
+
+    def join(self,geoids):
+        # the tract-ID is the first 11 characters of the GEOID, we can key from that: casting to 11-byte strings truncates them all at once
+        rows = self.table.rows( geoids.astype('S11') )
+        return [ (self.field, self.table.column(self.field, rows)) ]
+
+
+class DecennialMerger():
+    # the decennial fields, as the run's field spec says; see FieldTransform
+    def __init__(self,config):
+        self.workdir   = config['workdir']
+        self.name      = 'decennial'
+        self.transform = FieldTransform(field_spec(config))
+
+        # load the decennial columns keyed by block ID
+        self.table  = attribute_table(config, 'decennial_attributes.npy', self.columns)
+        self.counts = { 'rows':len(self.table), 'bytesread':os.path.getsize(os.path.join(self.workdir,'decennial_attributes.npy')), 'joinseconds':0.0, 'lookups':0 }
+        print "    Loaded %d blocks" % len(self.table)
+
+    def columns(self,data):
+        # the output fields, derived ones like YOUTH included, are made for every block (or every block in the batch) at once
+        return self.transform(data)
+
+    def join(self,geoids):
+        rows = self.table.rows(geoids)
+        return [ (name, self.table.column(name, rows)) for name in self.transform.names ]
+
+class BlockMerger():
+    # the one merge stage: ACSMerger and DecennialMerger each load their attributes, create_fields() defines every output field up front,
+    # then this reads censusblocks_stripped.shp once and writes the output with every field defined up front and filled in on the way through
+    # rather than opening the shapefile in update mode and rewriting every feature once per set of attributes
+    # the output is whichever of OUTPUT_FORMATS was asked for, with its spatial index; see output_path()
+    # and with --rollups the blocks are added up into block groups, tracts and counties on the way through; see BlockRollups
+    def __init__(self,config):
+        self.config  = config
+        self.workdir = config['workdir']
+        self.format  = config.get('format', OUTPUT_FORMAT)
+        self.target  = output_path(config)
+        self.counts  = {}
+
+        # a tileset is cut from a GeoPackage of the merged blocks, which is removed once the tiles are made
+        self.written = self.target
+        self.writeformat = self.format
+        if self.format in TILE_FORMATS:
+            self.written = os.path.join(self.workdir, 'censusblocks_tiling.gpkg')
+            self.writeformat = 'gpkg'
+
+    def fingerprint(self):
+        fingerprint = { 'format':self.format, 'counties':county_geoid_prefixes(self.config), 'labels':DECENNIAL_FIELD_LABELS }
+        if self.config.get('fieldspec'):
+            fingerprint['fieldspec'] = self.config['fieldspec']
+        if self.config.get('acsyears'):
+            fingerprint['acsyears'] = self.config['acsyears']
+        if self.config.get('rollups'):
+            fingerprint['rollups'] = { 'levels':sorted(self.config['rollups']), 'geometry':bool(self.config.get('rollupgeometry')), 'fields':rollup_sum_fields(self.config) }
+        return fingerprint
+
+    def outputs(self):
+        outputs = shapefile_files(self.target) if self.format == 'shapefile' else [ self.target ]
+        if self.config.get('rollups'):
+            outputs.extend( BlockRollups(self.config, self.written).outputs() )
+        return outputs
+
+    def main(self):
+        # loading the attributes is left until now, so the manifest can check whether we need to without paying for it
+        # with --metrics, loading each merger's attributes is measured as a stage of its own, and so is the time spent joining against them
+        # with --merge-workers the counties are merged side by side in a pool of processes instead, each loading its own attributes; see merge_partitioned()
+        self.rollups = BlockRollups(self.config, self.written) if self.config.get('rollups') else None
+        workers      = self.config.get('mergeworkers') or 1
+        partitions   = self.partitions() if workers > 1 and not multiprocessing.current_process().daemon else []
+        if len(partitions) > 1:
+            self.joins = self.merge_partitioned(partitions, workers)
+        else:
+            self.mergers = [ measure_stage(self.config, 'merge.%s' % vintage['stage'], lambda vintage=vintage: ACSMerger(self.config, vintage)) for vintage in acs_vintages(self.config) ]
+            self.mergers.append( measure_stage(self.config, 'merge.decennial', lambda: DecennialMerger(self.config)) )
+            try:
+                self.merge()
+            finally:
+                for merger in self.mergers:
+                    merger.table.close()
+            self.joins = [ join_summary(merger) for merger in self.mergers ]
+        if self.rollups:
+            measure_stage(self.config, 'merge.rollups', self.rollups.main, self.rollups)
+        if self.format in TILE_FORMATS:
+            tiler = VectorTiler(self.config, self.written, self.target)
+            measure_stage(self.config, 'merge.tiles', tiler.main, tiler)
+            unlink_dataset(self.written)
+        metrics = self.config.get('stagemetrics')
+        if metrics:
+            for join in self.joins:
+                metrics.record('merge.%s.join' % join['name'].lower(), join['joinseconds'], None, { 'rows':join['lookups'] })
+
+        # blocks which had no attributes were given zeros rather than stopping the merge; say how many and which
+        for join in self.joins:
+            if join['unmatched']:
+                print "    WARNING: %d blocks had no %s attributes, e.g. %s" % (join['unmatched'], join['name'], ", ".join(join['examples']))
+
+    def merge(self,fids=None):
+        # with fids, only those blocks of the stripped shapefile in that order, and no indexes: one county of merge_partitioned()
+        if fids is None:
+            print "    Assigning ACS and decennial fields to records in %s" % os.path.basename(self.written)
+
+        # 1 - open the stripped shapefile for reading, in GEOID order so each county's blocks end up next to each other in the output
+        # (and so a streaming join can merge-join them against the sorted attributes) and create the output with GEOID plus every merger's fields
+        session  = ogr_session(self.config)
+        stripped = os.path.join(self.workdir,'censusblocks_stripped.shp')
+        if fids is None:
+            layer    = session.query(stripped, 'SELECT * FROM censusblocks_stripped ORDER BY GEOID')
+            features = iter(layer.GetNextFeature, None)
+        else:
+            layer    = session.open(stripped).GetLayer(0)
+            features = ( layer.GetFeature(fid) for fid in fids )
+
+        output, outlayer = self.create_output(layer.GetSpatialRef())
+        self.create_fields(outlayer, layer.GetLayerDefn().GetFieldDefn( layer.GetLayerDefn().GetFieldIndex('GEOID') ))
+        outdefn = outlayer.GetLayerDefn()
+
+        # 2 - then iterate over all records, writing each one once with all of its attributes
+        # features are handled in batches: each batch's GEOIDs are joined against the attribute tables all at once,
+        # then written and committed together, which matters for formats that do transactions and costs nothing for those that don't
+        count = 0
+        batch = []
+        for feature in features:
+            batch.append(feature)
+            if len(batch) == MERGE_TRANSACTION_SIZE:
+                count += self.write_batch(outlayer, outdefn, batch)
+                batch = []
+        count += self.write_batch(outlayer, outdefn, batch)
+        if fids is None:
+            session.release(stripped, layer)
+
+        # 3 - indexes, then done; the stripped shapefile is kept, so a re-run which only changes attributes doesn't need the polygons again
+        if fids is None:
+            self.index_output(output)
+        output.Destroy()
+        self.counts['features']  = count
+        self.counts['bytesread'] = sum([ os.path.getsize(path) for path in shapefile_files(stripped) ])
+        if fids is None:
+            print "    Merged %d blocks into %s" % (count, os.path.basename(self.written))
+
+    def partitions(self):
+        # for --merge-workers: the stripped shapefile's blocks split up by county, as (county, FIDs in GEOID order), biggest county first
+        # so the pool isn't left waiting on one big county at the end; only the GEOIDs are read for this, not the polygons
+        session  = ogr_session(self.config)
+        stripped = os.path.join(self.workdir,'censusblocks_stripped.shp')
+        layer    = session.open(stripped).GetLayer(0)
+        layer.SetIgnoredFields([ 'OGR_GEOMETRY' ])
+        layer.ResetReading()
+        blocks  = []
+        feature = layer.GetNextFeature()
+        while feature:
+            blocks.append( (feature.GetField('GEOID'), feature.GetFID()) )
+            feature = layer.GetNextFeature()
+        layer.SetIgnoredFields([])
+        blocks.sort()
+
+        counties = {}
+        for geoid,fid in blocks:
+            counties.setdefault(geoid[:5], []).append(fid)
+        return sorted(counties.items(), key=lambda county: -len(county[1]))
+
+    def merge_partitioned(self,partitions,workers):
+        # --merge-workers: each county is joined and written to a piece of its own by a pool process, see merge_partition()
+        # then the pieces are copied into the output one after another in county order, so it comes out just as a merge in one go would
+        # the pieces are GeoPackages, unless the output is a shapefile anyway, so they don't cut field names to 10 characters or write reals as DBF text;
+        # and the output's fields are defined just as merge() defines them, not copied from a piece
+        # that copy is the one part left running on one core, and it's only reading and writing features, no joins
+        # returns the joins' summaries added up over every county, as join_summary() would give for a merge in one go
+        print "    Assigning ACS and decennial fields to records in %s, %d counties %d at a time" % (os.path.basename(self.written), len(partitions), workers)
+        config    = dict([ (key,value) for key,value in self.config.items() if key not in ('ogrsession', 'stagemetrics') ])
+        piecesdir = tempfile.mkdtemp(prefix='mergeparts', dir=self.workdir)
+        try:
+            # each attribute file's rows split up by county once here, and each process given only where its own county's are
+            counties = [ county for county,fids in partitions ]
+            slices   = {}
+            for filename in [ vintage['filename'] for vintage in acs_vintages(self.config) ] + [ 'decennial_attributes.npy' ]:
+                slices[filename] = attribute_slices(os.path.join(self.workdir, filename), counties, os.path.join(piecesdir, filename))
+            countyslices = lambda county: dict([ (filename, (path, rows[county])) for filename,(path,rows) in slices.items() ])
+
+            pieceformat = 'shapefile' if self.writeformat == 'shapefile' else 'gpkg'
+            jobs    = [ (dict(config, attributeslices=countyslices(county)), county, fids, os.path.join(piecesdir, 'part%s%s' % (county, OUTPUT_FORMATS[pieceformat][1])), pieceformat) for county,fids in partitions ]
+            results = sorted(pool_map(merge_partition, jobs, workers), key=lambda result: result[0])
+
+            output = None
+            count  = 0
+            for county, path, written, joins, rollups in results:
+                piece = ogr.Open(path, 0)
+                layer = piece.GetLayer(0)
+                if output is None:
+                    output, outlayer = self.create_output(layer.GetSpatialRef())
+                    self.create_fields(outlayer, layer.GetLayerDefn().GetFieldDefn( layer.GetLayerDefn().GetFieldIndex('GEOID') ))
+                    outdefn = outlayer.GetLayerDefn()
+                count += self.copy_features(layer, outlayer, outdefn)
+                piece.Destroy()
+            self.index_output(output)
+            output.Destroy()
+        finally:
+            shutil.rmtree(piecesdir, ignore_errors=True)
+
+        # the counties' joins and rollups, put together
+        summaries = []
+        for county, path, written, joins, rollups in results:
+            for join in joins:
+                total = [ summary for summary in summaries if summary['name'] == join['name'] ]
+                if not total:
+                    summaries.append( dict(join, examples=list(join['examples'])) )
+                    continue
+                total = total[0]
+                total['joinseconds'] += join['joinseconds']
+                total['lookups']     += join['lookups']
+                total['unmatched']   += join['unmatched']
+                total['examples'].extend([ example for example in join['examples'] if example not in total['examples'] ])
+                del total['examples'][UNMATCHED_EXAMPLES:]
+            if self.rollups:
+                for name,parts in rollups.items():
+                    self.rollups.parts[name].extend(parts)
+
+        stripped = os.path.join(self.workdir,'censusblocks_stripped.shp')
+        self.counts['features']  = count
+        self.counts['bytesread'] = sum([ os.path.getsize(path) for path in shapefile_files(stripped) ])
+        print "    Merged %d blocks into %s" % (count, os.path.basename(self.written))
+        return summaries
+
+    def create_output(self,srs):
+        # a new, empty output dataset and its layer, in the format being written, for the caller to add fields to
+        # the layer is MultiPolygon, like the rollups', rather than the stripped shapefile's Polygon: OGR reads TIGER's multipart blocks as MultiPolygons,
+        # which FlatGeobuf refuses in a Polygon layer and GeoPackage writes only with a warning; so every block's geometry is forced to MultiPolygon on the way in
+        drivername, extension, options = OUTPUT_FORMATS[self.writeformat]
+        unlink_dataset(self.written)
+        driver   = ogr.GetDriverByName(drivername)
+        output   = driver.CreateDataSource(self.written)
+        outlayer = output.CreateLayer('censusblocks', srs, ogr.wkbMultiPolygon, options)
+        return output, outlayer
+
+    def create_fields(self,outlayer,geoidfield):
+        # the output's fields: the blocks' GEOID, then each ACS vintage's MHHINC and the field spec's fields, the order the mergers' joins come in
+        # worked out from the config rather than from loaded mergers, so merge_partitioned() defines the output just as merge() does
+        outlayer.CreateField(geoidfield)
+        for vintage in acs_vintages(self.config):
+            outlayer.CreateField( ogr.FieldDefn('MHHINC' + vintage['suffix'], ogr.OFTInteger) )
+        FieldTransform(field_spec(self.config), SHAPEFILE_FIELD_NAME_LENGTH if self.writeformat == 'shapefile' else None).create_fields(outlayer)
+
+    def index_output(self,output):
+        index_dataset(output, self.writeformat, 'censusblocks')
+
+    def copy_features(self,layer,outlayer,outdefn):
+        # every feature of a merged piece into the output, committed in batches like write_batch(); returns how many
+        count = 0
+        outlayer.StartTransaction()
+        feature = layer.GetNextFeature()
+        while feature:
+            outfeat = ogr.Feature(outdefn)
+            outfeat.SetFrom(feature)
+            if feature.GetGeometryRef() is not None:
+                outfeat.SetGeometry( ogr.ForceToMultiPolygon(feature.GetGeometryRef()) )
+            outlayer.CreateFeature(outfeat)
+            count += 1
+            if count % MERGE_TRANSACTION_SIZE == 0:
+                outlayer.CommitTransaction()
+                outlayer.StartTransaction()
+            feature = layer.GetNextFeature()
+        outlayer.CommitTransaction()
+        return count
+
+    def write_batch(self,outlayer,outdefn,batch):
+        geoids  = numpy.array([ feature.GetField("GEOID") for feature in batch ], dtype='S15')
+        columns = []
+        for merger in self.mergers:
+            started = time.time()
+            columns.extend( merger.join(geoids) )
+            merger.counts['joinseconds'] += time.time() - started
+            merger.counts['lookups']     += len(geoids)
+
+        # with --rollups, the batch is added into the block groups, tracts and counties while it's still in columns
+        if self.rollups:
+            self.rollups.add(geoids, dict(columns))
+        columns = [ (name, values.tolist()) for name,values in columns ]
+
+        outlayer.StartTransaction()
+        for position,feature in enumerate(batch):
+            outfeat = ogr.Feature(outdefn)
+            if feature.GetGeometryRef() is not None:
+                outfeat.SetGeometry( ogr.ForceToMultiPolygon(feature.GetGeometryRef()) )
+            outfeat.SetField("GEOID", feature.GetField("GEOID"))
+            for name,values in columns:
+                outfeat.SetField(name, values[position])
+            outlayer.CreateFeature(outfeat)
+        outlayer.CommitTransaction()
+        return len(batch)
+
+
+def index_dataset(output,outputformat,layername):
+    # GeoPackage and FlatGeobuf build their spatial index as part of the layer, via the creation options
+    # a shapefile gets a .qix spatial index, and a GEOID attribute index for county extracts; GeoPackage gets that GEOID index too
+    # a shapefile's layer is named after its file, e.g. censusblocks_optimized; a GeoPackage's is always censusblocks
+    if outputformat == 'shapefile':
+        output.ExecuteSQL('CREATE SPATIAL INDEX ON %s' % layername)
+        output.ExecuteSQL('CREATE INDEX ON %s USING GEOID' % layername)
+    elif outputformat == 'gpkg':
+        output.ExecuteSQL('CREATE INDEX censusblocks_geoid ON censusblocks (GEOID)')
+
+
+def merge_partition(job):
+    # one county of BlockMerger.merge_partitioned(), in a pool process: load only that county's attributes, then join its blocks
+    # and write them into a piece of its own in the given format, without indexes since it'll just be copied into the output
+    # returns (county, path, blocks written, join_summary() for each merger, the county's rollup partial sums if --rollups)
+    config, county, fids, target, pieceformat = job
+    config = dict(config, countyfips=[ county[2:] ])
+
+    # each county's messages about loading its attributes would only be jumbled up with every other process's; the merge reports for the whole state
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        merger = BlockMerger(config)
+        merger.written     = target
+        merger.writeformat = pieceformat
+        merger.rollups     = BlockRollups(config, None) if config.get('rollups') else None
+        merger.mergers     = [ ACSMerger(config, vintage) for vintage in acs_vintages(config) ] + [ DecennialMerger(config) ]
+        try:
+            merger.merge(fids)
+        finally:
+            for attributes in merger.mergers:
+                attributes.table.close()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return (county, target, merger.counts['features'], [ join_summary(attributes) for attributes in merger.mergers ], merger.rollups.parts if merger.rollups else {})
+
+
+def join_summary(merger):
+    # what one merger's joins came to, for --metrics and the warning about blocks without attributes
+    # as plain values, so a --merge-workers process can send it back to be added up
+    return {
+        'name':merger.name,
+        'joinseconds':merger.counts['joinseconds'],
+        'lookups':merger.counts['lookups'],
+        'unmatched':merger.table.unmatched,
+        'examples':list(merger.table.examples),
+    }
+
+
+class BlockRollups:
+    # --rollups: block groups, tracts and counties added up from the blocks as they go through the merge, rather than by a separate job afterward
+    # each batch of blocks is grouped by GEOID prefix in one go with NumPy (unique, then bincount) into partial sums,
+    # and at the end the partial sums are grouped once more, since an area's blocks can straddle two batches
+    # MHHINC (or each vintage's, with --acs-years) is taken once per tract from what the ACS join gave its blocks, which is the tract's own value
+    # the blocks keep their copy of it too, since the Mapper colours blocks by it and the tiles carry it; see the README
+    # with --rollup-geometry each area's blocks are dissolved into its polygon too, one county per job in a pool of processes; see dissolve_county()
+    def __init__(self,config,source):
+        self.config   = config
+        self.source   = source
+        self.levels   = [ level for level in ROLLUP_LEVELS if level[0] in config['rollups'] ]
+        self.geometry = config.get('rollupgeometry')
+        self.parts    = dict([ (level[0], []) for level in self.levels ])
+        self.acsfields = [ 'MHHINC' + vintage['suffix'] for vintage in acs_vintages(config) ]
+        self.sumfields = rollup_sum_fields(config)
+        self.counts   = {}
+
+    def add(self,geoids,columns):
+        # one batch of blocks: their GEOIDs, and a dict of the joined columns
+        for name, width, basename in self.levels:
+            keys, first, inverse = numpy.unique(geoids.astype('S%d' % width), return_index=True, return_inverse=True)
+            sums = { 'BLOCKS':numpy.bincount(inverse, minlength=len(keys)) }
+            for field in self.sumfields:
+                sums[field] = numpy.bincount(inverse, weights=columns[field], minlength=len(keys)).astype('i8')
+            if name == 'tract':
+                for field in self.acsfields:
+                    sums[field] = columns[field][first]
+            self.parts[name].append( (keys, sums) )
+
+    def totals(self,name):
+        # one level's partial sums from every batch, grouped into one row per area: the areas' GEOIDs, and a dict of columns
+        # no batches at all, e.g. counties asked for which have no blocks, is no areas rather than an error
+        if not self.parts[name]:
+            width  = [ level[1] for level in self.levels if level[0] == name ][0]
+            fields = [ 'BLOCKS' ] + self.sumfields + (self.acsfields if name == 'tract' else [])
+            return numpy.zeros(0, dtype='S%d' % width), dict([ (field, numpy.zeros(0, dtype='i8')) for field in fields ])
+        keys = numpy.concatenate([ part[0] for part in self.parts[name] ])
+        areas, first, inverse = numpy.unique(keys, return_index=True, return_inverse=True)
+        totals = {}
+        for field in self.parts[name][0][1].keys():
+            values = numpy.concatenate([ part[1][field] for part in self.parts[name] ])
+            if field in self.acsfields:
+                totals[field] = values[first]
+            else:
+                totals[field] = numpy.bincount(inverse, weights=values, minlength=len(areas)).astype('i8')
+        return areas, totals
+
+    def main(self):
+        # 1 - with --rollup-geometry, dissolve the polygons: one job per county, each returning its areas' polygons at every level
+        shapes = dict([ (level[0], {}) for level in self.levels ])
+        if self.geometry:
+            counties = numpy.unique( self.totals(self.levels[0][0])[0].astype('S5') )
+            jobs     = [ (self.source, county, [ level[:2] for level in self.levels ]) for county in counties ]
+            print "    Dissolving blocks into %s for %d counties" % (", ".join([ level[0] for level in self.levels ]), len(jobs))
+            for dissolved in pool_map(dissolve_county, jobs, multiprocessing.cpu_count()):
+                for name,polygons in dissolved.items():
+                    shapes[name].update(polygons)
+
+        # 2 - write each level out, with how many blocks went into each area
+        self.counts['rows'] = 0
+        for name, width, basename in self.levels:
+            areas, totals = self.totals(name)
+            fields = [ 'BLOCKS' ] + self.sumfields + (self.acsfields if name == 'tract' else [])
+            path   = rollup_path(self.config, basename)
+            if self.geometry:
+                self.write_dataset(path, basename, width, areas, totals, fields, shapes[name])
+            else:
+                self.write_csv(path, areas, totals, fields)
+            self.counts['rows'] += len(areas)
+            print "    Rolled up %d %s areas into %s" % (len(areas), name, os.path.basename(path))
+
+    def outputs(self):
+        outputs = []
+        for name, width, basename in self.levels:
+            path = rollup_path(self.config, basename)
+            outputs.extend( shapefile_files(path) if path.endswith('.shp') else [ path ] )
+        return outputs
+
+    def write_csv(self,path,areas,totals,fields):
+        columns  = [ areas.tolist() ] + [ totals[field].tolist() for field in fields ]
+        csvwrite = open(path, 'wb')
+        csvoutput = csv.writer(csvwrite)
+        csvoutput.writerow([ 'GEOID' ] + fields)
+        csvoutput.writerows(zip(*columns))
+        csvwrite.close()
+
+    def write_dataset(self,path,layername,width,areas,totals,fields,polygons):
+        # same format, projection and indexes as the blocks; see BlockMerger.merge()
+        datasource   = ogr.Open(self.source, 0)
+        srs          = datasource.GetLayer(0).GetSpatialRef()
+        rollupformat = rollup_format(self.config)
+        drivername, extension, options = OUTPUT_FORMATS[rollupformat]
+
+        unlink_dataset(path)
+        output = ogr.GetDriverByName(drivername).CreateDataSource(path)
+        layer  = output.CreateLayer(layername, srs, ogr.wkbMultiPolygon, options)
+        geoidfield = ogr.FieldDefn('GEOID', ogr.OFTString)
+        geoidfield.SetWidth(width)
+        layer.CreateField(geoidfield)
+        for field in fields:
+            layer.CreateField( ogr.FieldDefn(field, ogr.OFTInteger) )
+        defn    = layer.GetLayerDefn()
+        columns = dict([ (field, totals[field].tolist()) for field in fields ])
+
+        layer.StartTransaction()
+        for position,geoid in enumerate(areas.tolist()):
+            feature = ogr.Feature(defn)
+            if geoid in polygons:
+                feature.SetGeometry( ogr.ForceToMultiPolygon(ogr.CreateGeometryFromWkb(polygons[geoid])) )
+            feature.SetField('GEOID', geoid)
+            for field in fields:
+                feature.SetField(field, columns[field][position])
+            layer.CreateFeature(feature)
+        layer.CommitTransaction()
+
+        if rollupformat == 'shapefile':
+            output.ExecuteSQL('CREATE SPATIAL INDEX ON %s' % layername)
+        elif rollupformat == 'gpkg':
+            output.ExecuteSQL('CREATE INDEX %s_geoid ON %s (GEOID)' % (layername, layername))
+        output.Destroy()
+        datasource.Destroy()
+
+
+def dissolve_county(job):
+    # one job of BlockRollups with --rollup-geometry, in a pool process: dissolve one county's blocks into its areas at each level
+    # the finest level is dissolved from the blocks, and each coarser one from the level below it, so a county is the union of a few dozen tracts
+    # rather than of thousands of blocks; returns { level name : { GEOID : WKB } }
+    source, county, levels = job
+    ogr.UseExceptions()
+
+    # the county's blocks, by a GEOID range so the GEOID index can be used: ~ sorts after every digit
+    datasource = ogr.Open(source, 0)
+    layer      = datasource.GetLayer(0)
+    layer.SetAttributeFilter("GEOID >= '%s' AND GEOID < '%s~'" % (county, county))
+    pieces  = {}
+    feature = layer.GetNextFeature()
+    while feature:
+        geometry = feature.GetGeometryRef()
+        if geometry is not None:
+            pieces[ feature.GetField('GEOID') ] = geometry.Clone()
+        feature = layer.GetNextFeature()
+    datasource.Destroy()
+
+    dissolved = {}
+    for name,width in sorted(levels, key=lambda level: -level[1]):
+        grouped = {}
+        for geoid,geometry in pieces.items():
+            grouped.setdefault(geoid[:width], []).append(geometry)
+        pieces = dict([ (geoid, union_geometries(geometries)) for geoid,geometries in grouped.items() ])
+        dissolved[name] = dict([ (geoid, geometry.ExportToWkb()) for geoid,geometry in pieces.items() ])
+    return dissolved
+
+
+def union_geometries(geometries):
+    # dissolve polygons into one: gathered into a multipolygon and unioned all at once, which is a lot quicker than one pair at a time
+    if len(geometries) == 1:
+        return geometries[0]
+    collection = ogr.Geometry(ogr.wkbMultiPolygon)
+    for geometry in geometries:
+        if ogr.GT_Flatten(geometry.GetGeometryType()) == ogr.wkbMultiPolygon:
+            for index in range(geometry.GetGeometryCount()):
+                collection.AddGeometry( geometry.GetGeometryRef(index) )
+        else:
+            collection.AddGeometry(geometry)
+    return collection.UnionCascaded()
+
+
+class BlockOptimizer:
+    # --optimize: a slimmer copy of the merged blocks to ship to the mapper, written alongside them as censusblocks_optimized (plus the format's extension)
+    # - a shapefile's DBF fields are only as wide as the widest value each one holds, rather than OGR's default of 9 or 10 characters for every integer
+    # - coordinates are rounded to --optimize-precision decimal places, and the vertices which that lands on top of the one before are dropped
+    # - with --empty-blocks, the blocks where TOTPOP is 0 are dropped, or merged into one feature per tract whose GEOID is the tract's,
+    #   so extracts by GEOID prefix still find them; the count fields are summed, and the rest (e.g. MHHINC, which is per tract anyway) are the first block's
+    # it reports the bytes saved, for the attributes and the geometry apart where it's a shapefile, and how long reading every feature took before and after
+    # rounding can leave a polygon touching itself where two vertices met; that's so of any quantization, and the mapper draws it just the same
+    def __init__(self,config):
+        self.config    = config
+        self.format    = config.get('format', OUTPUT_FORMAT)
+        self.source    = output_path(config)
+        self.target    = optimized_path(config)
+        self.precision = config.get('precision', OPTIMIZE_PRECISION)
+        self.empty     = config.get('emptyblocks') or 'keep'
+        self.sumfields = rollup_sum_fields(config)
+        self.counts    = {}
+
+    def fingerprint(self):
+        return { 'format':self.format, 'precision':self.precision, 'emptyblocks':self.empty, 'fields':self.sumfields }
+
+    def outputs(self):
+        return shapefile_files(self.target) if self.format == 'shapefile' else [ self.target ]
+
+    def main(self):
+        print "    Optimizing %s into %s" % (os.path.basename(self.source), os.path.basename(self.target))
+        before = dataset_sizes(self.source)
+        loadbefore, blocks = load_seconds(self.source)
+        self.counts.update({ 'rows':blocks, 'features':0, 'bytesread':before['total'], 'vertices':0, 'verticeskept':0, 'dropped':0, 'merged':0 })
+
+        datasource = ogr.Open(self.source, 0)
+        layer      = datasource.GetLayer(0)
+        defn       = layer.GetLayerDefn()
+        if self.empty != 'keep' and defn.GetFieldIndex('TOTPOP') < 0:
+            raise ValueError("--empty-blocks %s needs a TOTPOP field, and the field spec doesn't have one" % self.empty)
+        widths, order = self.scan(layer) if self.format == 'shapefile' or self.empty == 'merge' else ({}, None)
+        layer.ResetReading()
+
+        # the fields as they were, only narrower where the values allow
+        drivername, extension, options = OUTPUT_FORMATS[self.format]
+        unlink_dataset(self.target)
+        output   = ogr.GetDriverByName(drivername).CreateDataSource(self.target)
+        outlayer = output.CreateLayer('censusblocks', layer.GetSpatialRef(), ogr.wkbMultiPolygon, options)
+        for index in range(defn.GetFieldCount()):
+            fielddefn = defn.GetFieldDefn(index)
+            field     = ogr.FieldDefn(fielddefn.GetName(), fielddefn.GetType())
+            field.SetWidth( widths.get(fielddefn.GetName(), fielddefn.GetWidth()) )
+            field.SetPrecision( fielddefn.GetPrecision() )
+            outlayer.CreateField(field)
+        outdefn = outlayer.GetLayerDefn()
+
+        # the blocks as they come, which is GEOID order straight from the merge; if they aren't, e.g. a FlatGeobuf with a spatial index
+        # is in the order of the index, --empty-blocks merge fetches them one at a time in GEOID order, so the output stays in GEOID order too
+        # and each tract's empty blocks come one after another: they're held only until the tract is done, then merged and written after its other blocks
+        features = iter(layer.GetNextFeature, None) if order is None else ( layer.GetFeature(fid) for fid in order )
+        empties  = []
+        outlayer.StartTransaction()
+        for feature in features:
+            if empties and feature.GetField('GEOID')[:11] != empties[0].GetField('GEOID')[:11]:
+                self.write(outlayer, self.merge_empty(empties, outdefn))
+                empties = []
+            if self.empty != 'keep' and feature.GetField('TOTPOP') == 0:
+                self.counts['dropped'] += 1
+                if self.empty == 'merge':
+                    empties.append(feature)
+            else:
+                outfeat = ogr.Feature(outdefn)
+                outfeat.SetFrom(feature)
+                self.write(outlayer, outfeat)
+        if empties:
+            self.write(outlayer, self.merge_empty(empties, outdefn))
+        outlayer.CommitTransaction()
+        index_dataset(output, self.format, os.path.splitext(os.path.basename(self.target))[0] if self.format == 'shapefile' else 'censusblocks')
+        output.Destroy()
+        datasource.Destroy()
+
+        after = dataset_sizes(self.target)
+        loadafter, features = load_seconds(self.target)
+        self.report(before, after, loadbefore, loadafter)
+        metrics = self.config.get('stagemetrics')
+        if metrics:
+            metrics.record('optimize.load.before', loadbefore, None, { 'features':blocks }, 0)
+            metrics.record('optimize.load.after', loadafter, None, { 'features':features }, 0)
+
+    def scan(self,layer):
+        # one pass over the blocks without their geometry, for how wide each integer and string field needs to be for the values it holds
+        # with --empty-blocks merge that includes each tract's sums, which are what the merged features will hold,
+        # and the FIDs in GEOID order if the blocks aren't in it already (or None if they are), kept as arrays rather than a Python object per block
+        defn   = layer.GetLayerDefn()
+        names  = [ defn.GetFieldDefn(index).GetName() for index in range(defn.GetFieldCount()) if defn.GetFieldDefn(index).GetType() in (ogr.OFTInteger, ogr.OFTString) ]
+        widths = dict([ (name, 1) for name in names ])
+        sums   = {}
+        if self.empty == 'merge':
+            count  = layer.GetFeatureCount()
+            geoids = numpy.zeros(count, dtype='S15')
+            fids   = numpy.zeros(count, dtype='i8')
+        scanned = 0
+        ordered = True
+        layer.SetIgnoredFields([ 'OGR_GEOMETRY' ])
+        feature = layer.GetNextFeature()
+        while feature:
+            if self.empty == 'merge':
+                geoids[scanned] = feature.GetField('GEOID')
+                fids[scanned]   = feature.GetFID()
+                ordered = ordered and (not scanned or geoids[scanned] >= geoids[scanned-1])
+                scanned += 1
+            for name in names:
+                value = feature.GetField(name)
+                if value is not None:
+                    widths[name] = max(widths[name], len(str(value)))
+            if self.empty == 'merge' and feature.GetField('TOTPOP') == 0:
+                tract = sums.setdefault(feature.GetField('GEOID')[:11], {})
+                for name in self.sumfields:
+                    tract[name] = tract.get(name, 0) + (feature.GetField(name) or 0)
+            feature = layer.GetNextFeature()
+        layer.SetIgnoredFields([])
+        for tract in sums.values():
+            for name,value in tract.items():
+                if name in widths:
+                    widths[name] = max(widths[name], len(str(value)))
+        if self.empty != 'merge' or ordered:
+            return widths, None
+        return widths, fids[ numpy.argsort(geoids[:scanned], kind='mergesort') ].tolist()
+
+    def merge_empty(self,features,outdefn):
+        # one tract's empty blocks as one feature: their polygons dissolved, the counts summed, and the tract's GEOID
+        outfeat = ogr.Feature(outdefn)
+        outfeat.SetFrom(features[0])
+        outfeat.SetField('GEOID', features[0].GetField('GEOID')[:11])
+        for name in self.sumfields:
+            outfeat.SetField(name, sum([ feature.GetField(name) or 0 for feature in features ]))
+        geometries = [ feature.GetGeometryRef() for feature in features if feature.GetGeometryRef() is not None ]
+        if geometries:
+            outfeat.SetGeometry( union_geometries(geometries) )
+        self.counts['merged'] += 1
+        return outfeat
+
+    def write(self,outlayer,outfeat):
+        # round the feature's coordinates and write it, committing every so many like the merge does
+        # as a MultiPolygon, like the merge's output, since a tract's empty blocks dissolved together are often more than one polygon
+        geometry = outfeat.GetGeometryRef()
+        if geometry is not None:
+            wkb, vertices, kept = quantize_wkb(ogr.ForceToMultiPolygon(geometry).ExportToWkb(ogr.wkbNDR), self.precision)
+            self.counts['vertices']     += vertices
+            self.counts['verticeskept'] += kept
+            outfeat.SetGeometryDirectly( ogr.CreateGeometryFromWkb(wkb) )
+        outlayer.CreateFeature(outfeat)
+        self.counts['features'] += 1
+        if self.counts['features'] % MERGE_TRANSACTION_SIZE == 0:
+            outlayer.CommitTransaction()
+            outlayer.StartTransaction()
+
+    def report(self,before,after,loadbefore,loadafter):
+        print "    %-11s %10s %10s %7s" % ("", "before MB", "after MB", "saved")
+        for part in ('attributes', 'geometry', 'indexes', 'total'):
+            if part in before:
+                saved = 100.0 * (before[part] - after[part]) / before[part] if before[part] else 0
+                print "    %-11s %10.1f %10.1f %6.1f%%" % (part, before[part]/1048576.0, after[part]/1048576.0, saved)
+        print "    Blocks: %d in, %d out" % (self.counts['rows'], self.counts['features'])
+        if self.empty == 'merge':
+            print "    %d empty blocks merged into %d features, one per tract" % (self.counts['dropped'], self.counts['merged'])
+        elif self.empty == 'drop':
+            print "    %d empty blocks dropped" % self.counts['dropped']
+        print "    Vertices: %d, %d after rounding to %d decimal places" % (self.counts['vertices'], self.counts['verticeskept'], self.precision)
+        print "    Reading every feature: %.2f s before, %.2f s after" % (loadbefore, loadafter)
+
+
+def quantize_wkb(wkb,digits):
+    # round a polygon's or multipolygon's coordinates to so many decimal places, working on its little-endian WKB a ring at a time with NumPy
+    # returns the new WKB, and how many vertices there were before and after; anything else comes back as it was
+    order, kind = struct.unpack_from('<BI', wkb, 0)
+    if order != 1 or kind not in (ogr.wkbPolygon, ogr.wkbMultiPolygon):
+        return wkb, 0, 0
+    if kind == ogr.wkbPolygon:
+        polygon, offset, vertices, kept = quantize_polygon(wkb, 0, digits)
+        return polygon, vertices, kept
+    count    = struct.unpack_from('<I', wkb, 5)[0]
+    offset   = 9
+    parts    = []
+    vertices = 0
+    kept     = 0
+    for index in range(count):
+        polygon, offset, before, after = quantize_polygon(wkb, offset, digits)
+        parts.append(polygon)
+        vertices += before
+        kept     += after
+    return struct.pack('<BII', 1, ogr.wkbMultiPolygon, count) + ''.join(parts), vertices, kept
+
+
+def quantize_polygon(wkb,offset,digits):
+    # one polygon of quantize_wkb(), starting at offset: each ring rounded, then rid of any vertex which rounded onto the one before it
+    # a hole left with too few vertices to be a ring was smaller than the rounding and is dropped; an outer ring like that is left unrounded
+    # returns the polygon's new WKB, the offset just past it, and the vertices before and after
+    rings    = struct.unpack_from('<I', wkb, offset + 5)[0]
+    offset  += 9
+    parts    = []
+    vertices = 0
+    kept     = 0
+    for index in range(rings):
+        points  = struct.unpack_from('<I', wkb, offset)[0]
+        coords  = numpy.frombuffer(wkb, dtype='<f8', count=points * 2, offset=offset + 4).reshape(points, 2)
+        offset += 4 + points * 16
+        rounded = numpy.round(coords, digits)
+        keep    = numpy.ones(points, dtype=bool)
+        keep[1:] = (rounded[1:] != rounded[:-1]).any(axis=1)
+        rounded = rounded[keep]
+        vertices += points
+        if len(rounded) < 4:
+            if index:
+                continue
+            rounded = coords
+        kept += len(rounded)
+        parts.append( struct.pack('<I', len(rounded)) + rounded.astype('<f8').tostring() )
+    return struct.pack('<BII', 1, ogr.wkbPolygon, len(parts)) + ''.join(parts), offset, vertices, kept
+
+
+def dataset_sizes(path):
+    # a dataset's size on disk, and for a shapefile how much of that is the attributes (.dbf), the geometry (.shp and .shx) and the indexes and the rest
+    if os.path.splitext(path)[1] != '.shp':
+        return { 'total':os.path.getsize(path) }
+    sizes = { 'attributes':0, 'geometry':0, 'indexes':0, 'total':0 }
+    for filename in shapefile_files(path):
+        extension = os.path.splitext(filename)[1]
+        part = 'attributes' if extension == '.dbf' else 'geometry' if extension in ('.shp', '.shx') else 'indexes'
+        sizes[part]    += os.path.getsize(filename)
+        sizes['total'] += os.path.getsize(filename)
+    return sizes
+
+
+def load_seconds(path):
+    # how long reading every feature of a dataset takes, its geometry and attributes both, the way the mapper loading it would; and how many there were
+    # both sides of BlockOptimizer's comparison were just written, so they're as likely as each other to be in the OS's file cache
+    started    = time.time()
+    datasource = ogr.Open(path, 0)
+    layer      = datasource.GetLayer(0)
+    defn       = layer.GetLayerDefn()
+    names      = [ defn.GetFieldDefn(index).GetName() for index in range(defn.GetFieldCount()) ]
+    count      = 0
+    feature    = layer.GetNextFeature()
+    while feature:
+        geometry = feature.GetGeometryRef()
+        if geometry is not None:
+            geometry.ExportToWkb()
+        for name in names:
+            feature.GetField(name)
+        count  += 1
+        feature = layer.GetNextFeature()
+    datasource.Destroy()
+    return time.time() - started, count
+
+
+class VectorTiler:
+    # --format mbtiles or pmtiles: cut the merged blocks into a serve-ready vector tileset, rather than leaving a shapefile for a separate tiling job
+    # the tiles themselves are made by GDAL's MBTiles (MVT) writer, which reprojects to web mercator, clips and simplifies;
+    # the work is split into jobs and run in a pool of processes: each of TILE_ZOOM_BANDS is one job for the low zooms,
+    # and for the high zooms one job per tile at TILE_PARTITION_ZOOM, each reading only its own blocks via the GeoPackage's spatial index
+    # then the pieces are put together into one MBTiles, keeping from each regional job only the tiles inside its own region
+    # and for PMTiles that's re-packed by write_pmtiles()
+    def __init__(self,config,source,target):
+        self.config  = config
+        self.source  = source
+        self.target  = target
+        self.format  = config.get('format', OUTPUT_FORMAT)
+        self.workers = config.get('tileworkers') or multiprocessing.cpu_count()
+        self.counts  = {}
+
+    def main(self):
+        datasource = ogr.Open(self.source, 0)
+        layer      = datasource.GetLayer(0)
+        west, east, south, north = layer.GetExtent()
+        defn       = layer.GetLayerDefn()
+        fieldtypes = dict([ (defn.GetFieldDefn(index).GetName(), defn.GetFieldDefn(index).GetType()) for index in range(defn.GetFieldCount()) ])
+        datasource.Destroy()
+
+        # 1 - the jobs: (band, region) where the region is a tile at TILE_PARTITION_ZOOM, or None for the whole state
+        piecesdir = tempfile.mkdtemp(prefix='tiles', dir=self.config['workdir'])
+        jobs = []
+        for band in TILE_ZOOM_BANDS:
+            if band[0] < TILE_PARTITION_ZOOM:
+                regions = [ None ]
+            else:
+                left, top     = lonlat_to_tile(TILE_PARTITION_ZOOM, west, north)
+                right, bottom = lonlat_to_tile(TILE_PARTITION_ZOOM, east, south)
+                regions = [ (x,y) for x in range(left, right + 1) for y in range(top, bottom + 1) ]
+            for region in regions:
+                jobs.append( (self.source, os.path.join(piecesdir, 'piece%d.mbtiles' % len(jobs)), band, region) )
+        print "    Tiling zooms %d to %d in %d pieces, %d at a time" % (TILE_ZOOM_BANDS[0][0], TILE_ZOOM_BANDS[-1][1], len(jobs), self.workers)
+
+        # 2 - run them
+        pieces = []
+        try:
+            pieces = pool_map(tile_piece, jobs, self.workers)
+
+            # 3 - put the pieces together, with metadata describing every field any zoom has, then PMTiles if that's what was asked for
+            mbtiles = self.target if self.format == 'mbtiles' else os.path.join(piecesdir, 'merged.mbtiles')
+            unlink_dataset(self.target)
+            metadata = tileset_metadata(fieldtypes, (west, south, east, north))
+            tiles    = merge_tile_pieces(mbtiles, pieces, metadata)
+            if self.format == 'pmtiles':
+                write_pmtiles(mbtiles, self.target, metadata)
+        finally:
+            shutil.rmtree(piecesdir, ignore_errors=True)
+
+        self.counts['features'] = sum([ piece[2] for piece in pieces ])
+        self.counts['rows']     = tiles
+        print "    Wrote %d tiles into %s; %d small blocks left out of low zooms" % (tiles, os.path.basename(self.target), sum([ piece[3] for piece in pieces ]))
+
+
+def tile_piece(job):
+    # one job of a VectorTiler, in a pool process: one zoom band's tiles, for one region or the whole state, into its own small MBTiles
+    # the blocks are thinned for the band: only its fields, and blocks smaller than its minimum area (in pixels at its lowest zoom) left out
+    # returns (path, region, blocks written, blocks left out)
+    source, target, band, region = job
+    minzoom, maxzoom, fields, simplification, minpixels = band
+    ogr.UseExceptions()
+
+    datasource = ogr.Open(source, 0)
+    layer      = datasource.GetLayer(0)
+    if region:
+        # a margin around the region, so blocks just over its edge still make it into the tile buffers of the tiles along it
+        west, south, east, north = tile_bounds(TILE_PARTITION_ZOOM, region[0], region[1])
+        margin = (east - west) * 0.05
+        layer.SetSpatialFilterRect(west - margin, south - margin, east + margin, north + margin)
+    # a band's MHHINC stands for every vintage's with --acs-years, e.g. MHHINC13 and MHHINC18
+    defn    = layer.GetLayerDefn()
+    names   = [ defn.GetFieldDefn(index).GetName() for index in range(defn.GetFieldCount()) ]
+    if fields:
+        names = [ name for name in names if name in fields or name.rstrip('0123456789') in fields ]
+    pixel   = 360.0 / (256 * 2 ** minzoom)
+    minarea = minpixels * pixel * pixel
+
+    options = [ 'MINZOOM=%d' % minzoom, 'MAXZOOM=%d' % maxzoom, 'SIMPLIFICATION=%s' % simplification, 'NAME=censusblocks' ]
+    output  = ogr.GetDriverByName('MBTiles').CreateDataSource(target, options=options)
+    outlayer = output.CreateLayer('censusblocks', layer.GetSpatialRef(), layer.GetGeomType(), [ 'MINZOOM=%d' % minzoom, 'MAXZOOM=%d' % maxzoom ])
+    for name in names:
+        outlayer.CreateField( defn.GetFieldDefn(defn.GetFieldIndex(name)) )
+    outdefn = outlayer.GetLayerDefn()
+
+    written = 0
+    skipped = 0
+    feature = layer.GetNextFeature()
+    while feature:
+        geometry = feature.GetGeometryRef()
+        if minarea and geometry is not None and geometry.GetArea() < minarea:
+            skipped += 1
+        else:
+            outfeature = ogr.Feature(outdefn)
+            outfeature.SetGeometry(geometry)
+            for name in names:
+                outfeature.SetField(name, feature.GetField(name))
+            outlayer.CreateFeature(outfeature)
+            written += 1
+        feature = layer.GetNextFeature()
+
+    # the tiles are actually made when the dataset is closed
+    output.Destroy()
+    datasource.Destroy()
+    return (target, region, written, skipped)
+
+
+def pool_map(function,jobs,workers):
+    # run a function over a list of jobs in a pool of processes, returning the results in whatever order they finish
+    # a batch-mode worker is itself a pool process and isn't allowed a pool of its own, so there they run one after another
+    if workers < 2 or multiprocessing.current_process().daemon:
+        return [ function(job) for job in jobs ]
+    results = []
+    pool = multiprocessing.Pool(processes=workers)
+    try:
+        for result in pool.imap_unordered(function, jobs):
+            results.append(result)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return results
+
+
+def lonlat_to_tile(zoom,lon,lat):
+    # the web mercator (XYZ) tile containing a point
+    lat   = max(-85.0511, min(85.0511, lat))
+    scale = 2 ** zoom
+    x     = int((lon + 180.0) / 360.0 * scale)
+    y     = int((1.0 - math.log(math.tan(math.radians(lat)) + 1.0 / math.cos(math.radians(lat))) / math.pi) / 2.0 * scale)
+    return min(max(x, 0), scale - 1), min(max(y, 0), scale - 1)
+
+
+def tile_bounds(zoom,x,y):
+    # west, south, east, north of a web mercator (XYZ) tile, in degrees
+    scale = 2.0 ** zoom
+    def latitude(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / scale))))
+    return x / scale * 360.0 - 180.0, latitude(y + 1), (x + 1) / scale * 360.0 - 180.0, latitude(y)
+
+
+def tileset_metadata(fieldtypes,bounds):
+    # the MBTiles metadata, which PMTiles carries too: the bounds, zooms, and the one layer with every field any zoom band has
+    west, south, east, north = bounds
+    minzoom = TILE_ZOOM_BANDS[0][0]
+    maxzoom = TILE_ZOOM_BANDS[-1][1]
+    fields  = dict([ (name, "String" if fieldtype == ogr.OFTString else "Number") for name,fieldtype in fieldtypes.items() ])
+    return {
+        'name':'censusblocks',
+        'description':'Census blocks with decennial and ACS attributes',
+        'format':'pbf',
+        'type':'overlay',
+        'minzoom':str(minzoom),
+        'maxzoom':str(maxzoom),
+        'bounds':"%f,%f,%f,%f" % (west, south, east, north),
+        'center':"%f,%f,%d" % ((west + east) / 2, (south + north) / 2, (minzoom + maxzoom) / 2),
+        'json':json.dumps({ 'vector_layers':[ { 'id':'censusblocks', 'fields':fields, 'minzoom':minzoom, 'maxzoom':maxzoom } ] }),
+    }
+
+
+def merge_tile_pieces(target,pieces,metadata):
+    # put the pieces' tiles into one MBTiles; a piece for a region only contributes the tiles inside that region,
+    # since the blocks over its edge make partial tiles there which the neighbouring region's piece has in full
+    # MBTiles rows are TMS, counted from the bottom, hence the flip to compare with the region's XYZ row; returns how many tiles there are
+    unlink_dataset(target)
+    database = sqlite3.connect(target)
+    database.execute('CREATE TABLE metadata (name TEXT, value TEXT)')
+    database.execute('CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)')
+    database.executemany('INSERT INTO metadata (name, value) VALUES (?, ?)', sorted(metadata.items()))
+    database.commit()
+    for path, region, written, skipped in pieces:
+        database.execute('ATTACH DATABASE ? AS piece', (path,))
+        if region is None:
+            database.execute('INSERT INTO tiles SELECT zoom_level, tile_column, tile_row, tile_data FROM piece.tiles')
+        else:
+            database.execute('''INSERT INTO tiles SELECT zoom_level, tile_column, tile_row, tile_data FROM piece.tiles
+                WHERE (tile_column >> (zoom_level - ?)) = ? AND ((((1 << zoom_level) - 1 - tile_row)) >> (zoom_level - ?)) = ?''',
+                (TILE_PARTITION_ZOOM, region[0], TILE_PARTITION_ZOOM, region[1]))
+        database.commit()
+        database.execute('DETACH DATABASE piece')
+    database.execute('CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row)')
+    database.commit()
+    count = database.execute('SELECT COUNT(*) FROM tiles').fetchone()[0]
+    database.close()
+    return count
+
+
+def write_pmtiles(mbtiles,target,metadata):
+    # re-pack an MBTiles of gzipped MVT tiles as a PMTiles (version 3) archive: one file which a web server can serve with Range requests
+    # the tiles are laid out in Hilbert tile ID order, identical tiles are stored once, and consecutive repeats share one directory entry
+    # the directory goes in the first 16 KB if it fits, otherwise it's split into leaf directories
+    database = sqlite3.connect(mbtiles)
+    tileids  = sorted([ (pmtiles_tileid(zoom, column, (1 << zoom) - 1 - row), zoom, column, row) for zoom,column,row in database.execute('SELECT zoom_level, tile_column, tile_row FROM tiles') ])
+
+    # 1 - the tile data, into a temporary file next to the target, and the entries pointing into it: [tileid, offset, length, runlength]
+    tiledata = open(target + '.tiledata', 'w+b')
+    entries  = []
+    offsets  = {}
+    length   = 0
+    for tileid, zoom, column, row in tileids:
+        data   = str(database.execute('SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?', (zoom, column, row)).fetchone()[0])
+        digest = hashlib.sha1(data).digest()
+        if digest not in offsets:
+            offsets[digest] = (length, len(data))
+            tiledata.write(data)
+            length += len(data)
+        offset, size = offsets[digest]
+        if entries and entries[-1][0] + entries[-1][3] == tileid and entries[-1][1] == offset:
+            entries[-1][3] += 1
+        else:
+            entries.append([ tileid, offset, size, 1 ])
+    database.close()
+
+    # 2 - the directories, then the header which says where everything is
+    root, leaves = pmtiles_directories(entries)
+    meta    = gzip_bytes(json.dumps(metadata))
+    zooms   = [ tileid[1] for tileid in tileids ] or [ 0 ]
+    west, south, east, north = [ float(value) for value in metadata['bounds'].split(',') ]
+    centerlon, centerlat, centerzoom = [ float(value) for value in metadata['center'].split(',') ]
+    header  = struct.pack('<7sB', 'PMTiles', 3)
+    header += struct.pack('<QQQQQQQQQQQ', 127, len(root), 127 + len(root), len(meta), 127 + len(root) + len(meta), len(leaves),
+                          127 + len(root) + len(meta) + len(leaves), length, len(tileids), len(entries), len(offsets))
+    header += struct.pack('<BBBBBB', 1, 2, 2, 1, min(zooms), max(zooms))
+    header += struct.pack('<iiii', int(west * 10000000), int(south * 10000000), int(east * 10000000), int(north * 10000000))
+    header += struct.pack('<Bii', int(centerzoom), int(centerlon * 10000000), int(centerlat * 10000000))
+
+    output = open(target, 'wb')
+    output.write(header)
+    output.write(root)
+    output.write(meta)
+    output.write(leaves)
+    tiledata.seek(0)
+    shutil.copyfileobj(tiledata, output)
+    output.close()
+    tiledata.close()
+    os.unlink(target + '.tiledata')
+
+
+def pmtiles_tileid(zoom,x,y):
+    # PMTiles' tile ID: all the tiles of lower zooms, then the tile's position along the Hilbert curve at its own zoom
+    tileid = ((1 << (2 * zoom)) - 1) / 3
+    size   = 1 << zoom
+    step   = size / 2
+    while step > 0:
+        rx = 1 if x & step else 0
+        ry = 1 if y & step else 0
+        tileid += step * step * ((3 * rx) ^ ry)
+        if ry == 0:
+            if rx == 1:
+                x = size - 1 - x
+                y = size - 1 - y
+            x, y = y, x
+        step /= 2
+    return tileid
+
+
+def pmtiles_directories(entries):
+    # the root directory, and the leaf directories if the root would be too big with every entry in it
+    # leaves start at 4096 entries each and double until the root which points at them fits alongside the header in 16 KB
+    root = pmtiles_directory(entries)
+    if len(root) <= 16384 - 127:
+        return root, ''
+    leafsize = 4096
+    while True:
+        leaves  = ''
+        pointers = []
+        for start in range(0, len(entries), leafsize):
+            leaf = pmtiles_directory(entries[start:start+leafsize])
+            pointers.append([ entries[start][0], len(leaves), len(leaf), 0 ])
+            leaves += leaf
+        root = pmtiles_directory(pointers)
+        if len(root) <= 16384 - 127:
+            return root, leaves
+        leafsize *= 2
+
+
+def pmtiles_directory(entries):
+    # one directory, gzipped: the count, then the tile IDs as deltas, run lengths, lengths, and offsets (0 meaning straight after the previous tile)
+    parts = [ pmtiles_varint(len(entries)) ]
+    last  = 0
+    for tileid, offset, length, runlength in entries:
+        parts.append(pmtiles_varint(tileid - last))
+        last = tileid
+    parts.extend([ pmtiles_varint(entry[3]) for entry in entries ])
+    parts.extend([ pmtiles_varint(entry[2]) for entry in entries ])
+    for index,(tileid, offset, length, runlength) in enumerate(entries):
+        if index and offset == entries[index-1][1] + entries[index-1][2]:
+            parts.append(pmtiles_varint(0))
+        else:
+            parts.append(pmtiles_varint(offset + 1))
+    return gzip_bytes("".join(parts))
+
+
+def pmtiles_varint(value):
+    # protobuf-style unsigned varint: 7 bits at a time, low bits first, high bit set on all but the last byte
+    parts = []
+    while value >= 0x80:
+        parts.append(chr((value & 0x7f) | 0x80))
+        value >>= 7
+    parts.append(chr(value))
+    return "".join(parts)
+
+
+def gzip_bytes(data):
+    buffer = StringIO.StringIO()
+    output = gzip.GzipFile(fileobj=buffer, mode='wb')
+    output.write(data)
+    output.close()
+    return buffer.getvalue()
+
+
+####################################################################################################################################################
+####################################################################################################################################################
+
+class StageManifest:
+    # manifest.json in the working directory: for each stage which finished, a hash of what went into it
+    # (URL, vintage, field lists, the hashes of upstream stages' files) and a hash of each file it wrote
+    # a stage whose inputs haven't changed and whose files are still there as written is skipped, so a re-run picks up
+    # from the first stage which is stale, e.g. changing DECENNIAL_FIELD_SPEC's source re-runs the decennial download and the merge, not the polygons
+    def __init__(self,workdir,force=False,metrics=None):
+        self.path    = os.path.join(workdir, 'manifest.json')
+        self.lock    = threading.Lock()
+        self.stages  = {}
+        self.metrics = metrics
+        if force:
+            return
+        try:
+            manifest = json.load(open(self.path, 'r'))
+            if manifest.get('version') == MANIFEST_VERSION:
+                self.stages = manifest['stages']
+        except (IOError, ValueError, KeyError):
+            pass
+    def run(self,name,stage,upstream=()):
+        # run the stage's main() unless it's up to date, then record it
+        # the upstream stages' output hashes are part of this stage's inputs, so a fresh download makes the merge stale too
+        inputs = { 'stage':stage.fingerprint(), 'upstream':dict([ (previous, self.outputs(previous)) for previous in upstream ]) }
+        digest = hashlib.sha1(json.dumps(inputs, sort_keys=True)).hexdigest()
+        if self.is_current(name, digest):
+            print "    Up to date, skipping: %s" % ", ".join([ os.path.basename(path) for path in sorted(self.outputs(name).keys()) ])
+            if self.metrics:
+                self.metrics.record(name, 0.0, 0.0, {}, skipped=True)
+            return
+        with self.lock:
+            self.stages.pop(name, None)
+            self.save()
+        if self.metrics:
+            self.metrics.measure(name, stage.main, stage)
+        else:
+            stage.main()
+        outputs = dict([ (path, hash_file(path)) for path in stage.outputs() ])
+        with self.lock:
+            self.stages[name] = { 'inputs':digest, 'outputs':outputs, 'finished':time.time() }
+            self.save()
+    def is_current(self,name,digest):
+        entry = self.stages.get(name)
+        if not entry or entry['inputs'] != digest or not entry['outputs']:
+            return False
+        for path,filehash in entry['outputs'].items():
+            if not os.path.exists(path) or hash_file(path) != filehash:
+                return False
+        return True
+    def outputs(self,name):
+        entry = self.stages.get(name)
+        return entry['outputs'] if entry else {}
+    def save(self):
+        # written to a temp file then renamed into place, so a crash can't leave a half-written manifest
+        manifestfile = open(self.path + '.tmp', 'w')
+        json.dump({ 'version':MANIFEST_VERSION, 'stages':self.stages }, manifestfile, indent=2, sort_keys=True)
+        manifestfile.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+        os.rename(self.path + '.tmp', self.path)
+
+
+class StageMetrics:
+    # --metrics: for each stage, wall and CPU time, bytes read and written, rows and features per second, and peak memory
+    # written at the end of the run as metrics.json or metrics.csv in the working directory, one record per stage, to compare runs and states over time
+    # CPU time and peak RSS are the whole process's, so while the downloads run side by side their figures overlap; --serial gives each stage its own
+    # --profile also runs each stage under cProfile and dumps profile_<stage>.prof; cProfile only sees the thread it's run in, so that one is per stage regardless
+    FIELDS = [ 'state', 'counties', 'started', 'stage', 'ok', 'skipped', 'cachehit', 'wall', 'cpu', 'bytesread', 'byteswritten', 'rows', 'features', 'rowspersec', 'featurespersec', 'peakrssmb' ]
+
+    def __init__(self,config):
+        self.workdir  = config['workdir']
+        self.format   = config.get('metrics')
+        self.profile  = config.get('profile')
+        self.state    = config['state']
+        self.counties = ",".join(config.get('countyfips') or [])
+        self.started  = time.strftime('%Y-%m-%dT%H:%M:%S')
+        self.lock     = threading.Lock()
+        self.records  = []
+
+    def measure(self,name,function,stage=None):
+        # call function() and record it as the named stage, even if it fails
+        # the rows, features and bytes read come from stage.counts, or the result's counts if there's no stage, e.g. a merger which function creates
+        profiler = cProfile.Profile() if self.profile else None
+        result   = None
+        ok       = False
+        started  = time.time()
+        cpu      = process_cpu_seconds()
+        try:
+            if profiler:
+                result = profiler.runcall(function)
+            else:
+                result = function()
+            ok = True
+            return result
+        finally:
+            wall = time.time() - started
+            cpu  = process_cpu_seconds() - cpu
+            if profiler:
+                profiler.dump_stats(os.path.join(self.workdir, 'profile_%s.prof' % name))
+            source  = stage if stage is not None else result
+            written = 0
+            if ok and hasattr(source, 'outputs'):
+                written = sum([ os.path.getsize(path) for path in source.outputs() ])
+            self.record(name, wall, cpu, getattr(source, 'counts', {}), written, ok)
+
+    def record(self,name,wall,cpu,counts,byteswritten=0,ok=True,skipped=False):
+        rows     = counts.get('rows', 0)
+        features = counts.get('features', 0)
+        peak     = peak_rss_mb()
+        entry    = {
+            'state':self.state,
+            'counties':self.counties,
+            'started':self.started,
+            'stage':name,
+            'ok':ok,
+            'skipped':skipped,
+            'cachehit':counts.get('cachehit', False),
+            'wall':round(wall, 3),
+            'cpu':None if cpu is None else round(cpu, 3),
+            'bytesread':counts.get('bytesread', 0),
+            'byteswritten':byteswritten,
+            'rows':rows,
+            'features':features,
+            'rowspersec':round(rows / wall, 1) if wall else 0,
+            'featurespersec':round(features / wall, 1) if wall else 0,
+            'peakrssmb':None if peak is None else round(peak, 1),
+        }
+        with self.lock:
+            self.records.append(entry)
+
+    def save(self):
+        if not self.format:
+            return
+        path = os.path.join(self.workdir, 'metrics.%s' % self.format)
+        output = open(path, 'wb')
+        if self.format == 'json':
+            json.dump(self.records, output, indent=2, sort_keys=True)
+        else:
+            csvoutput = csv.DictWriter(output, self.FIELDS)
+            csvoutput.writerow(dict([ (field,field) for field in self.FIELDS ]))
+            csvoutput.writerows(self.records)
+        output.close()
+        print "Metrics written to %s" % path
+
+
+def measure_stage(config,name,function,stage=None):
+    # function() measured as a stage if this run is keeping metrics, otherwise just called
+    metrics = config.get('stagemetrics')
+    if metrics is None:
+        return function()
+    return metrics.measure(name, function, stage)
+
+
+def process_cpu_seconds():
+    # user plus system CPU time of this process so far
+    times = os.times()
+    return times[0] + times[1]
+
+
+def peak_rss_mb():
+    # peak resident memory of this process so far, in MB; Linux reports KB and OSX reports bytes
+    # None where there's no resource module, e.g. Windows
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / 1048576.0
+    return peak / 1024.0
+
+
+def hash_file(path):
+    filehash = hashlib.sha1()
+    local    = open(path, 'rb')
+    while True:
+        block = local.read(1048576)
+        if not block:
+            break
+        filehash.update(block)
+    local.close()
+    return filehash.hexdigest()
+
+
+class ThreadPrefixedOutput:
+    # a stand-in for sys.stdout while stages run in threads: each thread's output is buffered up to the end of a line,
+    # then written whole with the thread's name in front, e.g. "    [acs] Requesting ACS data from Dexter"
+    # so lines from side-by-side downloads don't get chopped up and mixed together
+    def __init__(self,stream):
+        self.stream  = stream
+        self.lock    = threading.Lock()
+        self.buffers = {}
+    def write(self,text):
+        thread = threading.current_thread()
+        with self.lock:
+            buffered = self.buffers.get(thread.ident, '') + text
+            lines    = buffered.split("\n")
+            self.buffers[thread.ident] = lines.pop()
+            for line in lines:
+                if isinstance(thread, threading._MainThread):
+                    self.stream.write(line + "\n")
+                else:
+                    text   = line.lstrip()
+                    indent = line[:len(line)-len(text)]
+                    self.stream.write("%s[%s] %s\n" % (indent, thread.name, text))
+            self.stream.flush()
+    def flush(self):
+        with self.lock:
+            self.stream.flush()
+
+
+class StageThread(threading.Thread):
+    # run one stage in a background thread, via the manifest so it's skipped if it's up to date
+    # an exception is kept and re-raised when the pipeline waits for the stage, so a failed download still fails the run
+    def __init__(self,name,manifest,stage):
+        threading.Thread.__init__(self, name=name)
+        self.daemon   = True
+        self.manifest = manifest
+        self.stage    = stage
+        self.error    = None
+    def run(self):
+        try:
+            self.manifest.run(self.name, self.stage)
+        except Exception:
+            self.error = sys.exc_info()
+    def wait(self):
+        # join with a timeout in a loop, since a plain join() can't be interrupted with ctrl-C
+        while self.is_alive():
+            self.join(0.5)
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+
+
+def state_config(state,counties=None,workdir='.',**settings):
+    # the config for one state's run, as the command line makes it: settings are the command line's settings by their config names,
+    # e.g. format='gpkg', cachedir=None or mergeworkers=4, and anything not given gets the command line's default
+    state = state.upper()
+    if state not in STATE_FIPS_CODES:
+        raise ValueError("Unknown state code: %s" % state)
+    config = dict(RUN_DEFAULTS)
+    config.update(settings)
+    config.update({ 'state':state, 'statefips':STATE_FIPS_CODES[state], 'countyfips':list(counties) if counties else None, 'workdir':workdir })
+    return config
+
+
+def generate(state,counties=None,workdir='.',**settings):
+    # the pipeline as a function, for other Python code such as ExtractService.py: no prompt, no sys.exit(), and errors are raised
+    # builds the state's merged blocks in workdir, or brings them up to date, and returns the output's path
+    #     path = GenerateStateMapperData.generate('VT', workdir='VT', format='gpkg')
+    if ogr is None or numpy is None:
+        raise ImportError("GenerateStateMapperData needs GDAL/OGR's Python bindings and NumPy")
+    config = state_config(state, counties, workdir, **settings)
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    run_pipeline(config)
+    return output_path(config)
+
+
+def run_pipeline(config):
+    # download the datasets and merge them into censusblocks.shp (or whichever output format)
+    # if counties were given, every stage filters to them as early as it can, so there's no trimming afterward
+    # the three downloads are independent and mostly waiting on the network, so they run side by side
+    # unless the config says serial, e.g. when debugging and you want to see one stage at a time
+    # stages which are up to date according to the manifest are skipped, unless the config says to force a full run
+    # the stages share one OGRSession, so each datasource is opened once for the whole run
+    # and with --metrics (or --profile) each stage is measured, and the figures are written out at the end even if a stage failed
+    metrics  = StageMetrics(config) if config.get('metrics') or config.get('profile') else None
+    manifest = StageManifest(config['workdir'], config.get('force'), metrics)
+    session  = OGRSession()
+    config   = dict(config, ogrsession=session, stagemetrics=metrics)
+    try:
+        if config.get('serial'):
+            fetch_and_merge_serial(config, manifest)
+        else:
+            fetch_and_merge(config, manifest)
+    finally:
+        session.close()
+        if metrics:
+            metrics.save()
+
+
+def fetch_and_merge(config,manifest):
+    stdout = sys.stdout
+    sys.stdout = ThreadPrefixedOutput(stdout)
+    try:
+        # Part 1: download all the datasets: polygon geometries, ACS for income data at tract level, decennial census for race and youth attributes
+        print "Fetching polygon shapefile from USCB TIGER, decennial and ACS income tract attributes from MCDC Dexter"
+        plyd = StageThread('polygons', manifest, PolygonDownloader(config))
+        decd = StageThread('decennial', manifest, DecennialDownloader(config))
+        acsd = [ StageThread(vintage['stage'], manifest, ACSDownloader(config, vintage)) for vintage in acs_vintages(config) ]
+        for download in [ plyd, decd ] + acsd:
+            download.start()
+
+        # Part 2: merge the attributes from the CSVs into the shapefile via OGR, once everything has arrived
+        for download in [ plyd, decd ] + acsd:
+            download.wait()
+        print "Merging ACS MHHINC and Decennial attribs into censusblocks"
+        manifest.run('merge', BlockMerger(config), merge_upstream(config))
+
+        # Part 3: with --optimize, a slimmer copy to ship
+        if config.get('optimize'):
+            print "Optimizing censusblocks for size"
+            manifest.run('optimize', BlockOptimizer(config), [ 'merge' ])
+    finally:
+        sys.stdout = stdout
+
+
+def fetch_and_merge_serial(config,manifest):
+    # Part 1: download all the datasets: polygon geometries, ACS for income data at tract level, decennial census for race and youth attributes
+    print "Fetching polygon shapefile from USCB TIGER"
+    manifest.run('polygons', PolygonDownloader(config))
+
+    print "Fetching decennial attributes from MCDC Dexter"
+    manifest.run('decennial', DecennialDownloader(config))
+
+    for vintage in acs_vintages(config):
+        print "Fetching ACS %s income tract attributes from MDCDC Dexter" % vintage['year']
+        manifest.run(vintage['stage'], ACSDownloader(config, vintage))
+
+    # Part 2: merge the attributes from the CSVs into the shapefile via OGR
+    print "Merging ACS MHHINC and Decennial attribs into censusblocks"
+    manifest.run('merge', BlockMerger(config), merge_upstream(config))
+
+    # Part 3: with --optimize, a slimmer copy to ship
+    if config.get('optimize'):
+        print "Optimizing censusblocks for size"
+        manifest.run('optimize', BlockOptimizer(config), [ 'merge' ])
+
+
+def run_state(config):
+    # batch-mode worker: run one state's pipeline inside its own working directory
+    # the usual progress chatter goes into a run.log in that directory, since a dozen states printing at once is unreadable
+    # any error is caught and reported in the summary, so one bad state doesn't kill the rest of the batch
+    # that includes failing to make the working directory or its run.log, so a summary always comes back; ExtractService counts on it
+    summary = { 'state':config['state'], 'workdir':config['workdir'], 'output':output_path(config), 'ok':False, 'seconds':0, 'error':None }
+    started = time.time()
+
+    logfile = None
+    stdout  = sys.stdout
+    try:
+        if not os.path.isdir(config['workdir']):
+            os.makedirs(config['workdir'])
+        logfile = open(os.path.join(config['workdir'],'run.log'), 'w')
+        sys.stdout = logfile
+
+        run_pipeline(config)
+        summary['ok'] = True
+    except Exception, e:
+        traceback.print_exc(file=logfile or sys.stderr)
+        summary['error'] = "%s: %s" % (e.__class__.__name__, e)
+    finally:
+        sys.stdout = stdout
+        if logfile:
+            logfile.close()
+
+    summary['seconds'] = time.time() - started
+    return summary
+
+
+def run_batch(configs, workers):
+    # run a list of state configs through a pool of worker processes, printing each one as it finishes
+    # then a combined summary at the end; returns True if every state succeeded
+    started   = time.time()
+    summaries = []
+    pool      = multiprocessing.Pool(processes=workers)
+    try:
+        for summary in pool.imap_unordered(run_state, configs):
+            summaries.append(summary)
+            status = "done" if summary['ok'] else "FAILED"
+            print "    %s %s in %.1f minutes (%d of %d)" % (summary['state'], status, summary['seconds']/60.0, len(summaries), len(configs))
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    failed = [ summary for summary in summaries if not summary['ok'] ]
+    print ""
+    print "Batch summary: %d states, %d succeeded, %d failed, %.1f minutes total" % (len(summaries), len(summaries)-len(failed), len(failed), (time.time()-started)/60.0)
+    for summary in sorted(summaries, key=lambda summary: summary['state']):
+        if summary['ok']:
+            print "    %s  OK      %6.1f min  %s" % (summary['state'], summary['seconds']/60.0, summary['output'])
+        else:
+            print "    %s  FAILED  %6.1f min  %s  (see %s)" % (summary['state'], summary['seconds']/60.0, summary['error'], os.path.join(summary['workdir'],'run.log'))
+    return not failed
+
+
+def prefetch_file(task):
+    # --prefetch worker: download one file into the mirror, laid out the way ServeMirror.py serves it, unless it's there already
+    # the TIGER zips keep their path under TIGER_BASE_URL, so the mirror's tiger directory can stand in for it; Dexter extracts are named by dexter_extract_name()
+    # files are downloaded under a temporary name and renamed into place once complete, so an interrupted prefetch never leaves a truncated one
+    kind, config, mirror = task
+    summary = { 'kind':kind, 'state':config['state'], 'target':None, 'ok':False, 'skipped':False, 'seconds':0, 'error':None }
+    started = time.time()
+    stdout  = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        if kind == 'polygons':
+            stage  = PolygonDownloader(config)
+            target = os.path.join(mirror, 'tiger', 'TIGER%sBLKPOPHU' % DECENNIAL_YEAR, os.path.basename(stage.url))
+            fetch  = lambda temp: RangedDownload(stage.url, target, config.get('connections', DOWNLOAD_CONNECTIONS)).fetch(temp)
+            files  = [ (target, fetch) ]
+        else:
+            # a varlist split into sub-extracts is mirrored as each of them, since that's what the runs will ask the mirror for
+            stage  = DecennialDownloader(config) if kind == 'decennial' else ACSDownloader(config)
+            files  = []
+            for params,labels in stage.batches:
+                target = os.path.join(mirror, 'dexter', dexter_extract_name(params.items()) + '.csv')
+                fetch  = lambda temp, params=params: stage.client.extract(params, lambda remote: save_stream(remote, temp))
+                files.append( (target, fetch) )
+        summary['target'] = files[0][0]
+        summary['skipped'] = True
+        for target,fetch in files:
+            if os.path.exists(target):
+                continue
+            summary['skipped'] = False
+            if not os.path.isdir(os.path.dirname(target)):
+                try:
+                    os.makedirs(os.path.dirname(target))
+                except OSError:
+                    pass
+            fetch(target + '.download')
+            os.rename(target + '.download', target)
+        summary['ok'] = True
+    except Exception, e:
+        summary['error'] = "%s: %s" % (e.__class__.__name__, e)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    summary['seconds'] = time.time() - started
+    return summary
+
+
+def save_stream(stream,path):
+    # copy a download into a file of its own, closed before this returns so all of it is on disk when prefetch_file() renames it into place
+    # (and so the rename works at all on Windows, which won't rename a file that's still open)
+    with open(path, 'wb') as output:
+        shutil.copyfileobj(stream, output, 1048576)
+
+
+def run_prefetch(states,mirror,workers,common):
+    # download every state's polygons and decennial extract, and the national ACS extract, into a local mirror, several at a time
+    # which ServeMirror.py can then serve in place of the Census web site and Dexter; returns True if every file made it
+    tasks = []
+    for state in states:
+        config = { 'state':state, 'statefips':STATE_FIPS_CODES[state], 'countyfips':None, 'workdir':mirror, 'cachedir':None }
+        config.update(dict([ (key,common.get(key)) for key in ('tigerurl','dexterurl','dexterbatch','connections','fieldspec') ]))
+        if not tasks:
+            for vintage in acs_vintages(common):
+                tasks.append( ('acs', dict(config, statefips=None, acsyears=[ vintage['year'] ] if vintage['suffix'] else None), mirror) )
+        tasks.append( ('polygons', config, mirror) )
+        tasks.append( ('decennial', config, mirror) )
+
+    started   = time.time()
+    summaries = []
+    pool      = multiprocessing.Pool(processes=workers)
+    try:
+        for summary in pool.imap_unordered(prefetch_file, tasks):
+            summaries.append(summary)
+            status = "already there" if summary['skipped'] else "done" if summary['ok'] else "FAILED: %s" % summary['error']
+            print "    %s %s %s in %.1f minutes (%d of %d)" % (summary['state'] if summary['kind'] != 'acs' else 'US', summary['kind'], status, summary['seconds']/60.0, len(summaries), len(tasks))
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    failed = [ summary for summary in summaries if not summary['ok'] ]
+    print ""
+    print "Prefetch summary: %d files, %d failed, %.1f minutes total, mirror in %s" % (len(summaries), len(failed), (time.time()-started)/60.0, mirror)
+    return not failed
+
+
+####################################################################################################################################################
+####################################################################################################################################################
+
+if __name__ == '__main__':
+    # sanity checks: make sure we have OGR module
+    if ogr is None:
+        print "Could not import ogr"
+        print "You must have Python-OGR installed, e.g. be using Python from OSG4Win"
+        sys.exit(4)
+
+    # sanity checks: make sure we have NumPy, for the attribute joins
+    if numpy is None:
+        print "Could not import numpy"
+        print "You must have NumPy installed; it comes with the Python in OSGeo4W"
+        sys.exit(4)
+
+    # parse command-line params: a single state and optional county, or a batch of states
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('state', nargs='?', help="two-letter postal code for the state, e.g. CA or VT")
+    parser.add_argument('county', nargs='*', help="three-digit county FIPS codes to limit to, e.g. 031")
+    parser.add_argument('--states', help="batch mode: comma-separated list of two-letter state codes, e.g. CA,TX,VT")
+    parser.add_argument('--all', action='store_true', help="batch mode: run every state")
+    parser.add_argument('--workers', type=int, default=BATCH_WORKERS, help="batch mode: how many states to run at the same time (default %d)" % BATCH_WORKERS)
+    parser.add_argument('--serial', action='store_true', help="run the downloads one after another instead of side by side, e.g. for debugging")
+    parser.add_argument('--cache', default=CACHE_DIRECTORY, help="directory to keep downloads in, so re-runs don't fetch them again (default %s)" % CACHE_DIRECTORY)
+    parser.add_argument('--no-cache', action='store_true', help="don't use or fill the download cache")
+    parser.add_argument('--cache-max-gb', type=float, default=CACHE_MAX_BYTES/1073741824.0, help="cap on the download cache's size; least-recently-used downloads are removed first (default %.0f)" % (CACHE_MAX_BYTES/1073741824.0))
+    parser.add_argument('--revalidate-cache', action='store_true', help="check cached polygon zips against the server's size and Last-Modified before using them")
+    parser.add_argument('--connections', type=int, default=DOWNLOAD_CONNECTIONS, help="how many connections to download each polygon zip over (default %d)" % DOWNLOAD_CONNECTIONS)
+    parser.add_argument('--format', choices=sorted(OUTPUT_FORMATS.keys()), default=OUTPUT_FORMAT, help="output format for the merged blocks, each with a spatial index (default %s)" % OUTPUT_FORMAT)
+    parser.add_argument('--tile-workers', type=int, help="with --format mbtiles or pmtiles, how many processes cut tiles at once (default one per CPU)")
+    parser.add_argument('--acs-years', help="join several ACS vintages at once, comma-separated e.g. 2013,2018, as year-suffixed fields MHHINC13, MHHINC18 (default just %s, as MHHINC)" % ACS_YEAR)
+    parser.add_argument('--field-spec', metavar='FILE', help="a JSON file saying which decennial variables to download and how the output fields are made from them, in the shape of DECENNIAL_FIELD_SPEC (default the usual eight fields)")
+    parser.add_argument('--rollups', help="also add the blocks up into these areas, comma-separated: %s" % ",".join([ level[0] for level in ROLLUP_LEVELS ]))
+    parser.add_argument('--rollup-geometry', action='store_true', help="with --rollups, dissolve the blocks into each area's polygon and write them in the output format, instead of CSV")
+    parser.add_argument('--merge-workers', type=int, default=1, help="merge this many counties at once, each in its own process (default 1, the whole state in one go)")
+    parser.add_argument('--optimize', action='store_true', help="also write censusblocks_optimized to ship: DBF fields only as wide as their values, coordinates rounded, and see --empty-blocks; reports the bytes saved and the load time")
+    parser.add_argument('--optimize-precision', type=int, default=OPTIMIZE_PRECISION, help="with --optimize, round coordinates to this many decimal places (default %d, about 10cm)" % OPTIMIZE_PRECISION)
+    parser.add_argument('--empty-blocks', choices=EMPTY_BLOCKS, default='keep', help="with --optimize, what to do with blocks where TOTPOP is 0: keep them, drop them, or merge each tract's into one feature (default keep)")
+    parser.add_argument('--stream-join', action='store_true', help="sort the attributes on disk and merge-join them in GEOID order, holding a fixed amount of the attributes in memory however big the state (the blocks' GEOID sort isn't bounded, and the join is slower)")
+    parser.add_argument('--join-memory-mb', type=int, default=STREAM_JOIN_MEMORY/1048576, help="with --stream-join, about how much of the attributes to hold in memory at once (default %d)" % (STREAM_JOIN_MEMORY/1048576))
+    parser.add_argument('--metrics', choices=['json','csv'], help="record each stage's time, CPU, bytes, rows and features per second and peak memory, into metrics.json or metrics.csv in the working directory")
+    parser.add_argument('--profile', action='store_true', help="run each stage under cProfile, writing profile_<stage>.prof into the working directory")
+    parser.add_argument('--tiger-url', default=TIGER_BASE_URL, help="base URL for the TIGER block polygons (default %s)" % TIGER_BASE_URL)
+    parser.add_argument('--dexter-url', default=DEXTER_BASE_URL, help="base URL for MCDC Dexter, for the attribute extracts (default %s)" % DEXTER_BASE_URL)
+    parser.add_argument('--dexter-batch', type=int, default=DEXTER_VARLIST_BATCH, help="ask Dexter for at most this many variables per extract, splitting a longer varlist into sub-extracts fetched side by side (default %d)" % DEXTER_VARLIST_BATCH)
+    parser.add_argument('--prefetch', metavar='MIRROR', help="instead of generating output, download the polygons and extracts for the given states (default all) into a local mirror, for ServeMirror.py")
+    parser.add_argument('--force', action='store_true', help="re-run every stage, even those the manifest says are up to date")
+    parser.add_argument('--workdir', default='.', help="directory to write output into; in batch mode each state gets its own subdirectory XX of this")
+    options = parser.parse_args()
+
+    counties = []
+    for county in options.county:
+        counties.extend([ county.strip() for county in county.split(',') if county.strip() ])
+    for county in counties:
+        if len(county) != 3 or not county.isdigit():
+            parser.error("Bad county FIPS code %s; County FIPS are always 3 digits." % county)
+
+    if ogr.GetDriverByName(OUTPUT_FORMATS[options.format][0]) is None:
+        parser.error("This GDAL doesn't have the %s driver, needed for --format %s" % (OUTPUT_FORMATS[options.format][0], options.format))
+    rollups = [ level.strip().lower() for level in (options.rollups or '').split(',') if level.strip() ]
+    for level in rollups:
+        if level not in [ known[0] for known in ROLLUP_LEVELS ]:
+            parser.error("Unknown rollup level %s; choose from %s" % (level, ", ".join([ known[0] for known in ROLLUP_LEVELS ])))
+    acsyears = [ year.strip() for year in (options.acs_years or '').split(',') if year.strip() ]
+    for year in acsyears:
+        if len(year) != 4 or not year.isdigit():
+            parser.error("Bad ACS year %s; give four-digit years, e.g. 2013,2018" % year)
+    if len(set([ year[-2:] for year in acsyears ])) != len(acsyears):
+        parser.error("The ACS years' fields are suffixed by their last two digits, so those need to be different: %s" % ",".join(acsyears))
+
+    if options.rollup_geometry and not rollups:
+        parser.error("--rollup-geometry needs --rollups")
+    if options.optimize and options.format in TILE_FORMATS:
+        parser.error("--optimize is for the feature formats; a tileset is already rounded to its tiles")
+    if options.empty_blocks != 'keep' and not options.optimize:
+        parser.error("--empty-blocks needs --optimize")
+    if not 0 <= options.optimize_precision <= 15:
+        parser.error("--optimize-precision should be 0 to 15 decimal places")
+    if options.dexter_batch < 1:
+        parser.error("--dexter-batch must be at least 1")
+
+    fieldspec = None
+    if options.field_spec:
+        try:
+            fieldspec = json.load(open(options.field_spec, 'r'))
+            FieldTransform(fieldspec, SHAPEFILE_FIELD_NAME_LENGTH if options.format == 'shapefile' else None)
+        except (IOError, ValueError, KeyError, TypeError), error:
+            parser.error("Can't use the field spec %s: %s" % (options.field_spec, error))
+    if options.format in TILE_FORMATS and ogr.GetDriverByName('GPKG') is None:
+        parser.error("This GDAL doesn't have the GPKG driver, needed for --format %s" % options.format)
+
+    # settings common to every state's config
+    common = {
+        'format':options.format,
+        'serial':options.serial,
+        'force':options.force,
+        'metrics':options.metrics,
+        'profile':options.profile,
+        'streamjoin':options.stream_join,
+        'tileworkers':options.tile_workers,
+        'mergeworkers':options.merge_workers,
+        'rollups':rollups,
+        'acsyears':acsyears or None,
+        'fieldspec':fieldspec,
+        'optimize':options.optimize,
+        'precision':options.optimize_precision,
+        'emptyblocks':options.empty_blocks,
+        'rollupgeometry':options.rollup_geometry,
+        'joinmemory':options.join_memory_mb * 1048576,
+        'cachedir':None if options.no_cache else options.cache,
+        'cachemaxbytes':int(options.cache_max_gb * 1073741824),
+        'cacherevalidate':options.revalidate_cache,
+        'connections':options.connections,
+        'tigerurl':options.tiger_url.rstrip('/'),
+        'dexterurl':options.dexter_url.rstrip('/'),
+        'dexterbatch':options.dexter_batch,
+    }
+
+    if options.prefetch:
+        if counties:
+            parser.error("--prefetch fetches whole states; leave out the counties")
+        if options.all or not (options.states or options.state):
+            states = sorted(STATE_FIPS_CODES.keys())
+        else:
+            states = [ state.strip().upper() for state in (options.states or options.state).split(',') if state.strip() ]
+        for state in states:
+            if state not in STATE_FIPS_CODES:
+                parser.error("Unknown state code: %s" % state)
+        print "Prefetching %d states into %s, %d at a time" % (len(states), options.prefetch, options.workers)
+        print ""
+        if not run_prefetch(states, options.prefetch, options.workers, common):
+            sys.exit(3)
+        sys.exit(0)
+
+    if options.states or options.all:
+        if options.state or counties:
+            parser.error("Give either a single state and counties, or --states / --all for batch mode, not both.")
+        if options.workers < 1:
+            parser.error("--workers must be at least 1")
+        if options.all:
+            states = sorted(STATE_FIPS_CODES.keys())
+        else:
+            states = [ state.strip().upper() for state in options.states.split(',') if state.strip() ]
+        for state in states:
+            if state not in STATE_FIPS_CODES:
+                parser.error("Unknown state code: %s" % state)
+
+        # compose one config object per state, each with its own working directory so they don't trample each other's files
+        configs = [ state_config(state, None, os.path.join(options.workdir,state), **common) for state in states ]
+        print "Preparing to generate data for %d states, %d at a time: %s" % (len(configs), options.workers, ", ".join(states))
+        print "Output and a run.log for each state will be in %s" % os.path.join(options.workdir,'XX')
+        print ""
+        print "If that looks right, just wait 5 seconds."
+        print "If not, hit ctrl-C right now to abort."
+        time.sleep(5)
+        print "Starting"
+        print ""
+
+        # the ACS extract is national, so it's fetched once up front and each state gets its own slice of it, rather than every worker fetching it
+        for vintage in acs_vintages(common):
+            acsfiles = split_national_acs(states, os.path.join(options.workdir,'ACS'), common, vintage)
+            for config in configs:
+                config.setdefault('acsfiles', {})[vintage['stage']] = acsfiles[config['state']]
+
+        if not run_batch(configs, options.workers):
+            sys.exit(3)
+        sys.exit(0)
+
+    if not options.state or options.state.upper() not in STATE_FIPS_CODES:
+        parser.error("Give a two-letter state code, e.g. CA or VT, or use --states / --all")
+
+    # compose a single config object, and tell the user what we think they asked for
+    config = state_config(options.state, counties, options.workdir, **common)
+    print "Preparing to generate data for %s   State FIPS code is %s" % (config['state'],config['statefips'])
+    if counties:
+        print "Will filter by county FIPS = %s" % ", ".join(counties)
+    print ""
+    print "If that looks right, just wait 5 seconds."
+    print "If not, hit ctrl-C right now to abort."
+    time.sleep(5)
+    print "Starting"
+    print ""
+
+    if not os.path.isdir(config['workdir']):
+        os.makedirs(config['workdir'])
+    run_pipeline(config)
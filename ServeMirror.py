@@ -0,0 +1,142 @@
+#!/bin/env python
+"""
+Serve a local mirror made by GenerateStateMapperData.py --prefetch, in place of the Census web site and MCDC's Dexter
+
+The mirror's tiger directory is served as-is under /tiger, with Range requests and Last-Modified so the ranged downloads and cache revalidation work.
+Dexter's protocol is played along with: a request to /cgi-bin/broker gets back a page pointing at /tmpscratch/<name>/xtract.csv,
+where the name is worked out from the query the same way --prefetch named the extract, and that URL serves the mirrored extract.
+A query for an extract that isn't in the mirror gets a 404, rather than going off to the real Dexter.
+
+To try out how the script copes with a slow or unreliable Dexter, --delay makes each extract's xtract.csv a 404 for that many seconds
+after the broker is asked for it, as if Dexter were still writing it, and --fail-every N answers every Nth Dexter request with a 503.
+
+Usage:
+    ServeMirror.py MIRROR [--port 8000] [--host 127.0.0.1] [--delay SECONDS] [--fail-every N]
+    Then point the script at it:
+    GenerateStateMapperData.py XX --tiger-url http://localhost:8000/tiger --dexter-url http://localhost:8000
+"""
+
+import os, time
+import argparse, urlparse, threading
+import BaseHTTPServer, SocketServer
+
+from GenerateStateMapperData import dexter_extract_name
+
+
+class MirrorRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # the mirror directory is set on the server, see MirrorServer
+    def do_GET(self):
+        url = urlparse.urlsplit(self.path)
+        if url.path == '/cgi-bin/broker' or url.path.startswith('/tmpscratch/'):
+            if self.server.fail():
+                return self.send_error(503, "Failing this one on purpose, for --fail-every")
+        if url.path == '/cgi-bin/broker':
+            return self.broker(url.query)
+        if url.path.startswith('/tmpscratch/') and url.path.endswith('/xtract.csv'):
+            name = url.path.split('/')[2]
+            if time.time() < self.server.ready.get(name, 0):
+                return self.send_error(404, "Still writing %s, for --delay" % name)
+            return self.send_file(os.path.join(self.server.mirror, 'dexter', name + '.csv'), 'text/csv')
+        if url.path.startswith('/tiger/'):
+            return self.send_file(self.local_path(url.path), 'application/zip')
+        self.send_error(404, "Not in the mirror: %s" % url.path)
+
+    def broker(self,query):
+        # what Dexter's broker does, minus the queue: say where the extract is
+        name = dexter_extract_name(urlparse.parse_qsl(query, keep_blank_values=True))
+        if not os.path.exists(os.path.join(self.server.mirror, 'dexter', name + '.csv')):
+            return self.send_error(404, "No extract %s in the mirror; run --prefetch for it" % name)
+        self.server.ready[name] = time.time() + self.server.delay
+        page = '<html><body>Your extract is ready: <a href="/tmpscratch/%s/xtract.csv">xtract.csv</a></body></html>' % name
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(page)))
+        self.end_headers()
+        self.wfile.write(page)
+
+    def local_path(self,path):
+        # a URL path to a file under the mirror, refusing anything which would climb out of it
+        parts = [ part for part in path.split('/') if part and part not in ('.', '..') ]
+        return os.path.join(self.server.mirror, *parts)
+
+    def send_file(self,path,contenttype):
+        # a whole file, or with a Range header just the bytes asked for (a 206, like the Census web site)
+        if not os.path.isfile(path):
+            return self.send_error(404, "Not in the mirror: %s" % self.path)
+        size  = os.path.getsize(path)
+        start = 0
+        end   = size - 1
+        ranged = self.headers.getheader('Range')
+        if ranged and ranged.startswith('bytes='):
+            first, last = ranged[6:].split(',')[0].split('-')
+            if first:
+                start = int(first)
+                end   = min(int(last), size - 1) if last else size - 1
+            else:
+                start = max(0, size - int(last))
+            if start > end:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % size)
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', contenttype)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Last-Modified', self.date_time_string(os.path.getmtime(path)))
+        self.end_headers()
+
+        local = open(path, 'rb')
+        local.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            block = local.read(min(remaining, 1048576))
+            if not block:
+                break
+            self.wfile.write(block)
+            remaining -= len(block)
+        local.close()
+
+
+class MirrorServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    # one thread per request, since the ranged downloads come in several connections at once
+    daemon_threads = True
+
+    def __init__(self,address,mirror,delay=0,failevery=0):
+        BaseHTTPServer.HTTPServer.__init__(self, address, MirrorRequestHandler)
+        self.mirror    = mirror
+        self.delay     = delay
+        self.failevery = failevery
+        self.ready     = {}
+        self.requests  = 0
+        self.lock      = threading.Lock()
+
+    def fail(self):
+        # whether to fail this Dexter request, being the Nth since the last one failed
+        with self.lock:
+            self.requests += 1
+            return bool(self.failevery) and self.requests % self.failevery == 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('mirror', help="the mirror directory made by GenerateStateMapperData.py --prefetch")
+    parser.add_argument('--port', type=int, default=8000, help="port to listen on (default 8000)")
+    parser.add_argument('--host', default='127.0.0.1', help="address to listen on (default 127.0.0.1, this machine only)")
+    parser.add_argument('--delay', type=float, default=0, help="act as if each Dexter extract takes this many seconds to be ready (default 0)")
+    parser.add_argument('--fail-every', type=int, default=0, help="answer every Nth Dexter request with a 503 (default 0, never)")
+    options = parser.parse_args()
+
+    if not os.path.isdir(options.mirror):
+        parser.error("No such mirror directory: %s" % options.mirror)
+
+    server = MirrorServer((options.host, options.port), os.path.abspath(options.mirror), options.delay, options.fail_every)
+    print "Serving the mirror in %s at http://%s:%d/" % (options.mirror, options.host, options.port)
+    print "    --tiger-url http://%s:%d/tiger --dexter-url http://%s:%d" % (options.host, options.port, options.host, options.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print ""
@@ -0,0 +1,112 @@
+#!/bin/env python
+"""
+Tests for the attribute joins in GenerateStateMapperData.py: AttributeStream, used by --stream-join, against the in-memory AttributeTable
+
+Both are given the same .npy of attributes and asked for the same GEOIDs, some of which aren't in it, with and without a county filter,
+and with a join memory budget small enough that the stream sorts its attributes in several runs and merges them back together.
+
+Usage:
+    python -m unittest discover tests
+"""
+
+import os, sys, random, shutil, tempfile, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import GenerateStateMapperData
+import numpy
+
+
+class AttributeJoinTest(unittest.TestCase):
+    def setUp(self):
+        # a few thousand blocks over three counties, shuffled, with a 4 KB budget so the stream is sorted in a dozen or so runs
+        generator    = random.Random(2010)
+        geoids       = sorted(set([ "50%03d%06d%04d" % (generator.choice([1,3,5]), generator.randint(0,20), generator.randint(1000,1200)) for index in range(3000) ]))
+        self.workdir = tempfile.mkdtemp(prefix='testjoins')
+        self.path    = os.path.join(self.workdir, 'decennial_attributes.npy')
+        self.budget  = 4096
+
+        # one in ten of the blocks has no attributes, and some GEOIDs asked for are of no block at all
+        stored = [ geoid for geoid in geoids if generator.random() > 0.1 ]
+        generator.shuffle(stored)
+        data   = numpy.zeros(len(stored), dtype=[ ('GEOID','S15'), ('TotPop','i4'), ('Kids','i4') ])
+        data['GEOID']  = stored
+        data['TotPop'] = [ generator.randint(0, 500) for geoid in stored ]
+        data['Kids']   = [ generator.randint(0, 100) for geoid in stored ]
+        GenerateStateMapperData.save_attribute_data(self.path, data)
+        self.geoids = numpy.array(sorted(geoids + [ '500039999999999', '500070000001000' ]), dtype='S15')
+
+        self.stdout = sys.stdout
+        sys.stdout  = open(os.devnull, 'w')
+
+    def tearDown(self):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+        shutil.rmtree(self.workdir)
+
+    def columns(self,data):
+        return { 'TOTPOP':data['TotPop'].astype('i4'), 'KIDS':data['Kids'].astype('i4') }
+
+    def join(self,table,geoids):
+        # the columns for the GEOIDs in batches, the way BlockMerger.write_batch() asks for them
+        joined = { 'TOTPOP':[], 'KIDS':[] }
+        for start in range(0, len(geoids), 100):
+            rows = table.rows(geoids[start:start+100])
+            for name in joined:
+                joined[name].extend( table.column(name, rows).tolist() )
+        return joined
+
+    def compare(self,prefixes,geoids):
+        data   = GenerateStateMapperData.load_attribute_data(self.path, prefixes)
+        table  = GenerateStateMapperData.AttributeTable(data['GEOID'], self.columns(data))
+        stream = GenerateStateMapperData.AttributeStream(self.path, prefixes, self.columns, self.budget, self.workdir)
+        try:
+            self.assertTrue(len(stream.runs) > 1)
+            self.assertEqual(len(stream), len(table))
+            self.assertEqual(self.join(stream, geoids), self.join(table, geoids))
+            self.assertEqual(stream.unmatched, table.unmatched)
+            self.assertEqual(stream.examples, table.examples)
+            self.assertTrue(table.unmatched > 0)
+        finally:
+            stream.close()
+        self.assertEqual(os.listdir(self.workdir), [ 'decennial_attributes.npy' ])
+
+    def test_whole_state(self):
+        self.compare(None, self.geoids)
+
+    def test_county_prefixes(self):
+        # only the two counties' attributes are loaded, so the third county's blocks are all unmatched
+        self.compare([ '50001', '50005' ], self.geoids)
+
+    def test_county_slices(self):
+        # --merge-workers: the shuffled file is sorted once, and each county's slice of it is just what filtering by its prefix gives
+        counties     = [ '50001', '50003', '50005', '50007' ]
+        path, slices = GenerateStateMapperData.attribute_slices(self.path, counties, os.path.join(self.workdir, 'sorted.npy'))
+        self.assertNotEqual(path, self.path)
+        for county in counties:
+            sliced   = GenerateStateMapperData.load_attribute_data(path, None, slices[county])
+            filtered = GenerateStateMapperData.load_attribute_data(self.path, [ county ])
+            self.assertEqual(sorted(sliced.tolist()), sorted(filtered.tolist()))
+        self.assertEqual(slices['50007'][0], slices['50007'][1])
+
+        # the streaming join reads only the slice too
+        stream = GenerateStateMapperData.AttributeStream(path, None, self.columns, self.budget, self.workdir, slices['50003'])
+        self.assertEqual(len(stream), slices['50003'][1] - slices['50003'][0])
+        stream.close()
+        os.unlink(path)
+
+        # and a file already in order is used as it is
+        data = GenerateStateMapperData.load_attribute_data(self.path)
+        GenerateStateMapperData.save_attribute_data(self.path, numpy.sort(data, order='GEOID'))
+        self.assertEqual(GenerateStateMapperData.attribute_slices(self.path, counties, os.path.join(self.workdir, 'sorted.npy'))[0], self.path)
+
+    def test_stream_needs_order(self):
+        stream = GenerateStateMapperData.AttributeStream(self.path, None, self.columns, self.budget, self.workdir)
+        try:
+            stream.rows(self.geoids[100:200])
+            self.assertRaises(RuntimeError, stream.rows, self.geoids[0:100])
+        finally:
+            stream.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
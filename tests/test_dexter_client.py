@@ -0,0 +1,187 @@
+#!/bin/env python
+"""
+Tests for DexterClient in GenerateStateMapperData.py, against a local HTTP server standing in for MCDC Dexter's broker
+
+The broker answers with a page pointing at the extract's xtract.csv, which can be made a 404 for a while as if Dexter were still writing it,
+and can be told to answer with other pages first: a meta refresh to come back later, a page with no extract on it, or an HTTP error.
+Then the sub-extracts of a long varlist are fetched side by side and joined back together.
+
+Usage:
+    python -m unittest discover tests
+"""
+
+import os, sys, csv, hashlib, threading, unittest, urllib2, urlparse
+import BaseHTTPServer, SocketServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import GenerateStateMapperData
+import numpy
+
+
+class BrokerRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # the extracts and how to behave are set on the server, see BrokerServer
+    def do_GET(self):
+        path, query = urlparse.urlparse(self.path)[2:5:2]
+        self.server.requests.append(self.path)
+
+        if path == '/cgi-bin/broker':
+            # the pages queued up first, as (status, body), then one pointing at the extract for the varlist asked for
+            if self.server.pages:
+                status, body = self.server.pages.pop(0)
+            else:
+                status = 200
+                body   = '<html><body><a href="/tmpscratch/%s/xtract.csv">xtract.csv</a></body></html>' % extract_name(urlparse.parse_qs(query).get('varlist', [ '' ])[0])
+            return self.answer(status, body)
+
+        # the extract is a 404 until it's been asked for as many times as the server's still pending, or if there's no such extract
+        name = path.split('/')[2] if path.startswith('/tmpscratch/') else None
+        if name not in self.server.extracts:
+            return self.answer(404, 'Not Found')
+        if self.server.pending:
+            self.server.pending -= 1
+            return self.answer(404, 'Not Found')
+        self.answer(200, self.server.extracts[name])
+
+    def answer(self,status,body):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self,*args):
+        pass
+
+
+class BrokerServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), BrokerRequestHandler)
+        self.extracts = {}
+        self.pages    = []
+        self.pending  = 0
+        self.requests = []
+
+    def serve(self,varlist,rows):
+        self.extracts[extract_name(varlist)] = "".join([ ",".join(row) + "\r\n" for row in rows ])
+
+
+def extract_name(varlist):
+    return hashlib.sha1(varlist).hexdigest()[:16]
+
+
+def read_text(remote):
+    return remote.read()
+
+
+class DexterClientTest(unittest.TestCase):
+    # the vintage's block extract: a GEOID and two of Dexter's variables
+    PARAMS = { 'sasdset':'vtblocks', 'varlist':'geoid,p0010001,p0120003' }
+    ROWS   = [ [ '500010001001000', '35', '7' ], [ '500010001001001', '0', '0' ], [ '500010001001002', '12', '3' ] ]
+
+    def setUp(self):
+        # Dexter's waits, turned down from minutes to hundredths of a second
+        self.timings = GenerateStateMapperData.DEXTER_BACKOFF, GenerateStateMapperData.DEXTER_POLL_SECONDS, GenerateStateMapperData.DEXTER_MAX_WAIT
+        GenerateStateMapperData.DEXTER_BACKOFF      = 0.01
+        GenerateStateMapperData.DEXTER_POLL_SECONDS = 0.01
+        GenerateStateMapperData.DEXTER_MAX_WAIT     = 5
+        self.server = BrokerServer()
+        self.server.serve(self.PARAMS['varlist'], self.ROWS)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.client = GenerateStateMapperData.DexterClient('http://127.0.0.1:%d' % self.server.server_address[1], retries=2, timeout=10)
+
+        # the client's waiting and retry messages aren't wanted in the test output
+        self.stdout = sys.stdout
+        sys.stdout  = open(os.devnull, 'w')
+
+    def tearDown(self):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+        self.server.shutdown()
+        self.server.server_close()
+        GenerateStateMapperData.DEXTER_BACKOFF, GenerateStateMapperData.DEXTER_POLL_SECONDS, GenerateStateMapperData.DEXTER_MAX_WAIT = self.timings
+
+    def broker_requests(self):
+        return len([ path for path in self.server.requests if path.startswith('/cgi-bin/broker') ])
+
+    def test_extract(self):
+        self.assertEqual(self.client.extract(self.PARAMS, read_text), self.server.extracts.values()[0])
+        self.assertEqual(self.broker_requests(), 1)
+
+    def test_polling(self):
+        # the extract isn't written yet the first few times it's checked for, which is waited out without going back to the broker
+        self.server.pending = 3
+        self.assertEqual(self.client.extract(self.PARAMS, read_text), self.server.extracts.values()[0])
+        self.assertEqual(self.broker_requests(), 1)
+        self.assertEqual(len(self.server.requests), 5)
+
+    def test_polling_gives_up(self):
+        GenerateStateMapperData.DEXTER_MAX_WAIT = 0.05
+        self.server.pending = 1000
+        self.client.retries = 0
+        self.assertRaises(IOError, self.client.extract, self.PARAMS, read_text)
+        self.assertTrue(self.server.pending > 0)
+
+    def test_meta_refresh(self):
+        # the broker says to come back to another URL, then has the extract there
+        self.server.pages = [ (200, '<html><head><meta http-equiv="refresh" content="0; url=/cgi-bin/broker?sasdset=vtblocks&varlist=geoid%2Cp0010001%2Cp0120003&wait=1"></head></html>') ]
+        self.assertEqual(self.client.extract(self.PARAMS, read_text), self.server.extracts.values()[0])
+        self.assertEqual(self.broker_requests(), 2)
+        self.assertTrue(self.server.requests[1].endswith('&wait=1'))
+
+    def test_retry(self):
+        # a 503 or two is ridden out
+        self.server.pages = [ (503, 'Service Unavailable'), (503, 'Service Unavailable') ]
+        self.assertEqual(self.client.extract(self.PARAMS, read_text), self.server.extracts.values()[0])
+        self.assertEqual(self.broker_requests(), 3)
+
+    def test_retry_gives_up(self):
+        # but not past the retries
+        self.server.pages = [ (503, 'Service Unavailable') ] * 5
+        try:
+            self.client.extract(self.PARAMS, read_text)
+        except urllib2.HTTPError, error:
+            self.assertEqual(error.code, 503)
+        else:
+            self.fail("no error after the retries")
+        self.assertEqual(self.broker_requests(), 3)
+
+    def test_not_retried(self):
+        # a bad query, an extract the broker doesn't have, or a page with no extract on it, are given up on straight away
+        for status, body in [ (400, 'Bad Request'), (404, 'Not Found'), (200, '<html><body>Something went wrong</body></html>') ]:
+            self.server.requests = []
+            self.server.pages    = [ (status, body) ]
+            self.assertRaises(IOError, self.client.extract, self.PARAMS, read_text)
+            self.assertEqual(self.broker_requests(), 1)
+
+    def test_varlist_batches(self):
+        # a varlist of three split into sub-extracts of two and one, fetched side by side and joined back together on the GEOID,
+        # though the second sub-extract has the rows in another order
+        columns = [ ('p0010001','TotPop'), ('p0120003','Boys'), ('p0130001','MedianAge') ]
+        batches = GenerateStateMapperData.dexter_batches(self.PARAMS, columns, 2)
+        self.assertEqual([ (params['varlist'], labels) for params,labels in batches ], [ ('esriid,p0010001,p0120003', [ 'TotPop', 'Boys' ]), ('esriid,p0130001', [ 'MedianAge' ]) ])
+        self.assertEqual(GenerateStateMapperData.dexter_batches(self.PARAMS, columns, 3), [ (self.PARAMS, [ 'TotPop', 'Boys', 'MedianAge' ]) ])
+
+        ages = { '500010001001000':'41.5', '500010001001001':'0', '500010001001002':'30.25' }
+        self.server.serve('esriid,p0010001,p0120003', self.ROWS)
+        self.server.serve('esriid,p0130001', [ [ geoid, ages[geoid] ] for geoid in sorted(ages.keys(), reverse=True) ])
+        readers = [ lambda remote, labels=labels: GenerateStateMapperData.read_attribute_rows(csv.reader(remote), 15, labels, 'test', { 'MedianAge':'f8' }) for params,labels in batches ]
+        parts   = self.client.extract_all(zip([ params for params,labels in batches ], readers))
+        data    = GenerateStateMapperData.join_attribute_batches(parts)
+        self.assertEqual(data.dtype.names, ('GEOID', 'TotPop', 'Boys', 'MedianAge'))
+        self.assertEqual(data['GEOID'].tolist(), [ row[0] for row in self.ROWS ])
+        self.assertEqual(data['TotPop'].tolist(), [ 35, 0, 12 ])
+        self.assertEqual(data['Boys'].tolist(), [ 7, 0, 3 ])
+        self.assertEqual(data['MedianAge'].tolist(), [ 41.5, 0, 30.25 ])
+
+        # a sub-extract which came back with other blocks in it, or too few, can't be joined
+        self.assertRaises(IOError, GenerateStateMapperData.join_attribute_batches, [ parts[0], parts[1][:2] ])
+        other = parts[1].copy()
+        other['GEOID'][0] = '500010001001099'
+        self.assertRaises(IOError, GenerateStateMapperData.join_attribute_batches, [ parts[0], other ])
+
+
+if __name__ == '__main__':
+    unittest.main()
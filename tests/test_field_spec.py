@@ -0,0 +1,108 @@
+#!/bin/env python
+"""
+Tests for the field spec in GenerateStateMapperData.py: reading the source columns out of an extract, and FieldTransform making the fields from them
+
+Usage:
+    python -m unittest discover tests
+"""
+
+import os, sys, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import GenerateStateMapperData
+import numpy
+
+
+class ReadAttributeRowsTest(unittest.TestCase):
+    def read(self,rows,types=None):
+        return GenerateStateMapperData.read_attribute_rows(rows, 15, [ 'TotPop', 'MedianAge' ], 'Dexter extract vtblocks_test', types)
+
+    def assertBadRow(self,rows,message,types=None):
+        try:
+            self.read(rows, types)
+        except IOError, error:
+            self.assertEqual(str(error), message)
+        else:
+            self.fail("no error for %s" % rows)
+
+    def test_types(self):
+        data = self.read([ [ '500010000001000', '35', '41.5' ], [ '500010000001001', '7', '8' ] ], { 'MedianAge':'f8' })
+        self.assertEqual(data['TotPop'].dtype.str, '<i4')
+        self.assertEqual(data['TotPop'].tolist(), [ 35, 7 ])
+        self.assertEqual(data['MedianAge'].tolist(), [ 41.5, 8.0 ])
+
+    def test_fraction_in_integer_column(self):
+        self.assertBadRow([ [ '500010000001000', '35', '7' ], [ '500010000001001', '8.5', '9' ] ],
+            "Dexter extract vtblocks_test: row 2 (GEOID 500010000001001) has 8.5 for TotPop, which should be a whole number")
+
+    def test_empty_cell(self):
+        self.assertBadRow([ [ '500010000001000', '1', '' ], [ '500010000001001', '3', '4' ] ],
+            "Dexter extract vtblocks_test: row 1 (GEOID 500010000001000) has '' for MedianAge, which isn't a number")
+
+    def test_row_width(self):
+        self.assertBadRow([ [ '500010000001000', '1', '2' ], [ '500010000001001', '3' ] ],
+            "Dexter extract vtblocks_test: row 2 has 2 columns, not 3")
+
+    def test_row_numbers_across_chunks(self):
+        chunkrows = GenerateStateMapperData.ATTRIBUTE_CHUNK_ROWS
+        GenerateStateMapperData.ATTRIBUTE_CHUNK_ROWS = 2
+        try:
+            rows = [ [ '5000100000010%02d' % index, str(index), '1' ] for index in range(5) ] + [ [ '500010000001099', 'x', '1' ] ]
+            self.assertBadRow(rows, "Dexter extract vtblocks_test: row 6 (GEOID 500010000001099) has 'x' for TotPop, which isn't a number")
+        finally:
+            GenerateStateMapperData.ATTRIBUTE_CHUNK_ROWS = chunkrows
+
+
+class FieldTransformTest(unittest.TestCase):
+    SOURCE = [ [ 'P6i1', 'TotPop' ], [ 'P4i3', 'Hispanic' ], [ 'P13i1', 'MedianAge', 'real' ] ]
+
+    def transform(self,fields,maxname=None):
+        return GenerateStateMapperData.FieldTransform({ 'source':self.SOURCE, 'fields':fields }, maxname)
+
+    def data(self):
+        data = numpy.zeros(3, dtype=[ ('GEOID','S15'), ('TotPop','i4'), ('Hispanic','i4'), ('MedianAge','f8') ])
+        data['TotPop']    = [ 9, 0, 3 ]
+        data['Hispanic']  = [ 3, 0, 1 ]
+        data['MedianAge'] = [ 41.5, 0, 30.25 ]
+        return data
+
+    def assertBadSpec(self,fields,message,maxname=None):
+        try:
+            self.transform(fields, maxname)
+        except ValueError, error:
+            self.assertEqual(str(error), message)
+        else:
+            self.fail("no error for %s" % fields)
+
+    def test_fields(self):
+        transform = self.transform([ [ 'TOTPOP', 'count', 'TotPop' ], [ 'PCTHISP', 'real', '100 * Hispanic / TotPop' ], [ 'AGE', 'real', 'MedianAge' ] ])
+        columns   = transform(self.data())
+        self.assertEqual(columns['TOTPOP'].tolist(), [ 9, 0, 3 ])
+        self.assertEqual(columns['AGE'].tolist(), [ 41.5, 0, 30.25 ])
+        self.assertAlmostEqual(columns['PCTHISP'][0], 33.333333, 5)
+        # a block with no population gets 0 rather than a division by zero
+        self.assertEqual(columns['PCTHISP'][1], 0)
+        self.assertEqual(transform.sumfields, [ 'TOTPOP' ])
+
+    def test_true_division(self):
+        # 1/3 is a third, not Python 2's 0
+        columns = self.transform([ [ 'THIRD', 'real', 'TotPop * (1/3)' ] ])(self.data())
+        self.assertEqual(columns['THIRD'].tolist(), [ 3.0, 0.0, 1.0 ])
+
+    def test_names(self):
+        self.assertBadSpec([ [ 'TOTPOP', 'count', 'TotPop' ], [ 'TOTPOP', 'count', 'Hispanic' ] ], "Field TOTPOP is in the field spec twice")
+        self.assertBadSpec([ [ 'MHHINC', 'integer', 'TotPop' ] ], "Field MHHINC would clash with the blocks' GEOID, the rollups' BLOCKS or the ACS fields' MHHINC; give it another name")
+        self.assertBadSpec([ [ 'GEOID', 'integer', 'TotPop' ] ], "Field GEOID would clash with the blocks' GEOID, the rollups' BLOCKS or the ACS fields' MHHINC; give it another name")
+        self.assertBadSpec([ [ 'PCTHISPANIC', 'real', 'Hispanic / TotPop' ] ], "Field PCTHISPANIC is longer than a shapefile's 10 characters for a field name; give it a shorter one", 10)
+        self.transform([ [ 'PCTHISPANIC', 'real', 'Hispanic / TotPop' ] ])
+
+    def test_expressions(self):
+        self.assertBadSpec([ [ 'F', 'real', '(TotPop' ] ], "Field F's expression isn't valid arithmetic: (TotPop (unexpected EOF while parsing)")
+        self.assertBadSpec([ [ 'F', 'real', 'TotPop ** 2' ] ], "Field F's expression has something out of place at: * 2")
+        self.assertBadSpec([ [ 'F', 'real', 'TotPop(2)' ] ], "Field F's expression has something out of place at: (2)")
+        self.assertBadSpec([ [ 'F', 'real', 'Kids / TotPop' ] ], "Field F's expression uses Kids, which isn't one of the spec's source labels")
+        self.assertBadSpec([ [ 'F', 'float', 'TotPop' ] ], "Field F has unknown type float; use one of count, integer, real")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+#!/bin/env python
+"""
+Tests for the PMTiles writer in GenerateStateMapperData.py: the Hilbert tile IDs, and an archive re-packed from a small MBTiles
+
+The tile IDs are checked against values from the PMTiles specification's own tests, and the archive is read back
+by a minimal reader here, following the specification rather than the writer, to find every tile where it should be.
+
+Usage:
+    python -m unittest discover tests
+"""
+
+import os, sys, gzip, shutil, sqlite3, struct, tempfile, unittest, StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import GenerateStateMapperData
+
+
+def read_varint(data,position):
+    value = 0
+    shift = 0
+    while True:
+        byte = ord(data[position])
+        position += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, position
+
+
+def read_directory(data):
+    # a gunzipped directory as [tileid, offset, length, runlength] entries
+    data     = gzip.GzipFile(fileobj=StringIO.StringIO(data)).read()
+    count, position = read_varint(data, 0)
+    columns  = []
+    for column in range(4):
+        values = []
+        for index in range(count):
+            value, position = read_varint(data, position)
+            values.append(value)
+        columns.append(values)
+    deltas, runlengths, lengths, offsets = columns
+    entries = []
+    tileid  = 0
+    for index in range(count):
+        tileid += deltas[index]
+        offset  = entries[-1][1] + entries[-1][2] if index and offsets[index] == 0 else offsets[index] - 1
+        entries.append([ tileid, offset, lengths[index], runlengths[index] ])
+    return entries
+
+
+class PMTilesTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='testpmtiles')
+        self.mbtiles = os.path.join(self.workdir, 'censusblocks.mbtiles')
+        self.target  = os.path.join(self.workdir, 'censusblocks.pmtiles')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_tileids(self):
+        self.assertEqual(GenerateStateMapperData.pmtiles_tileid(0, 0, 0), 0)
+        self.assertEqual(GenerateStateMapperData.pmtiles_tileid(1, 0, 0), 1)
+        self.assertEqual(GenerateStateMapperData.pmtiles_tileid(1, 0, 1), 2)
+        self.assertEqual(GenerateStateMapperData.pmtiles_tileid(1, 1, 1), 3)
+        self.assertEqual(GenerateStateMapperData.pmtiles_tileid(1, 1, 0), 4)
+        self.assertEqual(GenerateStateMapperData.pmtiles_tileid(2, 0, 0), 5)
+        self.assertEqual(GenerateStateMapperData.pmtiles_tileid(3, 0, 0), 21)
+        self.assertEqual(GenerateStateMapperData.pmtiles_tileid(12, 3423, 1763), 19078479)
+
+    def test_varint(self):
+        self.assertEqual(GenerateStateMapperData.pmtiles_varint(1), '\x01')
+        self.assertEqual(GenerateStateMapperData.pmtiles_varint(300), '\xac\x02')
+        self.assertEqual(read_varint(GenerateStateMapperData.pmtiles_varint(19078479), 0), (19078479, 4))
+
+    def test_archive(self):
+        # every tile of zoom 0 to 2, in MBTiles' TMS rows; all of zoom 2's tiles are the same empty tile but one, so they're stored once
+        tiles = { (0,0,0):'world' }
+        for x in range(2):
+            for y in range(2):
+                tiles[(1,x,y)] = 'zoom 1 tile %d %d' % (x, y)
+        for x in range(4):
+            for y in range(4):
+                tiles[(2,x,y)] = 'ocean'
+        tiles[(2,1,1)] = 'vermont'
+        database = sqlite3.connect(self.mbtiles)
+        database.execute('CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)')
+        for (zoom,x,y),data in tiles.items():
+            database.execute('INSERT INTO tiles VALUES (?, ?, ?, ?)', (zoom, x, (1 << zoom) - 1 - y, sqlite3.Binary(data)))
+        database.commit()
+        database.close()
+        GenerateStateMapperData.write_pmtiles(self.mbtiles, self.target, { 'bounds':'-73.4,42.7,-71.5,45.0', 'center':'-72.5,44.0,2' })
+
+        archive = open(self.target, 'rb').read()
+        self.assertEqual(archive[:8], 'PMTiles\x03')
+        rootoffset, rootlength, metaoffset, metalength, leafoffset, leaflength, dataoffset, datalength, addressed, entrycount, contents = struct.unpack_from('<QQQQQQQQQQQ', archive, 8)
+        minzoom, maxzoom = struct.unpack_from('<BB', archive, 8 + 88 + 4)
+        self.assertEqual((minzoom, maxzoom, addressed), (0, 2, len(tiles)))
+        self.assertEqual(contents, len(set(tiles.values())))
+        self.assertEqual(leaflength, 0)
+
+        entries = read_directory(archive[rootoffset:rootoffset+rootlength])
+        self.assertEqual(len(entries), entrycount)
+        found = {}
+        for tileid, offset, length, runlength in entries:
+            for run in range(runlength):
+                found[tileid + run] = archive[dataoffset+offset:dataoffset+offset+length]
+        self.assertEqual(found, dict([ (GenerateStateMapperData.pmtiles_tileid(zoom, x, y), data) for (zoom,x,y),data in tiles.items() ]))
+        self.assertFalse(os.path.exists(self.target + '.tiledata'))
+
+
+if __name__ == '__main__':
+    unittest.main()
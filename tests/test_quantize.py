@@ -0,0 +1,69 @@
+#!/bin/env python
+"""
+Tests for quantize_wkb in GenerateStateMapperData.py, the coordinate rounding of --optimize, on hand-made WKB polygons
+
+It takes OGR's geometry type codes, so like the rest of --optimize it needs GDAL, and these are skipped without it.
+
+Usage:
+    python -m unittest discover tests
+"""
+
+import os, sys, struct, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import GenerateStateMapperData
+
+
+def polygon_wkb(rings):
+    # little-endian WKB of a polygon, from a list of rings, each a list of (x, y)
+    wkb = struct.pack('<BII', 1, 3, len(rings))
+    for ring in rings:
+        wkb += struct.pack('<I', len(ring)) + ''.join([ struct.pack('<dd', x, y) for x,y in ring ])
+    return wkb
+
+
+def multipolygon_wkb(polygons):
+    return struct.pack('<BII', 1, 6, len(polygons)) + ''.join([ polygon_wkb(rings) for rings in polygons ])
+
+
+def read_rings(wkb,offset):
+    # a polygon's rings from WKB, and the offset just past it
+    count  = struct.unpack_from('<I', wkb, offset + 5)[0]
+    offset += 9
+    rings  = []
+    for index in range(count):
+        points = struct.unpack_from('<I', wkb, offset)[0]
+        rings.append([ struct.unpack_from('<dd', wkb, offset + 4 + 16 * point) for point in range(points) ])
+        offset += 4 + 16 * points
+    return rings, offset
+
+
+@unittest.skipIf(GenerateStateMapperData.ogr is None, "GDAL's Python bindings aren't installed")
+class QuantizeTest(unittest.TestCase):
+    def test_rounding(self):
+        # a square with a vertex a hair away from its corner, which rounds onto the corner and goes
+        square = [ (-72.1234564, 44.0), (-72.1224564, 44.0), (-72.12245641, 44.00000001), (-72.1224564, 44.001), (-72.1234564, 44.001), (-72.1234564, 44.0) ]
+        wkb, vertices, kept = GenerateStateMapperData.quantize_wkb(polygon_wkb([ square ]), 6)
+        rings, offset = read_rings(wkb, 0)
+        self.assertEqual((vertices, kept), (6, 5))
+        self.assertEqual(offset, len(wkb))
+        self.assertEqual(rings, [ [ (-72.123456, 44.0), (-72.122456, 44.0), (-72.122456, 44.001), (-72.123456, 44.001), (-72.123456, 44.0) ] ])
+
+    def test_tiny_hole(self):
+        # a hole smaller than the rounding is dropped, and the outer ring kept
+        outer = [ (0.0, 0.0), (1.0, 0.0), (1.0, 1.0), (0.0, 1.0), (0.0, 0.0) ]
+        hole  = [ (0.5, 0.5), (0.5000001, 0.5), (0.5, 0.5000001), (0.5, 0.5) ]
+        wkb, vertices, kept = GenerateStateMapperData.quantize_wkb(multipolygon_wkb([ [ outer, hole ] ]), 6)
+        self.assertEqual(struct.unpack_from('<BII', wkb, 0), (1, 6, 1))
+        rings, offset = read_rings(wkb, 9)
+        self.assertEqual(rings, [ outer ])
+        self.assertEqual(vertices, 9)
+
+    def test_other_geometry(self):
+        # anything but a little-endian polygon or multipolygon comes back as it was
+        point = struct.pack('<BIdd', 1, 1, -72.1234567, 44.1234567)
+        self.assertEqual(GenerateStateMapperData.quantize_wkb(point, 6), (point, 0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
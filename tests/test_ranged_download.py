@@ -0,0 +1,130 @@
+#!/bin/env python
+"""
+Tests for RangedDownload in GenerateStateMapperData.py, against a local HTTP server standing in for the Census web site
+
+The server answers Range requests with a 206 the way the Census web site does, and can be told to drop each connection partway,
+or to ignore Range altogether and send the whole file every time, so the fallback to a single stream is tested too.
+
+Usage:
+    python -m unittest discover tests
+"""
+
+import os, sys, random, shutil, tempfile, threading, unittest
+import BaseHTTPServer, SocketServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import GenerateStateMapperData
+
+
+class RangeRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # the file's bytes and how to behave are set on the server, see RangeServer
+    def do_GET(self):
+        content = self.server.content
+        ranged  = self.headers.getheader('Range')
+        self.server.ranges.append(ranged)
+        start = 0
+        end   = len(content) - 1
+        if ranged and not self.server.ignorerange:
+            first, last = ranged[6:].split('-')
+            start = int(first)
+            end   = min(int(last), len(content) - 1)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, len(content)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Last-Modified', 'Wed, 01 Jan 2014 00:00:00 GMT')
+        self.end_headers()
+
+        # dropping the connection: say how long the body is, send half of it, then hang up
+        body = content[start:end+1]
+        if self.server.drop and end > start:
+            body = body[:len(body) / 2]
+        self.wfile.write(body)
+
+    def log_message(self,*args):
+        pass
+
+
+class RangeServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self,content):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), RangeRequestHandler)
+        self.content     = content
+        self.ranges      = []
+        self.drop        = False
+        self.ignorerange = False
+
+
+class RangedDownloadTest(unittest.TestCase):
+    def setUp(self):
+        # a file big enough to be split over several connections, with the minimum part size turned down to suit
+        self.minpart = GenerateStateMapperData.DOWNLOAD_MIN_PART
+        GenerateStateMapperData.DOWNLOAD_MIN_PART = 4096
+        generator    = random.Random(2010)
+        self.content = "".join([ chr(generator.randint(0, 255)) for index in range(50000) ])
+        self.workdir = tempfile.mkdtemp(prefix='testranged')
+        self.server  = RangeServer(self.content)
+        self.thread  = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url     = 'http://127.0.0.1:%d/tl_2010_50_tabblock10.zip' % self.server.server_address[1]
+        self.target  = os.path.join(self.workdir, 'blocks.zip')
+
+        # the download's progress and retry messages aren't wanted in the test output
+        self.stdout = sys.stdout
+        sys.stdout  = open(os.devnull, 'w')
+
+    def tearDown(self):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.workdir)
+        GenerateStateMapperData.DOWNLOAD_MIN_PART = self.minpart
+
+    def download(self,retries=GenerateStateMapperData.DOWNLOAD_RETRIES):
+        return GenerateStateMapperData.RangedDownload(self.url, self.target + '.parts', connections=4, retries=retries, timeout=10)
+
+    def leftovers(self):
+        return [ filename for filename in os.listdir(self.workdir) if filename.startswith('blocks.zip.parts') ]
+
+    def test_parts_stitched(self):
+        lastmodified = self.download().fetch(self.target)
+        self.assertEqual(open(self.target, 'rb').read(), self.content)
+        self.assertEqual(lastmodified, 'Wed, 01 Jan 2014 00:00:00 GMT')
+        # the probe, then one request per connection
+        self.assertEqual(len(self.server.ranges), 5)
+        self.assertEqual(self.leftovers(), [])
+
+    def test_resume_after_dropped_connection(self):
+        # every connection drops halfway and there are no retries, so the download fails but keeps its parts
+        self.server.drop = True
+        self.assertRaises(IOError, self.download(retries=0).fetch, self.target)
+        self.assertFalse(os.path.exists(self.target))
+        self.assertTrue(os.path.exists(self.target + '.parts.json'))
+        planned = [ int(ranged[6:].split('-')[0]) for ranged in self.server.ranges[1:] ]
+
+        # the next attempt asks only for what's still missing of each part, then stitches the whole file together
+        self.server.drop   = False
+        self.server.ranges = []
+        self.download().fetch(self.target)
+        self.assertEqual(open(self.target, 'rb').read(), self.content)
+        resumed = [ int(ranged[6:].split('-')[0]) for ranged in self.server.ranges[1:] ]
+        self.assertEqual(len(resumed), len(planned))
+        for start in resumed:
+            self.assertNotIn(start, planned)
+        self.assertEqual(self.leftovers(), [])
+
+    def test_server_ignoring_range(self):
+        # a 200 to the probe means no ranges, so the file comes down in one stream
+        self.server.ignorerange = True
+        self.download().fetch(self.target)
+        self.assertEqual(open(self.target, 'rb').read(), self.content)
+        self.assertEqual(len(self.server.ranges), 2)
+        self.assertEqual(self.server.ranges[1], None)
+
+
+if __name__ == '__main__':
+    unittest.main()
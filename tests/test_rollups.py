@@ -0,0 +1,91 @@
+#!/bin/env python
+"""
+Tests for BlockRollups in GenerateStateMapperData.py: the block groups, tracts and counties added up from batches of merged blocks
+
+The batches' partial sums are checked against the same sums worked out one block at a time in plain Python,
+with the blocks split into batches which cut through block groups and tracts, as the merge's batches do.
+
+Usage:
+    python -m unittest discover tests
+"""
+
+import os, sys, random, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import GenerateStateMapperData
+import numpy
+
+
+# a small field spec of two counts and one field which isn't, so only the counts are added up
+FIELD_SPEC = {
+    'source' : [ [ 'P001001', 'TotPop' ], [ 'P012003', 'Boys' ] ],
+    'fields' : [ [ 'BOYS', 'count', 'Boys' ], [ 'TOTPOP', 'count', 'TotPop' ], [ 'PCTBOYS', 'real', '100.0 * Boys / TotPop' ] ],
+}
+
+
+class BlockRollupsTest(unittest.TestCase):
+    def setUp(self):
+        generator   = random.Random(2010)
+        self.geoids = sorted(set([ "50%03d%06d%04d" % (generator.choice([1,3]), generator.randint(0,5), generator.randint(1000,1300)) for index in range(2000) ]))
+        self.config = { 'statefips':'50', 'rollups':[ 'blockgroup', 'tract', 'county' ], 'fieldspec':FIELD_SPEC }
+
+        # each tract's MHHINC is the same for all of its blocks, as the ACS join gives it
+        incomes      = dict([ (geoid[:11], generator.randint(10000, 90000)) for geoid in self.geoids ])
+        self.columns = {
+            'TOTPOP' : [ generator.randint(0, 200) for geoid in self.geoids ],
+            'BOYS'   : [ generator.randint(0, 50) for geoid in self.geoids ],
+            'MHHINC' : [ incomes[geoid[:11]] for geoid in self.geoids ],
+        }
+
+    def rollups(self,batchsize):
+        rollups = GenerateStateMapperData.BlockRollups(self.config, None)
+        for start in range(0, len(self.geoids), batchsize):
+            geoids  = numpy.array(self.geoids[start:start+batchsize], dtype='S15')
+            columns = dict([ (name, numpy.array(values[start:start+batchsize], dtype='i4')) for name,values in self.columns.items() ])
+            rollups.add(geoids, columns)
+        return rollups
+
+    def test_sum_fields(self):
+        # the counts, with TOTPOP first as it's always been
+        self.assertEqual(GenerateStateMapperData.rollup_sum_fields(self.config), [ 'TOTPOP', 'BOYS' ])
+
+    def test_totals(self):
+        rollups = self.rollups(97)
+        for name, width, basename in GenerateStateMapperData.ROLLUP_LEVELS:
+            expected = {}
+            for position,geoid in enumerate(self.geoids):
+                area = expected.setdefault(geoid[:width], { 'BLOCKS':0, 'TOTPOP':0, 'BOYS':0 })
+                area['BLOCKS'] += 1
+                area['TOTPOP'] += self.columns['TOTPOP'][position]
+                area['BOYS']   += self.columns['BOYS'][position]
+                if name == 'tract':
+                    area['MHHINC'] = self.columns['MHHINC'][position]
+
+            areas, totals = rollups.totals(name)
+            self.assertEqual(areas.tolist(), sorted(expected.keys()))
+            self.assertEqual(sorted(totals.keys()), sorted(expected.values()[0].keys()))
+            for field in totals:
+                self.assertEqual(totals[field].tolist(), [ expected[area][field] for area in areas.tolist() ])
+
+    def test_batch_size(self):
+        # however the blocks are batched, the totals come out the same
+        whole = self.rollups(len(self.geoids))
+        small = self.rollups(13)
+        for name, width, basename in GenerateStateMapperData.ROLLUP_LEVELS:
+            areas, totals   = whole.totals(name)
+            batched, others = small.totals(name)
+            self.assertEqual(areas.tolist(), batched.tolist())
+            for field in totals:
+                self.assertEqual(totals[field].tolist(), others[field].tolist())
+
+    def test_no_blocks(self):
+        # e.g. a county with no blocks: every level has no areas, but still every field
+        rollups = GenerateStateMapperData.BlockRollups(self.config, None)
+        for name, width, basename in GenerateStateMapperData.ROLLUP_LEVELS:
+            areas, totals = rollups.totals(name)
+            self.assertEqual(len(areas), 0)
+            self.assertEqual(sorted(totals.keys()), sorted([ 'BLOCKS', 'TOTPOP', 'BOYS' ] + ([ 'MHHINC' ] if name == 'tract' else [])))
+
+
+if __name__ == '__main__':
+    unittest.main()